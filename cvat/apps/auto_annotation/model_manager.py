@@ -419,7 +419,11 @@ def run_inference_thread(tid, model_file, weights_file, labels_mapping, attribut
 
         if reset:
             annotation.clear_task(tid)
-        annotation.save_task(tid, result)
+        # Jobs are saved in parallel, each in its own transaction
+        errors = annotation.save_task(tid, result, atomic=False)
+        failed_jobs = [jid for jid, error in errors.items() if error]
+        if failed_jobs:
+            raise Exception("Cannot save annotations for jobs {}".format(failed_jobs))
         slogger.glob.info("auto annotation for task {} done".format(tid))
     except Exception as e:
         try:
@@ -4,7 +4,18 @@
 # SPDX-License-Identifier: MIT
 
 import os
+import io
+import re
 import copy
+import json
+import pickle
+import hashlib
+import zlib
+import bisect
+import struct
+import tempfile
+import threading
+import uuid
 from django.utils import timezone
 from collections import OrderedDict
 import numpy as np
@@ -13,15 +24,21 @@ from collections import OrderedDict
 from distutils.util import strtobool
 from xml.sax.saxutils import XMLGenerator
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue, Empty
 from PIL import Image
 
 import django_rq
 from django.conf import settings
-from django.db import transaction
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Case, OuterRef, Q, Subquery, Value, When
 
 from cvat.apps.profiler import silk_profile
 from cvat.apps.engine.plugins import plugin_decorator
-from . import models
+from . import models, columnar
 from .task import get_frame_path, get_image_meta_cache
 from .log import slogger
 
@@ -29,23 +46,75 @@ from .log import slogger
 
 FORMAT_XML = 1
 FORMAT_JSON = 2
+FORMAT_COLUMNAR_JSON = 3
+
+# Fragments of dumps which have been cached with another version are ignored.
+# It has to be changed if the format of a dump is changed.
+_DUMP_CACHE_VERSION = 5
 
 def dump(tid, data_format, scheme, host):
     """
-    Dump annotation for the task in specified data format.
+    Dump annotation for the task in specified data format. Return a ticket
+    to check the dump. The ticket identifies the state of the task, thus
+    concurrent requests for the same state share one dump and nothing is
+    dumped again if the dump for the state is ready already.
     """
-    queue = django_rq.get_queue('default')
-    queue.enqueue_call(func=_dump, args=(tid, data_format, scheme, host, OrderedDict()),
-        job_id="annotation.dump/{}".format(tid))
+    ticket = get_dump_ticket(tid, data_format, scheme, host)
+    # Clients which check the dump without the ticket get this one
+    caches['annotation'].set(_get_last_dump_ticket_key(tid), ticket)
+    db_task = models.Task.objects.get(id=tid)
+    if _read_dump_ticket(db_task.get_dump_path()) != ticket:
+        queue = django_rq.get_queue('default')
+        rq_id = _get_dump_rq_id(tid, ticket)
+        rq_job = queue.fetch_job(rq_id)
+        if rq_job is None or not (rq_job.is_queued or rq_job.is_started):
+            queue.enqueue_call(func=_dump, args=(tid, data_format, scheme, host, OrderedDict()),
+                job_id=rq_id)
+
+    return ticket
+
+def get_dump_ticket(tid, data_format, scheme, host):
+    """
+    Get the ticket for the dump of the current state of the task (see dump)
+    """
+    return _get_dump_ticket(tid, data_format, scheme, host, OrderedDict())
+
+def get_last_dump_ticket(tid, data_format, scheme, host):
+    """
+    Get the ticket of the last dump request for the task. A check without
+    the ticket uses it instead of computing the ticket of the current state
+    (it runs plugins) on every poll. If there is no such ticket, the ticket
+    for the current state of the task is returned.
+    """
+    ticket = caches['annotation'].get(_get_last_dump_ticket_key(tid))
+    if ticket is None:
+        ticket = get_dump_ticket(tid, data_format, scheme, host)
+
+    return ticket
+
+def _get_last_dump_ticket_key(tid):
+    return 'dump_ticket/{}'.format(tid)
 
-def check(tid):
+def get_dump(tid, scheme, host):
     """
-    Check that potentially long operation 'dump' is completed.
-    Return the status as json/dictionary object.
+    Get the dump of annotation for the task in XML format as chunks of gzip
+    compressed data without writing it into a file. Segments are loaded and
+    merged while chunks are consumed, thus the first chunks are available
+    before the whole dump is ready.
+    """
+    return _stream_dump(tid, FORMAT_XML, scheme, host, OrderedDict())
+
+def check(tid, ticket):
     """
+    Check that potentially long operation 'dump' is completed. The ticket
+    is returned by dump(). Return the status as json/dictionary object.
+    """
+    db_task = models.Task.objects.get(id=tid)
     queue = django_rq.get_queue('default')
-    job = queue.fetch_job("annotation.dump/{}".format(tid))
-    if job is None:
+    job = queue.fetch_job(_get_dump_rq_id(tid, ticket))
+    if _read_dump_ticket(db_task.get_dump_path()) == ticket:
+        response = {"state": "created"}
+    elif job is None:
         response = {"state": "unknown"}
     elif job.is_failed:
         # FIXME: here we have potential race. In general job.exc_info is
@@ -58,20 +127,294 @@ def check(tid):
         response = {"state": "created"}
     else:
         response = {"state": "started"}
+    response['ticket'] = ticket
 
     return response
 
-@transaction.atomic
-def get(jid):
+def _get_dump_rq_id(tid, ticket):
+    return "annotation.dump/{}/{}".format(tid, ticket)
+
+def _read_dump_ticket(path):
     """
-    Get annotations for the job.
+    Get the ticket which the dump file has been made for (it is the comment
+    in the gzip header, see _gzip_blocks) or None if there is no dump.
     """
-    db_job = models.Job.objects.select_for_update().get(id=jid)
-    annotation = _AnnotationForJob(db_job)
-    annotation.init_from_db()
+    try:
+        with open(path, 'rb') as dump_file:
+            header = dump_file.read(64)
+    except FileNotFoundError:
+        return None
+
+    end = header.find(b'\0', 10)
+    if header[:4] != b'\x1f\x8b\x08\x10' or end == -1:
+        return None
+
+    return header[10:end].decode('latin-1')
+
+@contextmanager
+def _read_snapshot():
+    """
+    Run several read queries over one consistent snapshot of the database
+    without locking any rows. Concurrent writers (e.g. save_job) are not
+    blocked by readers and readers never see a half-applied save.
+    """
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        # By default PostgreSQL uses READ COMMITTED level, thus each query
+        # gets its own snapshot. The level can be changed only before the
+        # first query of the transaction. SQLite and MySQL (InnoDB) give
+        # a consistent snapshot inside a transaction by default.
+        if outermost and 'postgresql' in settings.DATABASES["default"]["ENGINE"]:
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        yield
+
+def _export_snapshot():
+    """
+    Return an identifier of the snapshot of the current transaction which
+    other connections can use to see the same data (see _import_snapshot)
+    or None if it isn't supported.
+    """
+    if connection.in_atomic_block and 'postgresql' in settings.DATABASES["default"]["ENGINE"]:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_export_snapshot()")
+            return cursor.fetchone()[0]
+
+    return None
+
+@contextmanager
+def _import_snapshot(snapshot):
+    """
+    Run read queries in a transaction over the snapshot exported by another
+    transaction (it has to be open). If snapshot is None, it is the same as
+    _read_snapshot().
+    """
+    if snapshot is None:
+        with _read_snapshot():
+            yield
+        return
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot])
+        yield
+
+def get(jid, frames=None):
+    """
+    Get annotations for the job. If frames (a pair of the first and the
+    last frame) is specified, only shapes on these frames and tracks which
+    are visible on them are returned.
+    """
+    with _read_snapshot():
+        db_job = models.Job.objects.select_related('segment__task').get(id=jid)
+        annotation = _AnnotationForJob(db_job, frames)
+        annotation.init_from_db()
 
     return annotation.to_client()
 
+def get_serialized(jid, data_format=FORMAT_JSON, frames=None):
+    """
+    Get annotations for the job as chunks of gzip compressed JSON in the
+    usual (FORMAT_JSON) or in the compact columnar (FORMAT_COLUMNAR_JSON)
+    format. The result is cached for the current annotation version of
+    the job and labels of the task. Big annotations are encoded and compressed incrementally,
+    thus memory usage doesn't depend on the size of the job. See get()
+    about frames. Annotations for a range of frames aren't cached.
+
+    Everything is read from the database before the first chunk, thus
+    the snapshot isn't held while a client downloads the result.
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=settings.ANNOTATION_CACHE_MAX_ITEM_SIZE)
+    try:
+        with _read_snapshot():
+            # Job.objects.get() can be served by cacheops from redis, thus
+            # the version is read by a separate query which isn't cached.
+            version, tid = models.Job.objects.filter(id=jid) \
+                .values_list('annotation_version', 'segment__task_id')[0]
+            # Deletion of a label or an attribute spec deletes annotations
+            # by the cascade without a change of the version
+            version = (version, _get_labels_digest(tid))
+            data = None if frames else _get_cached_annotation(jid, data_format, version)
+            if data is None:
+                db_job = models.Job.objects.select_related('segment__task').get(id=jid)
+                annotation = _AnnotationForJob(db_job, frames)
+                if data_format == FORMAT_COLUMNAR_JSON:
+                    strings = annotation.iter_client_columnar_json()
+                else:
+                    strings = annotation.iter_client_json()
+                # Compressed chunks are written into memory or into a temporary
+                # file if they are big
+                for chunk in _gzip_chunks(strings):
+                    buffer.write(chunk)
+
+        if data is not None:
+            yield data
+            return
+
+        size = buffer.tell()
+        buffer.seek(0)
+        if not frames and size <= settings.ANNOTATION_CACHE_MAX_ITEM_SIZE:
+            data = buffer.read()
+            _set_cached_annotation(jid, data_format, version, data)
+            yield data
+            return
+
+        for chunk in iter(lambda: buffer.read(256 * 1024), b''):
+            yield chunk
+    finally:
+        buffer.close()
+
+def _gzip_chunks(strings, chunk_size=256 * 1024):
+    """
+    Compress a sequence of strings into gzip format. Small strings are
+    joined into chunks of chunk_size characters before compression.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buffer, buffer_size = [], 0
+    for string in strings:
+        buffer.append(string)
+        buffer_size += len(string)
+        if buffer_size >= chunk_size:
+            chunk = compressor.compress(''.join(buffer).encode('utf-8'))
+            buffer, buffer_size = [], 0
+            if chunk:
+                yield chunk
+
+    chunk = compressor.compress(''.join(buffer).encode('utf-8'))
+    yield chunk + compressor.flush()
+
+def _deflate(text):
+    """
+    Compress text into a block of raw deflate data. Blocks are byte aligned
+    and don't refer to each other, thus they can be compressed separately
+    (e.g. cached) and concatenated into one gzip stream by _gzip_blocks.
+    The block is a tuple (data, crc32, size) where size is the length of
+    uncompressed data.
+    """
+    data = text.encode('utf-8')
+    if not data:
+        return (b'', 0, 0)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH),
+        zlib.crc32(data), len(data))
+
+def _inflate(block):
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(block[0]).decode('utf-8')
+
+def _digest(value):
+    """
+    SHA-1 of a canonical serialization of the value: None, numbers, strings,
+    NumPy arrays and lists, tuples, dicts and objects (by their attributes)
+    which contain them. Keys of dicts and attributes are sorted, thus unlike
+    a pickle the digest doesn't depend on the order of insertion or on the
+    hash seed of strings (Python 3.5).
+    """
+    digest = hashlib.sha1()
+
+    def update(value):
+        if value is None or isinstance(value, (bool, int, float, str, bytes)):
+            digest.update(repr(value).encode('utf-8'))
+        elif isinstance(value, (list, tuple)):
+            digest.update(b'[')
+            for item in value:
+                update(item)
+                digest.update(b',')
+            digest.update(b']')
+        elif isinstance(value, dict):
+            digest.update(b'{')
+            for key in sorted(value):
+                update(key)
+                digest.update(b':')
+                update(value[key])
+                digest.update(b',')
+            digest.update(b'}')
+        elif isinstance(value, np.ndarray):
+            digest.update('array({},{})'.format(value.dtype.str, value.shape).encode('utf-8'))
+            digest.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, np.generic):
+            update(value.item())
+        else:
+            digest.update(type(value).__name__.encode('utf-8'))
+            update(vars(value))
+
+    update(value)
+    return digest.hexdigest()
+
+def _gf2_matrix_times(matrix, vector):
+    result = 0
+    for row in matrix:
+        if not vector:
+            break
+        if vector & 1:
+            result ^= row
+        vector >>= 1
+    return result
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+# Operators which apply 2^n zero bytes to a CRC-32 (see crc32_combine in zlib)
+_CRC32_ZEROS_OPERATORS = []
+
+def _crc32_combine(crc1, crc2, size2):
+    """Get CRC-32 of concatenated data by CRC-32 of its parts"""
+    if not _CRC32_ZEROS_OPERATORS:
+        # The operator for one zero bit, then for 2, 4 and 8 bits (one byte)
+        operator = [0xedb88320] + [1 << n for n in range(31)]
+        for _ in range(3):
+            operator = _gf2_matrix_square(operator)
+        for _ in range(64):
+            _CRC32_ZEROS_OPERATORS.append(operator)
+            operator = _gf2_matrix_square(operator)
+
+    n = 0
+    while size2:
+        if size2 & 1:
+            crc1 = _gf2_matrix_times(_CRC32_ZEROS_OPERATORS[n], crc1)
+        size2 >>= 1
+        n += 1
+
+    return crc1 ^ crc2
+
+def _gzip_blocks(blocks, comment=None):
+    """
+    Concatenate blocks of raw deflate data (see _deflate) into gzip format.
+    The comment (a zero-terminated Latin-1 string) is kept in the header.
+    """
+    # Header: deflate, no flags or the comment flag, no mtime, unknown OS
+    if comment is None:
+        yield b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+    else:
+        yield b'\x1f\x8b\x08\x10\x00\x00\x00\x00\x00\xff' + \
+            comment.encode('latin-1') + b'\0'
+    crc, size = 0, 0
+    for data, block_crc, block_size in blocks:
+        if data:
+            crc = _crc32_combine(crc, block_crc, block_size)
+            size += block_size
+            yield data
+
+    # The final empty block and the trailer
+    yield zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS).flush() + \
+        struct.pack('<II', crc, size & 0xffffffff)
+
+def _get_labels_digest(tid):
+    return _digest(list(models.Label.objects.filter(task_id=tid) \
+        .order_by('id', 'attributespec__id') \
+        .values_list('id', 'name', 'attributespec__id', 'attributespec__text')))
+
+def _get_cached_annotation(jid, data_format, version):
+    item = caches['annotation'].get('job/{}/{}'.format(jid, data_format))
+    if item and item[0] == version:
+        return item[1]
+
+    return None
+
+def _set_cached_annotation(jid, data_format, version, data):
+    # Only the latest version of annotations is kept for a job
+    caches['annotation'].set('job/{}/{}'.format(jid, data_format), (version, data))
+
 @silk_profile(name="Save job")
 @plugin_decorator
 @transaction.atomic
@@ -87,9 +430,23 @@ def save_job(jid, data):
     annotation.force_set_client_id(data['create'])
     client_ids = annotation.validate_data_from_client(data)
 
-    annotation.delete_from_db(data['delete'])
-    annotation.save_to_db(data['create'])
-    annotation.update_in_db(data['update'])
+    if settings.ANNOTATION_JOURNAL:
+        # The save is applied to the annotation tables later by a worker.
+        # Until that readers apply it on top of the tables. Both of them
+        # parse it by init_from_client, thus a save which cannot be parsed
+        # is rejected here and never gets into the journal.
+        journal_data = json.dumps(data, default=_journal_default)
+        parsed_data = json.loads(journal_data)
+        for action in ['create', 'update']:
+            copy.copy(annotation).init_from_client(parsed_data[action])
+        for deleted_ids in parsed_data['delete'].values():
+            list(map(int, deleted_ids))
+        models.AnnotationJournal.objects.create(job=db_job, data=journal_data)
+        transaction.on_commit(lambda: _schedule_compaction(jid))
+    else:
+        annotation.delete_from_db(data['delete'])
+        annotation.save_to_db(data['create'])
+        annotation.update_in_db(data['update'])
 
     updated = sum([  len(data["update"][key]) for key in data["update"] ])
     deleted = sum([  len(data["delete"][key]) for key in data["delete"] ])
@@ -98,6 +455,7 @@ def save_job(jid, data):
     if updated or deleted or created:
         db_job.segment.task.updated_date = timezone.now()
         db_job.segment.task.save()
+        db_job.annotation_version += 1
 
     db_job.max_shape_id = max(db_job.max_shape_id, max(client_ids['create']) if client_ids['create'] else -1)
     db_job.save()
@@ -115,80 +473,265 @@ def clear_job(jid):
         .select_for_update().get(id=jid)
 
     annotation = _AnnotationForJob(db_job)
+    models.AnnotationJournal.objects.filter(job_id=jid).delete()
     annotation.delete_all_shapes_from_db()
     annotation.delete_all_paths_from_db()
 
     db_job.segment.task.updated_date = timezone.now()
     db_job.segment.task.save()
+    db_job.annotation_version += 1
+    db_job.save()
     slogger.job[jid].info("Leave clear_job API: jid = {}".format(jid))
 
+def _journal_default(obj):
+    # Tables of the columnar format are saved as usual lists of objects
+    if isinstance(obj, columnar.Table):
+        return list(obj)
+    if isinstance(obj, columnar.Row):
+        return {key: obj[key] for key in obj.columns if key != 'offsets'}
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+def _schedule_compaction(jid):
+    queue = django_rq.get_queue('annotation')
+    rq_id = 'annotation.compact_journal/{}'.format(jid)
+    rq_job = queue.fetch_job(rq_id)
+    # A started compaction can have checked the journal already before
+    # the save has been committed, thus only a queued one is enough.
+    # Compactions of the job don't run together (the job row is locked).
+    if rq_job is None or not rq_job.is_queued:
+        queue.enqueue_call(func=compact_journal, args=(jid,), job_id=rq_id)
+
+def compact_journal(jid):
+    """
+    Apply saves from the journal of the job to the annotation tables in
+    the order of saves and remove them from the journal. The saves have
+    been validated already. A save which cannot be applied anyway (e.g. it
+    has been appended by an older version) is moved aside (rejected) and
+    isn't applied by readers anymore, otherwise the journal is never empty.
+    """
+    # Saves which are appended during the compaction are compacted too
+    while True:
+        with transaction.atomic():
+            db_job = models.Job.objects.select_related('segment__task') \
+                .select_for_update().get(id=jid)
+            db_records = list(models.AnnotationJournal.objects \
+                .filter(job_id=jid, rejected=False).order_by('id') \
+                .values_list('id', 'data'))
+            if not db_records:
+                break
+
+            annotation = _AnnotationForJob(db_job)
+            rejected = []
+            for record_id, data in db_records:
+                try:
+                    with transaction.atomic():
+                        data = json.loads(data)
+                        annotation.delete_from_db(data['delete'])
+                        annotation.save_to_db(data['create'])
+                        annotation.update_in_db(data['update'])
+                except Exception:
+                    slogger.job[jid].error("cannot compact the save {}, it is "
+                        "rejected".format(record_id), exc_info=True)
+                    rejected.append(record_id)
+
+            if rejected:
+                models.AnnotationJournal.objects.filter(id__in=rejected) \
+                    .update(rejected=True)
+                # Readers don't apply rejected saves, thus annotations change
+                db_job.annotation_version += 1
+                db_job.save()
+            models.AnnotationJournal.objects.filter(job_id=jid, rejected=False,
+                id__lte=db_records[-1][0]).delete()
+            slogger.job[jid].info("{} saves have been compacted".format(
+                len(db_records) - len(rejected)))
+
 # pylint: disable=unused-argument
 @silk_profile(name="Save task")
-def save_task(tid, data):
+def save_task(tid, data, atomic=True):
     """
-    Save new annotations for the task.
+    Save new annotations for the task. See _run_for_jobs about the atomic
+    argument and the result.
     """
     slogger.task[tid].info("Enter save_task API: tid = {}".format(tid))
     db_task = models.Task.objects.get(id=tid)
     db_segments = list(db_task.segment_set.prefetch_related('job_set').all())
 
-    splitted_data = {}
-
-    for segment in db_segments:
-        jid = segment.job_set.first().id
-        start = segment.start_frame
-        stop = segment.stop_frame
-        splitted_data[jid] = {}
-        for action in ['create', 'update', 'delete']:
-            splitted_data[jid][action] = {
-                "boxes": list(filter(lambda x: start <= int(x['frame']) <= stop, data[action]['boxes'])),
-                "polygons": list(filter(lambda x: start <= int(x['frame']) <= stop, data[action]['polygons'])),
-                "polylines": list(filter(lambda x: start <= int(x['frame']) <= stop, data[action]['polylines'])),
-                "points": list(filter(lambda x: start <= int(x['frame']) <= stop, data[action]['points'])),
-                "box_paths": list(filter(lambda x: len(list(filter(lambda y: (start <= int(y['frame']) <= stop) and (not y['outside']), x['shapes']))), data[action]['box_paths'])),
-                "polygon_paths": list(filter(lambda x: len(list(filter(lambda y: (start <= int(y['frame']) <= stop) and (not y['outside']), x['shapes']))), data[action]['polygon_paths'])),
-                "polyline_paths": list(filter(lambda x: len(list(filter(lambda y: (start <= int(y['frame']) <= stop) and (not y['outside']), x['shapes']))), data[action]['polyline_paths'])),
-                "points_paths": list(filter(lambda x: len(list(filter(lambda y: (start <= int(y['frame']) <= stop) and (not y['outside']), x['shapes']))), data[action]['points_paths'])),
-            }
-
-    for jid, _data in splitted_data.items():
-        # if an item inside _data isn't empty need to call save_job
-        isNonEmpty = False
-        for action in ['create', 'update', 'delete']:
-            for objects in _data[action].values():
-                if objects:
-                    isNonEmpty = True
-                    break
-
-        if isNonEmpty:
-            save_job(jid, _data)
+    jobs = []
+    for db_segment, segment_data in _split_task_data(db_segments, data):
+        # if an item inside segment_data isn't empty need to call save_job
+        if any(objects for action_data in segment_data.values()
+            for objects in action_data.values()):
+            jobs.append((db_segment.job_set.first().id, segment_data))
+    results = _run_for_jobs(save_job, jobs, atomic)
 
     slogger.task[tid].info("Leave save_task API: tid = {}".format(tid))
+    return results
 
+def _split_task_data(db_segments, data):
+    """
+    Split data for the task by segments in one pass. A shape gets into all
+    segments which contain its frame (segments can overlap). A path gets
+    into all segments which contain one of its visible shapes. Segments for
+    a frame are found by a binary search over start frames of segments.
+    Return a list of (segment, data) pairs ordered by start frames.
+    """
+    db_segments = sorted(db_segments, key=lambda db_segment: db_segment.start_frame)
+    start_frames = [db_segment.start_frame for db_segment in db_segments]
+    segments_by_frame = {}
+
+    def get_segments(frame):
+        if frame not in segments_by_frame:
+            # Stop frames of segments don't decrease as start frames, thus
+            # segments which contain the frame are right before the found one
+            idx = bisect.bisect_right(start_frames, frame)
+            segments = []
+            while idx > 0 and db_segments[idx - 1].stop_frame >= frame:
+                idx -= 1
+                segments.append(idx)
+            segments_by_frame[frame] = segments
+
+        return segments_by_frame[frame]
+
+    actions = ['create', 'update', 'delete']
+    splitted_data = [{action: {shape_type: [] for shape_type in columnar.SHAPE_TYPES}
+        for action in actions} for _ in db_segments]
+    for action in actions:
+        for shape_type in ['boxes', 'polygons', 'polylines', 'points']:
+            for shape in data[action][shape_type]:
+                for idx in get_segments(int(shape['frame'])):
+                    splitted_data[idx][action][shape_type].append(shape)
+
+        for paths_type in ['box_paths', 'polygon_paths', 'polyline_paths', 'points_paths']:
+            for path in data[action][paths_type]:
+                segments = set()
+                for shape in path['shapes']:
+                    if not shape['outside']:
+                        segments.update(get_segments(int(shape['frame'])))
+                for idx in segments:
+                    splitted_data[idx][action][paths_type].append(path)
+
+    return list(zip(db_segments, splitted_data))
 
 # pylint: disable=unused-argument
 @silk_profile(name="Clear task")
-def clear_task(tid):
+def clear_task(tid, atomic=True):
     """
-    Clear annotations for the task.
+    Clear annotations for the task. See _run_for_jobs about the atomic
+    argument and the result.
     """
     slogger.task[tid].info("Enter clear_task API: tid = {}".format(tid))
     db_task = models.Task.objects.get(id=tid)
     db_segments = list(db_task.segment_set.prefetch_related('job_set').all())
 
-    for db_segment in db_segments:
-        for db_job in list(db_segment.job_set.all()):
-            clear_job(db_job.id)
+    jobs = [(db_job.id,) for db_segment in db_segments
+        for db_job in db_segment.job_set.all()]
+    results = _run_for_jobs(clear_job, jobs, atomic)
 
     slogger.task[tid].info("Leave clear_task API: tid = {}".format(tid))
+    return results
+
+def _run_for_jobs(func, jobs, atomic):
+    """
+    Call func(jid, *args) for each (jid, *args) item of jobs. If atomic is
+    True, all jobs are processed one by one in one transaction: all or
+    nothing, an error is raised. Otherwise jobs are processed in parallel
+    by ANNOTATION_SAVE_WORKERS threads (each with its own database
+    connection), each job in its own transaction, and an error for a job
+    doesn't stop other jobs. Return a dictionary {jid: None or an error}.
+    """
+    if atomic:
+        with transaction.atomic():
+            for jid, *args in jobs:
+                func(jid, *args)
+
+        return OrderedDict((job[0], None) for job in jobs)
+
+    results = {}
+    queue = Queue()
+    for job in jobs:
+        queue.put(job)
+    # Storages of loggers create them lazily without a lock, thus loggers
+    # of the jobs (and their tasks) are created here before threads use them
+    loggers = {job[0]: slogger.job[job[0]] for job in jobs}
+
+    def run_jobs():
+        while True:
+            try:
+                jid, *args = queue.get_nowait()
+            except Empty:
+                break
+            try:
+                func(jid, *args)
+                results[jid] = None
+            except Exception as ex:
+                results[jid] = ex
+                loggers[jid].error("cannot process the job", exc_info=True)
+
+    def run_worker():
+        try:
+            run_jobs()
+        finally:
+            # Each thread has its own connection to the database
+            connection.close()
+
+    # SQLite serializes all writers anyway
+    workers = min(settings.ANNOTATION_SAVE_WORKERS, len(jobs))
+    if workers > 1 and 'postgresql' in settings.DATABASES["default"]["ENGINE"]:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in range(workers):
+                executor.submit(run_worker)
+    else:
+        run_jobs()
+
+    return OrderedDict((job[0], results[job[0]]) for job in jobs)
 
-# pylint: disable=unused-argument
 def rq_handler(job, exc_type, exc_value, traceback):
-    tid = job.id.split('/')[1]
-    slogger.task[tid].error("dump annotation error was occured", exc_info=True)
+    # Ids of rq jobs are "annotation.<function>/<id of a task or a job>/..."
+    kind, object_id = job.id.split('/')[:2]
+    exc_info = (exc_type, exc_value, traceback)
+    if kind == 'annotation.dump':
+        slogger.task[int(object_id)].error("dump annotation error was occured",
+            exc_info=exc_info)
+    elif kind == 'annotation.save_job':
+        slogger.job[int(object_id)].error("cannot save annotation for the job",
+            exc_info=exc_info)
+    elif kind == 'annotation.compact_journal':
+        slogger.job[int(object_id)].error("cannot compact the journal of the job",
+            exc_info=exc_info)
 
 ##################################################
 
+# Points of polygons, polylines and points are kept in memory as arrays of
+# shape (N, 2) and in the database as packed little-endian float32 pairs.
+# The client and the dump use the text format "x0,y0 x1,y1 ...".
+def _split_points(points):
+    # Text which isn't a list of pairs "x,y" is converted point by point as
+    # before: extra values of a point are ignored and a point with a single
+    # value raises IndexError.
+    values = points.replace(' ', ',').split(',')
+    if len(values) != 2 * (points.count(' ') + 1):
+        values = []
+        for point in points.split(' '):
+            point = point.split(',')
+            values.extend([float(point[0]), float(point[1])])
+
+    return values
+
+def _parse_points(points):
+    return np.array(_split_points(points), dtype=np.float32).reshape(-1, 2)
+
+def _format_points(points):
+    # float32 keeps about 7 significant digits, thus coordinates are rounded
+    # to avoid noise like 23.979999542236328 in the output
+    points = np.around(points.astype(np.float64), 3).tolist()
+    return ' '.join(['{},{}'.format(x, y) for x, y in points])
+
+def _pack_points(points):
+    return points.astype('<f4').tobytes()
+
+def _unpack_points(data):
+    return np.frombuffer(data, dtype='<f4').reshape(-1, 2)
+
 class _Label:
     def __init__(self, db_label):
         self.id = db_label.id
@@ -196,9 +739,10 @@ class _Label:
 
 class _Attribute:
     def __init__(self, db_attr, value):
+        attr = db_attr.get_attribute()
         self.id = db_attr.id
-        self.name = db_attr.get_name()
-        if db_attr.get_type() == 'checkbox':
+        self.name = attr['name']
+        if attr['type'] == 'checkbox':
             self.value = str(value).lower()
         else:
             self.value = str(value)
@@ -271,6 +815,184 @@ class _InterpolatedPolyShape(_TrackedPolyShape):
         super().__init__(points, frame, occluded, z_order, outside, attributes)
         self.keyframe = keyframe
 
+class _Interpolation:
+    """
+    Shapes of a track on each frame where they are dumped. There is no
+    object per frame. Instead there are arrays with an item per frame: the
+    frame, the index of the shape of the track (a keyframe) which the shape
+    is based on, flags and coordinates of boxes. Attributes change only on
+    keyframes, thus they are kept once per keyframe. Objects for frames are
+    created on access only (e.g. iteration) and aren't kept.
+    """
+    def __init__(self, shapes, attributes, frames, sources, outside, occluded,
+        z_order, keyframe, coords=None):
+        self.shapes = shapes
+        self.attributes = attributes
+        self.frames = frames
+        self.sources = sources
+        self.outside = outside
+        self.occluded = occluded
+        self.z_order = z_order
+        self.keyframe = keyframe
+        # (xtl, ytl, xbr, ybr) for each frame if shapes are boxes
+        self.coords = coords
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return self._iter_shapes(0, len(self))
+
+    def __getitem__(self, index):
+        index = range(len(self))[index]
+        return next(self._iter_shapes(index, index + 1))
+
+    def get_range(self, start_frame, stop_frame):
+        """Get shapes on frames from start_frame to stop_frame inclusive"""
+        begin, end = np.searchsorted(self.frames, [start_frame, stop_frame + 1])
+        return list(self._iter_shapes(begin, end))
+
+    def get_columns(self, begin=0, end=None):
+        """
+        Get lists of frames, sources, outside, occluded, z_order and
+        keyframe values for frames from begin to end (indexes)
+        """
+        return [column[begin:end].tolist() for column in [self.frames, self.sources,
+            self.outside, self.occluded, self.z_order, self.keyframe]]
+
+    def _iter_shapes(self, begin, end):
+        rows = zip(*self.get_columns(begin, end))
+        if self.coords is not None:
+            for (frame, source, outside, occluded, z_order, keyframe), \
+                (xtl, ytl, xbr, ybr) in zip(rows, self.coords[begin:end].tolist()):
+                yield _InterpolatedBox(xtl, ytl, xbr, ybr, frame, occluded, z_order,
+                    outside, keyframe, self.attributes[source])
+        else:
+            for frame, source, outside, occluded, z_order, keyframe in rows:
+                yield _InterpolatedPolyShape(self.shapes[source].points, frame,
+                    occluded, z_order, outside, keyframe, self.attributes[source])
+
+def _accumulate_attributes(shapes):
+    """
+    New shape of a track doesn't have all attributes (only first one does).
+    Thus it is necessary to propagate them. Return the list of attributes
+    for each shape. Lists are shared if there are no changes.
+    """
+    result = []
+    attributes = {}
+    for shape in shapes:
+        if shape.attributes or not result:
+            for attr in shape.attributes:
+                attributes[attr.id] = attr
+            result.append(list(attributes.values()))
+        else:
+            result.append(result[-1])
+
+    return result
+
+def _split_interpolation(paths, shapes, attributes, sizes, counts, columns, coords=None):
+    """
+    Split arrays for frames of all tracks (see _interpolate_box_paths) into
+    interpolations of each track. sizes are numbers of keyframes of tracks,
+    counts are numbers of frames for each keyframe.
+    """
+    ends = np.cumsum(sizes)
+    frame_ends = np.append(0, np.cumsum(counts))[ends].tolist()
+    # Indexes of sources are local for each track
+    frames, sources, *flags = columns
+    sources = sources - np.repeat(ends - sizes, sizes)[sources]
+    begin, frame_begin = 0, 0
+    for path, end, frame_end in zip(paths, ends.tolist(), frame_ends):
+        path._interpolation = _Interpolation(shapes[begin:end], attributes[begin:end],
+            frames[frame_begin:frame_end], sources[frame_begin:frame_end],
+            *[flag[frame_begin:frame_end] for flag in flags],
+            coords=coords[frame_begin:frame_end] if coords is not None else None)
+        begin, frame_begin = end, frame_end
+
+def _interpolate_box_paths(paths):
+    """
+    Interpolate boxes of tracks which haven't been interpolated yet on all
+    frames at once by vectorized operations over keyframes of all tracks.
+    The arithmetic is the same as for a single box, thus the result is the
+    same up to the last bit. A box is interpolated linearly between two
+    keyframes. An outside keyframe is on its frame only. The last keyframe
+    lasts till the stop frame of the track.
+    """
+    paths = [path for path in paths if path._interpolation is None]
+    if not paths:
+        return
+
+    boxes = [box for path in paths for box in path.boxes]
+    sizes = np.array([len(path.boxes) for path in paths], dtype=np.int64)
+    assert np.all(sizes > 0)
+    ends = np.cumsum(sizes)
+    frames = np.array([box.frame for box in boxes], dtype=np.int64)
+    coords = np.array([(box.xtl, box.ytl, box.xbr, box.ybr) for box in boxes],
+        dtype=np.float64).reshape(-1, 4)
+    outside = np.array([box.outside for box in boxes], dtype=bool)
+    occluded = np.array([box.occluded for box in boxes], dtype=bool)
+    z_order = np.array([box.z_order for box in boxes], dtype=np.int64)
+
+    # The next keyframe for the last one is its copy after the stop frame
+    next_frames = np.empty_like(frames)
+    next_frames[:-1] = frames[1:]
+    next_frames[ends - 1] = [path.stop_frame + 1 for path in paths]
+    next_coords = np.empty_like(coords)
+    next_coords[:-1] = coords[1:]
+    next_coords[ends - 1] = coords[ends - 1]
+    distance = next_frames - frames
+    assert np.all(distance > 0)
+    deltas = (next_coords - coords) / distance.astype(np.float64)[:, np.newaxis]
+
+    counts = np.where(outside, 1, distance)
+    sources = np.repeat(np.arange(len(boxes)), counts)
+    offsets = np.arange(len(sources)) - np.repeat(np.cumsum(counts) - counts, counts)
+    columns = [frames[sources] + offsets, sources, outside[sources],
+        occluded[sources], z_order[sources], offsets == 0]
+    coords = coords[sources] + deltas[sources] * offsets[:, np.newaxis]
+
+    attributes = [attrs for path in paths for attrs in _accumulate_attributes(path.boxes)]
+    _split_interpolation(paths, boxes, attributes, sizes, counts, columns, coords)
+
+def _interpolate_poly_paths(paths):
+    """
+    The same as _interpolate_box_paths for polygons, polylines and points.
+    They aren't interpolated. A shape is on its keyframe only and becomes
+    outside on the next frame if it isn't a keyframe.
+    """
+    paths = [path for path in paths if path._interpolation is None]
+    if not paths:
+        return
+
+    path_shapes = []
+    for path in paths:
+        assert path.shapes[-1].frame <= path.stop_frame
+        shapes = {shape.frame: shape for shape in path.shapes
+            if shape.frame >= path.frame}
+        path_shapes.append([shapes[frame] for frame in sorted(shapes)])
+    shapes = [shape for keyframes in path_shapes for shape in keyframes]
+    sizes = np.array([len(keyframes) for keyframes in path_shapes], dtype=np.int64)
+    ends = np.cumsum(sizes)
+    frames = np.array([shape.frame for shape in shapes], dtype=np.int64)
+    outside = np.array([shape.outside for shape in shapes], dtype=bool)
+    occluded = np.array([shape.occluded for shape in shapes], dtype=bool)
+    z_order = np.array([shape.z_order for shape in shapes], dtype=np.int64)
+
+    next_frames = np.empty_like(frames)
+    next_frames[:-1] = frames[1:]
+    next_frames[ends[sizes > 0] - 1] = [path.stop_frame + 1
+        for path, size in zip(paths, sizes.tolist()) if size]
+    counts = np.where(~outside & (next_frames - frames > 1), 2, 1)
+    sources = np.repeat(np.arange(len(shapes)), counts)
+    generated = np.arange(len(sources)) - np.repeat(np.cumsum(counts) - counts, counts) == 1
+    columns = [frames[sources] + generated, sources, outside[sources] | generated,
+        occluded[sources] & ~generated, np.where(generated, 0, z_order[sources]),
+        np.ones(len(sources), dtype=bool)]
+
+    attributes = [attrs for keyframes in path_shapes
+        for attrs in _accumulate_attributes(keyframes)]
+    _split_interpolation(paths, shapes, attributes, sizes, counts, columns)
+
 class _BoxPath:
     def __init__(self, label, start_frame, stop_frame, group_id, boxes=None, client_id=None, attributes=None):
         self.label = label
@@ -280,54 +1002,16 @@ class _BoxPath:
         self.boxes = boxes if boxes else []
         self.client_id = client_id
         self.attributes = attributes if attributes else []
-        self._interpolated_boxes = []
+        self._interpolation = None
         assert not self.boxes or self.boxes[-1].frame <= self.stop_frame
 
     def add_box(self, box):
         self.boxes.append(box)
 
     def get_interpolated_boxes(self):
-        if not self._interpolated_boxes:
-            self._init_interpolated_boxes()
-
-        return self._interpolated_boxes
-
-    def _init_interpolated_boxes(self):
-        assert self.boxes[-1].frame <= self.stop_frame
-
-        boxes = []
-        stop_box = copy.copy(self.boxes[-1])
-        stop_box.frame = self.stop_frame + 1
-        attributes = {}
-        for box0, box1 in zip(self.boxes, self.boxes[1:] + [stop_box]):
-            assert box0.frame < box1.frame
-
-            distance = float(box1.frame - box0.frame)
-            delta_xtl = (box1.xtl - box0.xtl) / distance
-            delta_ytl = (box1.ytl - box0.ytl) / distance
-            delta_xbr = (box1.xbr - box0.xbr) / distance
-            delta_ybr = (box1.ybr - box0.ybr) / distance
-
-            # New box doesn't have all attributes (only first one does).
-            # Thus it is necessary to propagate them.
-            for attr in box0.attributes:
-                attributes[attr.id] = attr
-
-            for frame in range(box0.frame, box1.frame):
-                off = frame - box0.frame
-                xtl = box0.xtl + delta_xtl * off
-                ytl = box0.ytl + delta_ytl * off
-                xbr = box0.xbr + delta_xbr * off
-                ybr = box0.ybr + delta_ybr * off
-
-                box = _InterpolatedBox(xtl, ytl, xbr, ybr, frame, box0.occluded, box0.z_order,
-                    box0.outside, box0.frame == frame, list(attributes.values()))
-                boxes.append(box)
-
-                if box0.outside:
-                    break
-
-        self._interpolated_boxes = boxes
+        # Use _interpolate_box_paths to interpolate a lot of tracks at once
+        _interpolate_box_paths([self])
+        return self._interpolation
 
     def merge(self, path):
         assert self.label.id == path.label.id
@@ -341,7 +1025,7 @@ class _BoxPath:
         self.frame = min(self.frame, path.frame)
         self.stop_frame = max(self.stop_frame, path.stop_frame)
         self.boxes = list(sorted(boxes.values(), key=lambda box: box.frame))
-        self._interpolated_boxes = []
+        self._interpolation = None
 
     def add_attribute(self, attr):
         self.attributes.append(attr)
@@ -355,36 +1039,15 @@ class _PolyPath:
         self.shapes = shapes if shapes else []
         self.client_id = client_id
         self.attributes = attributes if attributes else []
-        self._interpolated_shapes = []   # ???
+        self._interpolation = None
 
     def add_shape(self, shape):
         self.shapes.append(shape)
 
     def get_interpolated_shapes(self):
-        if not self._interpolated_shapes:
-            self._init_interpolated_shapes()
-
-        return self._interpolated_shapes
-
-    def _init_interpolated_shapes(self):
-        assert self.shapes[-1].frame <= self.stop_frame
-        self._interpolated_shapes = []
-        shapes = {shape.frame: shape for shape in self.shapes}
-        outside = False
-        attributes = {}
-        for frame in range(self.frame, self.stop_frame + 1):
-            if frame in shapes:
-                for attr in shapes[frame].attributes:
-                    attributes[attr.id] = attr
-                shape = _InterpolatedPolyShape(shapes[frame].points, frame,
-                    shapes[frame].occluded, shapes[frame].z_order, shapes[frame].outside, True, list(attributes.values()))
-                outside = shape.outside
-                self._interpolated_shapes.append(shape)
-            elif not outside:
-                shape = _InterpolatedPolyShape(self._interpolated_shapes[-1].points, frame, False,
-                    0, True, True, list(attributes.values()))
-                outside = shape.outside
-                self._interpolated_shapes.append(shape)
+        # Use _interpolate_poly_paths to interpolate a lot of tracks at once
+        _interpolate_poly_paths([self])
+        return self._interpolation
 
     def merge(self, path):
         pass
@@ -419,6 +1082,7 @@ class _Annotation:
     # Functions below used by dump functionality
     def to_boxes(self):
         boxes = []
+        _interpolate_box_paths(self.box_paths)
         for path in self.box_paths:
             for box in path.get_interpolated_boxes():
                 if not box.outside:
@@ -437,6 +1101,7 @@ class _Annotation:
 
     def _to_poly_shapes(self, iter_attr_name):
         shapes = []
+        _interpolate_poly_paths(getattr(self, iter_attr_name))
         for path in getattr(self, iter_attr_name):
             for shape in path.get_interpolated_shapes():
                 if not shape.outside:
@@ -515,26 +1180,66 @@ class _Annotation:
     def to_points_paths(self):
         return self._to_poly_paths('points') + self.points_paths
 
-def bulk_create(db_model, objects, flt_param = {}):
+def _split_query_params(values, reserved=0, copies=1):
+    """
+    Split values into chunks which can be passed to one query (copies times,
+    e.g. for each part of a union) together with a number of other
+    (reserved) parameters. Some databases limit the number of parameters of
+    a query, e.g. SQLite allows only 999 by default.
+    """
+    values = list(values)
+    size = connection.features.max_query_params
+    size = (size - reserved) // copies if size else max(len(values), 1)
+    return [values[idx:idx + size] for idx in range(0, len(values), size)]
+
+def bulk_create(db_model, objects, flt_param = {}, key_fields = None):
+    """
+    Create objects by one query. If key_fields is specified, ids of created
+    objects are set. PostgreSQL returns them for the insert query. For
+    other databases created rows are selected by flt_param and values of
+    key_fields, which must identify an object among the selected rows (e.g.
+    client_id for shapes of a job). Thus the cost depends on the number of
+    created objects and not on the number of existing rows.
+    """
     if objects:
-        if flt_param:
+        if key_fields:
             if 'postgresql' in settings.DATABASES["default"]["ENGINE"]:
                 return db_model.objects.bulk_create(objects)
             else:
-                ids = list(db_model.objects.filter(**flt_param).values_list('id', flat=True))
                 db_model.objects.bulk_create(objects)
 
-                return list(db_model.objects.exclude(id__in=ids).filter(**flt_param))
+                # Rows are ordered by id, thus if there are old rows with
+                # the same key, ids of the latest (created) rows are used
+                ids = {}
+                for keys in _split_query_params(set(getattr(obj, key_fields[0])
+                    for obj in objects), len(flt_param)):
+                    ids.update((tuple(key), db_id) for db_id, *key in db_model.objects \
+                        .filter(**flt_param, **{'{}__in'.format(key_fields[0]): keys}) \
+                        .order_by('id').values_list('id', *key_fields))
+                for obj in objects:
+                    obj.id = ids[tuple(getattr(obj, field) for field in key_fields)]
+
+                return objects
         else:
             return db_model.objects.bulk_create(objects)
 
 class _AnnotationForJob(_Annotation):
-    def __init__(self, db_job):
+    # The order of shape types in data which is sent to the client
+    CLIENT_SHAPE_TYPES = ['boxes', 'box_paths', 'polygons', 'polygon_paths',
+        'polylines', 'polyline_paths', 'points', 'points_paths']
+
+    def __init__(self, db_job, frames=None):
         db_segment = db_job.segment
         super().__init__(db_segment.start_frame, db_segment.stop_frame)
 
         # pylint: disable=bad-continuation
         self.db_job = db_job
+        # Shapes are read from the database only for the range of frames
+        # (the first and the last frame), if it is specified
+        self.frames = frames
+        # Saves from the journal (see save_job) which aren't in the tables
+        self.journal = None
+        self.journal_annotations = None
         self.logger = slogger.job[db_job.id]
         self.db_labels = {db_label.id:db_label
             for db_label in db_job.segment.task.label_set.all()}
@@ -542,543 +1247,403 @@ class _AnnotationForJob(_Annotation):
             for db_attr in models.AttributeSpec.objects.filter(
                 label__task__id=db_job.segment.task.id)}
 
-    def _get_client_ids_from_db(self):
-        client_ids = set()
-
-        ids = list(self.db_job.objectpath_set.values_list('client_id', flat=True))
-        client_ids.update(ids)
-
-        for shape_type in ['polygons', 'polylines', 'points', 'boxes']:
-            ids = list(self._get_shape_class(shape_type).objects.filter(
-                job_id=self.db_job.id).values_list('client_id', flat=True))
-            client_ids.update(ids)
+    def _get_client_ids_from_db(self, client_ids):
+        """
+        Return client ids from the set which exist in the job. Only these
+        ids are looked up (by one query over all tables and the
+        (job, client_id) indexes), thus the cost doesn't depend on the size
+        of the job.
+        """
+        querysets = [self.db_job.objectpath_set] + [self._get_shape_set(shape_type)
+            for shape_type in ['polygons', 'polylines', 'points', 'boxes']]
+
+        saved = set()
+        for ids in _split_query_params(client_ids, len(querysets), len(querysets)):
+            chunk = [queryset.filter(client_id__in=ids) \
+                .values_list('client_id', flat=True) for queryset in querysets]
+            saved.update(chunk[0].union(*chunk[1:], all=True))
+
+        client_ids = set(client_ids)
+        for data in self._get_journal():
+            for shape_type in self.CLIENT_SHAPE_TYPES:
+                saved.difference_update(int(client_id) for client_id in data['delete'][shape_type])
+                saved.update(client_ids.intersection(int(obj['id'])
+                    for obj in data['create'][shape_type]))
+
+        return saved
+
+    def _get_journal(self):
+        if self.journal is None:
+            self.journal = [json.loads(data) for data in models.AnnotationJournal.objects \
+                .filter(job_id=self.db_job.id, rejected=False).order_by('id') \
+                .values_list('data', flat=True)]
+
+        return self.journal
+
+    def _get_journal_annotations(self):
+        """
+        Return a list of (deleted client ids, updated, created annotations)
+        for saves from the journal.
+        """
+        if self.journal_annotations is None:
+            self.journal_annotations = []
+            for data in self._get_journal():
+                # A shallow copy shares labels and attributes of the job
+                updated, created = copy.copy(self), copy.copy(self)
+                updated.init_from_client(data['update'])
+                created.init_from_client(data['create'])
+                self.journal_annotations.append((data['delete'], updated, created))
+
+        return self.journal_annotations
+
+    def _is_visible(self, obj):
+        # The same condition as in _iter_shapes_from_db and _iter_paths_from_db
+        if not self.frames:
+            return True
+        if isinstance(obj, (_BoxPath, _PolyPath)):
+            last_shape = (obj.boxes if isinstance(obj, _BoxPath) else obj.shapes)[-1]
+            return obj.frame <= self.frames[1] and \
+                (last_shape.frame >= self.frames[0] or not last_shape.outside)
+
+        return self.frames[0] <= obj.frame <= self.frames[1]
+
+    def _iter_from_db(self, shape_type, labels):
+        """
+        Yield shapes or paths of the type from the database with saves from
+        the journal applied. If the journal is empty, rows are read lazily.
+        """
+        if shape_type.endswith('_paths'):
+            objects = self._iter_paths_from_db(shape_type, labels)
+        else:
+            objects = self._iter_shapes_from_db(shape_type, labels)
 
-        return client_ids
+        journal = self._get_journal_annotations()
+        if not journal:
+            yield from objects
+            return
 
-    def _merge_table_rows(self, rows, keys_for_merge, field_id):
-        """dot.notation access to dictionary attributes"""
-        class dotdict(OrderedDict):
-            __getattr__ = OrderedDict.get
-            __setattr__ = OrderedDict.__setitem__
-            __delattr__ = OrderedDict.__delitem__
-            __eq__ = lambda self, other: self.id == other.id
-            __hash__ = lambda self: self.id
-
-        # It is necessary to keep a stable order of original rows
-        # (e.g. for tracked boxes). Otherwise prev_box.frame can be bigger
-        # than next_box.frame.
-        merged_rows = OrderedDict()
-
-        # Group all rows by field_id. In grouped rows replace fields in
-        # accordance with keys_for_merge structure.
-        for row in rows:
-            row_id = row[field_id]
-            if not row_id in merged_rows:
-                merged_rows[row_id] = dotdict(row)
-                for key in keys_for_merge:
-                    merged_rows[row_id][key] = []
-
-            for key in keys_for_merge:
-                item = dotdict({v.split('__', 1)[-1]:row[v] for v in keys_for_merge[key]})
-                if item.id:
-                    merged_rows[row_id][key].append(item)
-
-        # Remove redundant keys from final objects
-        redundant_keys = [item for values in keys_for_merge.values() for item in values]
-        for i in merged_rows:
-            for j in redundant_keys:
-                del merged_rows[i][j]
-
-        return list(merged_rows.values())
+        objects = OrderedDict((obj.client_id, obj) for obj in objects)
+        for deleted, updated, created in journal:
+            for client_id in deleted[shape_type]:
+                objects.pop(int(client_id), None)
+            for obj in getattr(updated, shape_type) + getattr(created, shape_type):
+                objects[obj.client_id] = obj
+
+        objects = objects.values()
+        if not shape_type.endswith('_paths'):
+            # Updated shapes keep their ids, so the order is the same as
+            # in _iter_shapes_from_db after the compaction
+            objects = sorted(objects, key=lambda shape: shape.frame)
+        for obj in objects:
+            if self._is_visible(obj):
+                yield obj
 
     @staticmethod
-    def _clamp(value, min_value, max_value):
-        return max(min(value, max_value), min_value)
-
-    def _clamp_box(self, xtl, ytl, xbr, ybr, im_size):
-        xtl = self._clamp(xtl, 0, im_size['width'])
-        xbr = self._clamp(xbr, 0, im_size['width'])
-        ytl = self._clamp(ytl, 0, im_size['height'])
-        ybr = self._clamp(ybr, 0, im_size['height'])
-
-        return xtl, ytl, xbr, ybr
+    def _parse_bools(values):
+        # Each distinct value is converted only once
+        values = [str(value) for value in values]
+        bools = {value: bool(strtobool(value)) for value in set(values)}
+
+        return [bools[value] for value in values]
+
+    def _parse_shapes_from_client(self, shapes, image_sizes, geometry):
+        """
+        Convert frames and geometry of shapes from the client into columns
+        (xtl, ytl, xbr, ybr for boxes and points otherwise). Coordinates of all
+        shapes are clamped by sizes of images in one vectorized step.
+        Values are converted by the same functions as for a single shape
+        (int, float, strtobool), thus an invalid value raises the same error
+        as before. If several shapes are invalid, another one can be reported.
+        """
+        frames = [int(shape['frame']) for shape in shapes]
+        if self.db_job.segment.task.mode == 'annotation':
+            sizes = [image_sizes[frame] for frame in frames]
+        else:
+            sizes = [image_sizes[0] for frame in frames]
+        sizes = np.array(sizes, dtype=np.float64).reshape(-1, 2)
+
+        if geometry == 'boxes':
+            coords = np.array([(float(shape['xtl']), float(shape['ytl']),
+                float(shape['xbr']), float(shape['ybr'])) for shape in shapes],
+                dtype=np.float64).reshape(-1, 4)
+            np.minimum(coords[:, 0::2], sizes[:, 0:1], out=coords[:, 0::2])
+            np.minimum(coords[:, 1::2], sizes[:, 1:2], out=coords[:, 1::2])
+            np.maximum(coords, 0, out=coords)
+            geometry = coords.T.tolist()
+        else:
+            values = [_split_points(shape['points']) for shape in shapes]
+            counts = np.array([len(shape_values) // 2 for shape_values in values], dtype=np.int64)
+            points = np.array([value for shape_values in values for value in shape_values],
+                dtype=np.float32).reshape(-1, 2)
+            sizes = np.repeat(sizes, counts, axis=0)
+            np.maximum(points, 0, out=points)
+            np.minimum(points, sizes, out=points)
+            geometry = [np.split(points, np.cumsum(counts)[:-1]) if shapes else []]
+
+        return frames, geometry
+
+    def _parse_attributes(self, attributes, cache, mutable=None):
+        # Attributes with the same value are shared between shapes
+        result = []
+        for attr in attributes:
+            key = (int(attr['id']), str(attr['value']), mutable)
+            if key not in cache:
+                spec = self.db_attributes[key[0]]
+                assert mutable is None or spec.is_mutable() == mutable
+                cache[key] = _Attribute(spec, key[1])
+            result.append(cache[key])
+
+        return result
+
+    def _get_path_shapes_from_client(self, path):
+        shapes = path['shapes']
+        # If the path starts on a previous segment, its last shape there is
+        # moved to the start frame of the segment
+        last_shape_on_prev_segm = None
+        for shape in shapes:
+            frame = int(shape['frame'])
+            if frame < self.start_frame:
+                if last_shape_on_prev_segm is None or int(last_shape_on_prev_segm['frame']) < frame:
+                    last_shape_on_prev_segm = shape
+            elif frame == self.start_frame:
+                last_shape_on_prev_segm = None
+                break
+        if last_shape_on_prev_segm is not None:
+            last_shape_on_prev_segm['frame'] = self.start_frame
+
+        result = []
+        for shape in shapes:
+            frame = int(shape['frame'])
+            if self.start_frame <= frame <= self.stop_frame:
+                result.append(shape)
+            else:
+                self.logger.error("init_from_client: ignore frame #%d " +
+                    "because it out of segment range [%d-%d]", frame, self.start_frame, self.stop_frame)
 
-    def _clamp_poly(self, points, im_size):
-        verified = []
-        points = points.split(' ')
-        for p in points:
-            p = p.split(',')
-            verified.append('{},{}'.format(
-                self._clamp(float(p[0]), 0, im_size['width']),
-                self._clamp(float(p[1]), 0, im_size['height'])
-            ))
+        return result
 
-        return ' '.join(verified)
+    @staticmethod
+    def _group_rows(parents, children):
+        """
+        Group child rows (tuples) by parent rows (tuples). The first item
+        of a parent row is its id and the first item of a child row is the
+        id of its parent. Both sequences must be ordered in the same way,
+        thus all children of a parent are consecutive and one linear pass
+        is enough. Both sequences are consumed lazily. Yield parent rows
+        with the list of children appended as the last item.
+        """
+        children = iter(children)
+        child = next(children, None)
+        for parent in parents:
+            group = []
+            while child is not None and child[0] == parent[0]:
+                group.append(child)
+                child = next(children, None)
+            yield parent + (group,)
+
+        assert child is None
+
+    def _get_geometry_fields(self, shape_type):
+        if shape_type in ['boxes', 'box_paths']:
+            return ['xtl', 'ytl', 'xbr', 'ybr']
+        else:
+            return ['points']
+
+    def _get_shape_attr_fk(self, shape_type):
+        if shape_type in ['polygons', 'polygon_paths']:
+            return 'polygon'
+        elif shape_type in ['polylines', 'polyline_paths']:
+            return 'polyline'
+        elif shape_type in ['boxes', 'box_paths']:
+            return 'box'
+        elif shape_type in ['points', 'points_paths']:
+            return 'points'
+
+    def _get_attributes_from_db(self, shape_type, order_by, flt_param):
+        # Attribute values are fetched by a separate query in the order of
+        # their parents. It allows to avoid a cartesian product of joined
+        # tables (e.g. path attributes x shapes x shape attributes).
+        fk = self._get_shape_attr_fk(shape_type)
+        return self._get_shape_attr_class(shape_type).objects.filter(**flt_param) \
+            .values_list(fk + '_id', 'spec_id', 'value') \
+            .order_by(*['{}__{}'.format(fk, field) for field in order_by], 'id') \
+            .iterator()
+
+    def _init_attributes_from_db(self, db_attrs):
+        return [_Attribute(self.db_attributes[spec_id], value)
+            for _, spec_id, value in db_attrs]
+
+    def _get_labels(self):
+        return {label_id:_Label(db_label) for label_id, db_label in self.db_labels.items()}
+
+    def _iter_shapes_from_db(self, shape_type, labels):
+        """
+        Yield shapes of the type one by one ordered by frame. Rows are read
+        from the database lazily.
+        """
+        fields = self._get_geometry_fields(shape_type)
+        fk = self._get_shape_attr_fk(shape_type)
+        flt_param = {'job_id': self.db_job.id}
+        if self.frames:
+            flt_param['frame__range'] = self.frames
+        db_shapes = self._get_shape_class(shape_type).objects.filter(**flt_param) \
+            .values_list('id', 'frame', 'label_id', 'group_id', 'occluded',
+            'z_order', 'client_id', *fields).order_by('frame', 'id').iterator()
+        db_attrs = self._get_attributes_from_db(shape_type, ['frame', 'id'],
+            {'{}__{}'.format(fk, key): value for key, value in flt_param.items()})
+
+        for db_shape in self._group_rows(db_shapes, db_attrs):
+            _, frame, label_id, group_id, occluded, z_order, client_id, *geometry, db_attrs = db_shape
+            if shape_type == 'boxes':
+                yield _LabeledBox(labels[label_id], *geometry, frame,
+                    group_id, occluded, z_order, client_id,
+                    self._init_attributes_from_db(db_attrs))
+            else:
+                yield _LabeledPolyShape(labels[label_id], _unpack_points(*geometry), frame,
+                    group_id, occluded, z_order, client_id,
+                    self._init_attributes_from_db(db_attrs))
+
+    def _iter_paths_from_db(self, paths_type, labels):
+        """
+        Yield paths of the type one by one ordered by id. Rows are read
+        from the database lazily.
+        """
+        fields = self._get_geometry_fields(paths_type)
+        if paths_type == 'box_paths':
+            path_class, shape_class = _BoxPath, _TrackedBox
+        else:
+            path_class, shape_class = _PolyPath, _TrackedPolyShape
+        db_shape_class = self._get_shape_class(paths_type)
+        db_paths = self.db_job.objectpath_set.filter(
+            shapes=self._get_path_shapes(paths_type))
+        if self.frames:
+            # A track is visible on the range of frames if it starts before
+            # the end of the range and its last shape isn't "outside" or is
+            # inside the range. Whole tracks are returned, because all
+            # keyframes are needed for interpolation.
+            last_shapes = db_shape_class.objects.filter(track_id=OuterRef('id')) \
+                .order_by('-frame')
+            db_paths = db_paths.filter(frame__lte=self.frames[1]).annotate(
+                last_frame=Subquery(last_shapes.values('frame')[:1]),
+                last_outside=Subquery(last_shapes.values('outside')[:1])) \
+                .filter(Q(last_frame__gte=self.frames[0]) | Q(last_outside=False))
+            flt_param = path_flt_param = {'track__in': db_paths.values('id')}
+        else:
+            flt_param = {'track__job_id': self.db_job.id}
+            path_flt_param = dict(flt_param, track__shapes=self._get_path_shapes(paths_type))
+
+        db_paths = db_paths.values_list('id', 'frame', 'label_id', 'group_id',
+            'client_id').order_by('id').iterator()
+        db_path_attrs = models.ObjectPathAttributeVal.objects.filter(**path_flt_param) \
+            .values_list('track_id', 'spec_id', 'value') \
+            .order_by('track_id', 'id').iterator()
+        db_shapes = db_shape_class.objects.filter(**flt_param).values_list('id',
+            'track_id', 'frame', 'occluded', 'z_order', 'outside', *fields) \
+            .order_by('track_id', 'frame').iterator()
+        fk = self._get_shape_attr_fk(paths_type)
+        db_attrs = self._get_attributes_from_db(paths_type, ['track_id', 'frame', 'id'],
+            {'{}__{}'.format(fk, key): value for key, value in flt_param.items()})
+
+        # Attribute values are grouped by shape ids at first. After that
+        # the shape id isn't needed and shapes are grouped by track ids.
+        db_shapes = (db_shape[1:] for db_shape in self._group_rows(db_shapes, db_attrs))
+        db_paths = self._group_rows(self._group_rows(db_paths, db_path_attrs), db_shapes)
+
+        for _, start_frame, label_id, group_id, client_id, db_attrs, db_shapes in db_paths:
+            prev_frame = -1
+            path_shapes = []
+            for _, frame, occluded, z_order, outside, *geometry, db_shape_attrs in db_shapes:
+                assert frame > prev_frame
+                prev_frame = frame
+
+                if paths_type != 'box_paths':
+                    geometry = [_unpack_points(*geometry)]
+                path_shapes.append(shape_class(*geometry, frame, occluded,
+                    z_order, outside, self._init_attributes_from_db(db_shape_attrs)))
+
+            yield path_class(labels[label_id], start_frame, self.stop_frame,
+                group_id, path_shapes, client_id, self._init_attributes_from_db(db_attrs))
 
     def init_from_db(self):
-        def get_values(shape_type):
-            if shape_type == 'polygons':
-                return [
-                    ('id', 'frame', 'points', 'label_id', 'group_id', 'occluded', 'z_order', 'client_id',
-                    'labeledpolygonattributeval__value', 'labeledpolygonattributeval__spec_id',
-                    'labeledpolygonattributeval__id'), {
-                        'attributes': [
-                            'labeledpolygonattributeval__value',
-                            'labeledpolygonattributeval__spec_id',
-                            'labeledpolygonattributeval__id'
-                        ]
-                    }, 'labeledpolygonattributeval_set'
-                ]
-            elif shape_type == 'polylines':
-                return [
-                    ('id', 'frame', 'points', 'label_id', 'group_id', 'occluded', 'z_order', 'client_id',
-                    'labeledpolylineattributeval__value', 'labeledpolylineattributeval__spec_id',
-                    'labeledpolylineattributeval__id'), {
-                        'attributes': [
-                            'labeledpolylineattributeval__value',
-                            'labeledpolylineattributeval__spec_id',
-                            'labeledpolylineattributeval__id'
-                        ]
-                    }, 'labeledpolylineattributeval_set'
-                ]
-            elif shape_type == 'boxes':
-                return [
-                    ('id', 'frame', 'xtl', 'ytl', 'xbr', 'ybr', 'label_id', 'group_id', 'occluded', 'z_order', 'client_id',
-                    'labeledboxattributeval__value', 'labeledboxattributeval__spec_id',
-                    'labeledboxattributeval__id'), {
-                        'attributes': [
-                            'labeledboxattributeval__value',
-                            'labeledboxattributeval__spec_id',
-                            'labeledboxattributeval__id'
-                        ]
-                    }, 'labeledboxattributeval_set'
-                ]
-            elif shape_type == 'points':
-                return [
-                    ('id', 'frame', 'points', 'label_id', 'group_id', 'occluded', 'z_order', 'client_id',
-                    'labeledpointsattributeval__value', 'labeledpointsattributeval__spec_id',
-                    'labeledpointsattributeval__id'), {
-                        'attributes': [
-                            'labeledpointsattributeval__value',
-                            'labeledpointsattributeval__spec_id',
-                            'labeledpointsattributeval__id'
-                        ]
-                    }, 'labeledpointsattributeval_set'
-                ]
-
         self.reset()
-        for shape_type in ['boxes', 'points', 'polygons', 'polylines']:
-            (values, merge_keys, prefetch) = get_values(shape_type)
-            db_shapes = list(self._get_shape_set(shape_type).prefetch_related(prefetch).
-                values(*values).order_by('frame'))
-            db_shapes = self._merge_table_rows(db_shapes, merge_keys, 'id')
-            for db_shape in db_shapes:
-                label = _Label(self.db_labels[db_shape.label_id])
-                if shape_type == 'boxes':
-                    shape = _LabeledBox(label=label,
-                        x0=db_shape.xtl, y0=db_shape.ytl, x1=db_shape.xbr, y1=db_shape.ybr,
-                        frame=db_shape.frame,
-                        group_id=db_shape.group_id,
-                        occluded=db_shape.occluded,
-                        z_order=db_shape.z_order,
-                        client_id=db_shape.client_id,
-                    )
-                else:
-                    shape = _LabeledPolyShape(
-                        label=label,
-                        points=db_shape.points,
-                        frame=db_shape.frame,
-                        group_id=db_shape.group_id,
-                        occluded=db_shape.occluded,
-                        z_order=db_shape.z_order,
-                        client_id=db_shape.client_id,
-                    )
-                for db_attr in db_shape.attributes:
-                    if db_attr.id != None:
-                        spec = self.db_attributes[db_attr.spec_id]
-                        attr = _Attribute(spec, db_attr.value)
-                        shape.add_attribute(attr)
-                getattr(self, shape_type).append(shape)
-
-        db_paths = self.db_job.objectpath_set
-        for shape in ['trackedpoints_set', 'trackedbox_set', 'trackedpolyline_set', 'trackedpolygon_set']:
-            db_paths.prefetch_related(shape)
-        for shape_attr in ['trackedpoints_set__trackedpointsattributeval_set', 'trackedbox_set__trackedboxattributeval_set',
-            'trackedpolygon_set__trackedpolygonattributeval_set', 'trackedpolyline_set__trackedpolylineattributeval_set']:
-            db_paths.prefetch_related(shape_attr)
-        db_paths.prefetch_related('objectpathattributeval_set')
-        db_paths = list (db_paths.values('id', 'frame', 'group_id', 'shapes', 'client_id', 'objectpathattributeval__spec_id',
-            'objectpathattributeval__id', 'objectpathattributeval__value',
-            'trackedbox', 'trackedpolygon', 'trackedpolyline', 'trackedpoints',
-            'trackedbox__id', 'label_id', 'trackedbox__xtl', 'trackedbox__ytl',
-            'trackedbox__xbr', 'trackedbox__ybr', 'trackedbox__frame', 'trackedbox__occluded',
-            'trackedbox__z_order','trackedbox__outside', 'trackedbox__trackedboxattributeval__spec_id',
-            'trackedbox__trackedboxattributeval__value', 'trackedbox__trackedboxattributeval__id',
-            'trackedpolygon__id' ,'trackedpolygon__points', 'trackedpolygon__frame', 'trackedpolygon__occluded',
-            'trackedpolygon__z_order', 'trackedpolygon__outside', 'trackedpolygon__trackedpolygonattributeval__spec_id',
-            'trackedpolygon__trackedpolygonattributeval__value', 'trackedpolygon__trackedpolygonattributeval__id',
-            'trackedpolyline__id', 'trackedpolyline__points', 'trackedpolyline__frame', 'trackedpolyline__occluded',
-            'trackedpolyline__z_order', 'trackedpolyline__outside', 'trackedpolyline__trackedpolylineattributeval__spec_id',
-            'trackedpolyline__trackedpolylineattributeval__value', 'trackedpolyline__trackedpolylineattributeval__id',
-            'trackedpoints__id', 'trackedpoints__points', 'trackedpoints__frame', 'trackedpoints__occluded',
-            'trackedpoints__z_order', 'trackedpoints__outside', 'trackedpoints__trackedpointsattributeval__spec_id',
-            'trackedpoints__trackedpointsattributeval__value', 'trackedpoints__trackedpointsattributeval__id')
-            .order_by('id', 'trackedbox__frame', 'trackedpolygon__frame', 'trackedpolyline__frame', 'trackedpoints__frame'))
-
-        db_box_paths = list(filter(lambda path: path['shapes'] == 'boxes', db_paths ))
-        db_polygon_paths = list(filter(lambda path: path['shapes'] == 'polygons', db_paths ))
-        db_polyline_paths = list(filter(lambda path: path['shapes'] == 'polylines', db_paths ))
-        db_points_paths = list(filter(lambda path: path['shapes'] == 'points', db_paths ))
-
-        object_path_attr_merge_key = [
-            'objectpathattributeval__value',
-            'objectpathattributeval__spec_id',
-            'objectpathattributeval__id'
-        ]
+        labels = self._get_labels()
 
-        db_box_paths = self._merge_table_rows(db_box_paths, {
-            'attributes': object_path_attr_merge_key,
-            'shapes': [
-                'trackedbox__id', 'trackedbox__xtl', 'trackedbox__ytl',
-                'trackedbox__xbr', 'trackedbox__ybr', 'trackedbox__frame',
-                'trackedbox__occluded', 'trackedbox__z_order', 'trackedbox__outside',
-                'trackedbox__trackedboxattributeval__value',
-                'trackedbox__trackedboxattributeval__spec_id',
-                'trackedbox__trackedboxattributeval__id'
-            ],
-        }, 'id')
-
-        db_polygon_paths = self._merge_table_rows(db_polygon_paths, {
-            'attributes': object_path_attr_merge_key,
-            'shapes': [
-                'trackedpolygon__id', 'trackedpolygon__points', 'trackedpolygon__frame',
-                'trackedpolygon__occluded', 'trackedpolygon__z_order', 'trackedpolygon__outside',
-                'trackedpolygon__trackedpolygonattributeval__value',
-                'trackedpolygon__trackedpolygonattributeval__spec_id',
-                'trackedpolygon__trackedpolygonattributeval__id'
-            ]
-        }, 'id')
-
-        db_polyline_paths = self._merge_table_rows(db_polyline_paths, {
-            'attributes': object_path_attr_merge_key,
-            'shapes': [
-                'trackedpolyline__id', 'trackedpolyline__points', 'trackedpolyline__frame',
-                'trackedpolyline__occluded', 'trackedpolyline__z_order', 'trackedpolyline__outside',
-                'trackedpolyline__trackedpolylineattributeval__value',
-                'trackedpolyline__trackedpolylineattributeval__spec_id',
-                'trackedpolyline__trackedpolylineattributeval__id'
-            ],
-        }, 'id')
-
-        db_points_paths = self._merge_table_rows(db_points_paths, {
-            'attributes': object_path_attr_merge_key,
-            'shapes': [
-                'trackedpoints__id', 'trackedpoints__points', 'trackedpoints__frame',
-                'trackedpoints__occluded', 'trackedpoints__z_order', 'trackedpoints__outside',
-                'trackedpoints__trackedpointsattributeval__value',
-                'trackedpoints__trackedpointsattributeval__spec_id',
-                'trackedpoints__trackedpointsattributeval__id'
-            ]
-        }, 'id')
-
-        for db_box_path in db_box_paths:
-            db_box_path.attributes = list(set(db_box_path.attributes))
-            db_box_path.shapes = self._merge_table_rows(db_box_path.shapes, {
-                'attributes': [
-                    'trackedboxattributeval__value',
-                    'trackedboxattributeval__spec_id',
-                    'trackedboxattributeval__id'
-                ]
-            }, 'id')
-
-        for db_polygon_path in db_polygon_paths:
-            db_polygon_path.attributes = list(set(db_polygon_path.attributes))
-            db_polygon_path.shapes = self._merge_table_rows(db_polygon_path.shapes, {
-                'attributes': [
-                    'trackedpolygonattributeval__value',
-                    'trackedpolygonattributeval__spec_id',
-                    'trackedpolygonattributeval__id'
-                ]
-            }, 'id')
-
-        for db_polyline_path in db_polyline_paths:
-            db_polyline_path.attributes = list(set(db_polyline_path.attributes))
-            db_polyline_path.shapes = self._merge_table_rows(db_polyline_path.shapes, {
-                'attributes': [
-                    'trackedpolylineattributeval__value',
-                    'trackedpolylineattributeval__spec_id',
-                    'trackedpolylineattributeval__id'
-                ]
-            }, 'id')
-
-        for db_points_path in db_points_paths:
-            db_points_path.attributes = list(set(db_points_path.attributes))
-            db_points_path.shapes = self._merge_table_rows(db_points_path.shapes, {
-                'attributes': [
-                    'trackedpointsattributeval__value',
-                    'trackedpointsattributeval__spec_id',
-                    'trackedpointsattributeval__id'
-                ]
-            }, 'id')
-
-        for db_path in db_box_paths:
-            for db_shape in db_path.shapes:
-                db_shape.attributes = list(set(db_shape.attributes))
-            label = _Label(self.db_labels[db_path.label_id])
-            path = _BoxPath(
-                label=label,
-                start_frame=db_path.frame,
-                stop_frame=self.stop_frame,
-                group_id=db_path.group_id,
-                client_id=db_path.client_id,
-            )
-            for db_attr in db_path.attributes:
-                spec = self.db_attributes[db_attr.spec_id]
-                attr = _Attribute(spec, db_attr.value)
-                path.add_attribute(attr)
-
-            frame = -1
-            for db_shape in db_path.shapes:
-                box = _TrackedBox(
-                    x0=db_shape.xtl, y0=db_shape.ytl, x1=db_shape.xbr, y1=db_shape.ybr,
-                    frame=db_shape.frame,
-                    occluded=db_shape.occluded,
-                    z_order=db_shape.z_order,
-                    outside=db_shape.outside,
-                )
-                assert box.frame > frame
-                frame = box.frame
-
-                for db_attr in db_shape.attributes:
-                    spec = self.db_attributes[db_attr.spec_id]
-                    attr = _Attribute(spec, db_attr.value)
-                    box.add_attribute(attr)
-                path.add_box(box)
-
-            self.box_paths.append(path)
-
-        for idx, paths_type in enumerate(['polygon_paths', 'polyline_paths', 'points_paths']):
-            source = [db_polygon_paths, db_polyline_paths, db_points_paths][idx]
-
-            for db_path in source:
-                for db_shape in db_path.shapes:
-                    db_shape.attributes = list(set(db_shape.attributes))
-                label = _Label(self.db_labels[db_path.label_id])
-                path = _PolyPath(
-                    label=label,
-                    start_frame=db_path.frame,
-                    stop_frame= self.stop_frame,
-                    group_id=db_path.group_id,
-                    client_id=db_path.client_id,
-                )
-                for db_attr in db_path.attributes:
-                    spec = self.db_attributes[db_attr.spec_id]
-                    attr = _Attribute(spec, db_attr.value)
-                    path.add_attribute(attr)
-
-                frame = -1
-                for db_shape in db_path.shapes:
-                    shape = _TrackedPolyShape(
-                        points=db_shape.points,
-                        frame=db_shape.frame,
-                        occluded=db_shape.occluded,
-                        z_order=db_shape.z_order,
-                        outside=db_shape.outside,
-                    )
-                    assert shape.frame > frame
-                    frame = shape.frame
-
-                    for db_attr in db_shape.attributes:
-                        spec = self.db_attributes[db_attr.spec_id]
-                        attr = _Attribute(spec, db_attr.value)
-                        shape.add_attribute(attr)
-                    path.add_shape(shape)
-
-                getattr(self, paths_type).append(path)
+        for shape_type in ['boxes', 'points', 'polygons', 'polylines']:
+            getattr(self, shape_type).extend(self._iter_from_db(shape_type, labels))
 
+        for paths_type in ['box_paths', 'polygon_paths', 'polyline_paths', 'points_paths']:
+            getattr(self, paths_type).extend(self._iter_from_db(paths_type, labels))
 
     def init_from_client(self, data):
         # All fields inside data should be converted to correct type explicitly.
         # We cannot trust that client will send 23 as integer. Here we also
-        # accept "23".
+        # accept "23". Shapes of each type are converted as columns.
         db_task = self.db_job.segment.task
-        image_meta = get_image_meta_cache(db_task)
+        image_sizes = [(size['width'], size['height'])
+            for size in get_image_meta_cache(db_task)['original_size']]
+        labels = {}
+        attributes = {}
         self.reset()
 
-        for box in data['boxes']:
-            label = _Label(self.db_labels[int(box['label_id'])])
-
-            frame_idx = int(box['frame']) if db_task.mode == 'annotation' else 0
-            xtl, ytl, xbr, ybr = self._clamp_box(float(box['xtl']), float(box['ytl']),
-                float(box['xbr']), float(box['ybr']),
-                image_meta['original_size'][frame_idx])
-
-            labeled_box = _LabeledBox(
-                label=label,
-                x0=xtl, y0=ytl, x1=xbr, y1=ybr,
-                frame=int(box['frame']),
-                group_id=int(box['group_id']),
-                occluded=strtobool(str(box['occluded'])),
-                z_order=int(box['z_order']),
-                client_id=int(box['id']),
-            )
-
-            for attr in box['attributes']:
-                spec = self.db_attributes[int(attr['id'])]
-                attr = _Attribute(spec, str(attr['value']))
-                labeled_box.add_attribute(attr)
-
-            self.boxes.append(labeled_box)
-
-        for poly_shape_type in ['points', 'polygons', 'polylines']:
-            for poly_shape in data[poly_shape_type]:
-                label = _Label(self.db_labels[int(poly_shape['label_id'])])
-
-                frame_idx = int(poly_shape['frame']) if db_task.mode == 'annotation' else 0
-                points = self._clamp_poly(poly_shape['points'], image_meta['original_size'][frame_idx])
-                labeled_poly_shape = _LabeledPolyShape(
-                    label=label,
-                    points=points,
-                    frame=int(poly_shape['frame']),
-                    group_id=int(poly_shape['group_id']),
-                    occluded=poly_shape['occluded'],
-                    z_order=int(poly_shape['z_order']),
-                    client_id=int(poly_shape['id']),
-                )
-
-                for attr in poly_shape['attributes']:
-                    spec = self.db_attributes[int(attr['id'])]
-                    attr = _Attribute(spec, str(attr['value']))
-                    labeled_poly_shape.add_attribute(attr)
-
-                getattr(self, poly_shape_type).append(labeled_poly_shape)
-
-        for path in data['box_paths']:
-            label = _Label(self.db_labels[int(path['label_id'])])
-            boxes = []
-            frame = -1
-
-            has_boxes_on_prev_segm = False
-            last_box_on_prev_segm = None
-            has_box_on_start_frame = False
-            for box in path['shapes']:
-                if int(box['frame']) < self.start_frame:
-                    has_boxes_on_prev_segm = True
-                    if last_box_on_prev_segm is None or int(last_box_on_prev_segm["frame"]) < int(box["frame"]):
-                        last_box_on_prev_segm = box
-                elif int(box['frame']) == self.start_frame:
-                    has_box_on_start_frame = True
-                    break
-            if has_boxes_on_prev_segm and not has_box_on_start_frame:
-                last_box_on_prev_segm["frame"] = self.start_frame
-
-            for box in path['shapes']:
-                if int(box['frame']) <= self.stop_frame and int(box['frame']) >= self.start_frame:
-                    frame_idx = int(box['frame']) if db_task.mode == 'annotation' else 0
-                    xtl, ytl, xbr, ybr = self._clamp_box(float(box['xtl']), float(box['ytl']),
-                        float(box['xbr']), float(box['ybr']), image_meta['original_size'][frame_idx])
-                    tracked_box = _TrackedBox(
-                        x0=xtl, y0=ytl, x1=xbr, y1=ybr,
-                        frame=int(box['frame']),
-                        occluded=strtobool(str(box['occluded'])),
-                        z_order=int(box['z_order']),
-                        outside=strtobool(str(box['outside'])),
-                    )
-                    assert tracked_box.frame >  frame
-                    frame = tracked_box.frame
-
-                    for attr in box['attributes']:
-                        spec = self.db_attributes[int(attr['id'])]
-                        assert spec.is_mutable()
-                        attr = _Attribute(spec, str(attr['value']))
-                        tracked_box.add_attribute(attr)
-
-                    boxes.append(tracked_box)
-                else:
-                    self.logger.error("init_from_client: ignore frame #%d " +
-                        "because it out of segment range [%d-%d]", int(box['frame']), self.start_frame, self.stop_frame)
-
-            attributes = []
-            for attr in path['attributes']:
-                spec = self.db_attributes[int(attr['id'])]
-                assert not spec.is_mutable()
-                attr = _Attribute(spec, str(attr['value']))
-                attributes.append(attr)
-
-            assert frame <= self.stop_frame
-            box_path = _BoxPath(label=label,
-                start_frame=min(list(map(lambda box: box.frame, boxes))),
-                stop_frame=self.stop_frame,
-                group_id=int(path['group_id']),
-                boxes=boxes,
-                client_id=int(path['id']),
-                attributes=attributes,
-            )
-            self.box_paths.append(box_path)
-
-        for poly_path_type in ['points_paths', 'polygon_paths', 'polyline_paths']:
-            for path in data[poly_path_type]:
-                label = _Label(self.db_labels[int(path['label_id'])])
-                poly_shapes = []
-                frame = -1
+        def get_label(label_id):
+            db_label = self.db_labels[int(label_id)]
+            if db_label.id not in labels:
+                labels[db_label.id] = _Label(db_label)
+            return labels[db_label.id]
 
-                has_shapes_on_prev_segm = False
-                last_shape_on_prev_segm = None
-                has_shape_on_start_frame = False
-                for poly_shape in path['shapes']:
-                    if int(poly_shape['frame']) < self.start_frame:
-                        has_shapes_on_prev_segm = True
-                        if last_shape_on_prev_segm is None or int(last_shape_on_prev_segm["frame"]) < (poly_shape["frame"]):
-                            last_shape_on_prev_segm = box
-                    elif int(poly_shape['frame']) == self.start_frame:
-                        has_shape_on_start_frame = True
-                        break
-                if has_shapes_on_prev_segm and not has_shape_on_start_frame:
-                    last_shape_on_prev_segm["frame"] = self.start_frame
-
-                for poly_shape in path['shapes']:
-                    if int(poly_shape['frame']) <= self.stop_frame and int(poly_shape['frame']) >= self.start_frame:
-                        frame_idx = int(poly_shape['frame']) if db_task.mode == 'annotation' else 0
-                        points = self._clamp_poly(poly_shape['points'], image_meta['original_size'][frame_idx])
-                        tracked_poly_shape = _TrackedPolyShape(
-                            points=points,
-                            frame=int(poly_shape['frame']),
-                            occluded=strtobool(str(poly_shape['occluded'])),
-                            z_order=int(poly_shape['z_order']),
-                            outside=strtobool(str(poly_shape['outside'])),
-                        )
-                        assert tracked_poly_shape.frame >  frame
-                        frame = tracked_poly_shape.frame
-
-                        for attr in poly_shape['attributes']:
-                            spec = self.db_attributes[int(attr['id'])]
-                            assert spec.is_mutable()
-                            attr = _Attribute(spec, str(attr['value']))
-                            tracked_poly_shape.add_attribute(attr)
-
-                        poly_shapes.append(tracked_poly_shape)
-                    else:
-                        self.logger.error("init_from_client: ignore frame #%d " +
-                            "because it out of segment range [%d-%d]", int(poly_shape['frame']), self.start_frame, self.stop_frame)
-
-                attributes = []
-                for attr in path['attributes']:
-                    spec = self.db_attributes[int(attr['id'])]
-                    assert not spec.is_mutable()
-                    attr = _Attribute(spec, str(attr['value']))
-                    attributes.append(attr)
-
-                poly_path = _PolyPath(
-                    label=label,
-                    start_frame=min(list(map(lambda shape: shape.frame, poly_shapes))),
-                    stop_frame=self.stop_frame + 1,
-                    group_id=int(path['group_id']),
-                    shapes=poly_shapes,
-                    client_id=int(path['id']),
-                    attributes=attributes,
-                )
-
-                getattr(self, poly_path_type).append(poly_path)
+        for shape_type in ['boxes', 'points', 'polygons', 'polylines']:
+            shapes = data[shape_type]
+            frames, geometry = self._parse_shapes_from_client(shapes, image_sizes, shape_type)
+            shape_class = _LabeledBox if shape_type == 'boxes' else _LabeledPolyShape
+            # The occluded property of poly shapes is kept as it is (the model
+            # field converts it)
+            occluded = [shape['occluded'] for shape in shapes]
+            if shape_type == 'boxes':
+                occluded = self._parse_bools(occluded)
+            setattr(self, shape_type, [shape_class(*fields) for fields in zip(
+                [get_label(shape['label_id']) for shape in shapes],
+                *geometry,
+                frames,
+                [int(shape['group_id']) for shape in shapes],
+                occluded,
+                [int(shape['z_order']) for shape in shapes],
+                [int(shape['id']) for shape in shapes],
+                [self._parse_attributes(shape['attributes'], attributes) for shape in shapes],
+            )])
+
+        for paths_type in ['box_paths', 'points_paths', 'polygon_paths', 'polyline_paths']:
+            paths = data[paths_type]
+            path_shapes = [self._get_path_shapes_from_client(path) for path in paths]
+            shapes = [shape for shapes in path_shapes for shape in shapes]
+            frames, geometry = self._parse_shapes_from_client(shapes, image_sizes,
+                'boxes' if paths_type == 'box_paths' else 'poly_shapes')
+            shape_class = _TrackedBox if paths_type == 'box_paths' else _TrackedPolyShape
+            tracked_shapes = [shape_class(*fields) for fields in zip(
+                *geometry,
+                frames,
+                self._parse_bools(shape['occluded'] for shape in shapes),
+                [int(shape['z_order']) for shape in shapes],
+                self._parse_bools(shape['outside'] for shape in shapes),
+                [self._parse_attributes(shape['attributes'], attributes, True) for shape in shapes],
+            )]
+
+            path_class = _BoxPath if paths_type == 'box_paths' else _PolyPath
+            stop_frame = self.stop_frame if paths_type == 'box_paths' else self.stop_frame + 1
+            offset = 0
+            for path, shapes in zip(paths, path_shapes):
+                shapes = tracked_shapes[offset:offset + len(shapes)]
+                offset += len(shapes)
+                assert all(shape0.frame < shape1.frame for shape0, shape1 in zip(shapes, shapes[1:]))
+
+                getattr(self, paths_type).append(path_class(
+                    get_label(path['label_id']),
+                    min(list(map(lambda shape: shape.frame, shapes))),
+                    stop_frame,
+                    int(path['group_id']),
+                    shapes,
+                    int(path['id']),
+                    self._parse_attributes(path['attributes'], attributes, False),
+                ))
 
         return self.has_data()
 
@@ -1100,6 +1665,16 @@ class _AnnotationForJob(_Annotation):
         elif shape_type == 'points_paths':
             return models.TrackedPoints
 
+    def _get_path_shapes(self, shape_type):
+        if shape_type == 'polygon_paths':
+            return 'polygons'
+        elif shape_type == 'polyline_paths':
+            return 'polylines'
+        elif shape_type == 'box_paths':
+            return 'boxes'
+        elif shape_type == 'points_paths':
+            return 'points'
+
     def _get_shape_attr_class(self, shape_type):
         if shape_type == 'polygons':
             return models.LabeledPolygonAttributeVal
@@ -1122,8 +1697,7 @@ class _AnnotationForJob(_Annotation):
         for shape_type in ['polygon_paths', 'polyline_paths', 'points_paths', 'box_paths']:
             db_paths = []
             db_path_attrvals = []
-            db_shapes = []
-            db_shape_attrvals = []
+            path_shapes = []
 
             shapes = getattr(self, shape_type)
             for path in shapes:
@@ -1133,14 +1707,7 @@ class _AnnotationForJob(_Annotation):
                 db_path.frame = path.frame
                 db_path.group_id = path.group_id
                 db_path.client_id = path.client_id
-                if shape_type == 'polygon_paths':
-                    db_path.shapes = 'polygons'
-                elif shape_type == 'polyline_paths':
-                    db_path.shapes = 'polylines'
-                elif shape_type == 'box_paths':
-                    db_path.shapes = 'boxes'
-                elif shape_type == 'points_paths':
-                    db_path.shapes = 'points'
+                db_path.shapes = self._get_path_shapes(shape_type)
 
                 for attr in path.attributes:
                     db_attrspec = self.db_attributes[attr.id]
@@ -1150,64 +1717,73 @@ class _AnnotationForJob(_Annotation):
                     db_attrval.value = attr.value
                     db_path_attrvals.append(db_attrval)
 
-                path_shapes = path.boxes if hasattr(path, 'boxes') else path.shapes
-                for shape in path_shapes:
-                    db_shape = self._get_shape_class(shape_type)()
-                    db_shape.track_id = len(db_paths)
-                    if shape_type == 'box_paths':
-                        db_shape.xtl = shape.xtl
-                        db_shape.ytl = shape.ytl
-                        db_shape.xbr = shape.xbr
-                        db_shape.ybr = shape.ybr
-                    else:
-                        db_shape.points = shape.points
-                    db_shape.frame = shape.frame
-                    db_shape.occluded = shape.occluded
-                    db_shape.z_order = shape.z_order
-                    db_shape.outside = shape.outside
-
-                    for attr in shape.attributes:
-                        db_attrspec = self.db_attributes[attr.id]
-                        db_attrval = self._get_shape_attr_class(shape_type)()
-                        if shape_type == 'polygon_paths':
-                            db_attrval.polygon_id = len(db_shapes)
-                        elif shape_type == 'polyline_paths':
-                            db_attrval.polyline_id = len(db_shapes)
-                        elif shape_type == 'box_paths':
-                            db_attrval.box_id = len(db_shapes)
-                        elif shape_type == 'points_paths':
-                            db_attrval.points_id = len(db_shapes)
-                        db_attrval.spec = db_attrspec
-                        db_attrval.value = attr.value
-                        db_shape_attrvals.append(db_attrval)
-
-                    db_shapes.append(db_shape)
+                path_shapes.extend((len(db_paths), shape) for shape in
+                    (path.boxes if hasattr(path, 'boxes') else path.shapes))
                 db_paths.append(db_path)
 
             db_paths = bulk_create(models.ObjectPath, db_paths,
-                {"job_id": self.db_job.id})
+                {"job_id": self.db_job.id}, ['client_id'])
 
             for db_attrval in db_path_attrvals:
                 db_attrval.track_id = db_paths[db_attrval.track_id].id
             bulk_create(models.ObjectPathAttributeVal, db_path_attrvals)
 
-            for db_shape in db_shapes:
-                db_shape.track_id = db_paths[db_shape.track_id].id
-
-            db_shapes = bulk_create(self._get_shape_class(shape_type), db_shapes,
-                {"track__job_id": self.db_job.id})
-
-            for db_attrval in db_shape_attrvals:
+            self._save_path_shapes_to_db(shape_type,
+                [(db_paths[idx].id, shape) for idx, shape in path_shapes])
+
+    def _save_path_shapes_to_db(self, shape_type, path_shapes):
+        """
+        Save shapes of paths. path_shapes is a list of pairs: an id of
+        the path in the database and a shape.
+        """
+        db_shapes = []
+        db_shape_attrvals = []
+        for track_id, shape in path_shapes:
+            db_shape = self._get_shape_class(shape_type)()
+            db_shape.track_id = track_id
+            if shape_type == 'box_paths':
+                db_shape.xtl = shape.xtl
+                db_shape.ytl = shape.ytl
+                db_shape.xbr = shape.xbr
+                db_shape.ybr = shape.ybr
+            else:
+                db_shape.points = _pack_points(shape.points)
+            db_shape.frame = shape.frame
+            db_shape.occluded = shape.occluded
+            db_shape.z_order = shape.z_order
+            db_shape.outside = shape.outside
+
+            for attr in shape.attributes:
+                db_attrspec = self.db_attributes[attr.id]
+                db_attrval = self._get_shape_attr_class(shape_type)()
                 if shape_type == 'polygon_paths':
-                    db_attrval.polygon_id = db_shapes[db_attrval.polygon_id].id
+                    db_attrval.polygon_id = len(db_shapes)
                 elif shape_type == 'polyline_paths':
-                    db_attrval.polyline_id = db_shapes[db_attrval.polyline_id].id
+                    db_attrval.polyline_id = len(db_shapes)
                 elif shape_type == 'box_paths':
-                    db_attrval.box_id = db_shapes[db_attrval.box_id].id
+                    db_attrval.box_id = len(db_shapes)
                 elif shape_type == 'points_paths':
-                    db_attrval.points_id = db_shapes[db_attrval.points_id].id
+                    db_attrval.points_id = len(db_shapes)
+                db_attrval.spec = db_attrspec
+                db_attrval.value = attr.value
+                db_shape_attrvals.append(db_attrval)
+
+            db_shapes.append(db_shape)
+
+        db_shapes = bulk_create(self._get_shape_class(shape_type), db_shapes,
+            {}, ['track_id', 'frame'])
 
-            bulk_create(self._get_shape_attr_class(shape_type), db_shape_attrvals)
+        for db_attrval in db_shape_attrvals:
+            if shape_type == 'polygon_paths':
+                db_attrval.polygon_id = db_shapes[db_attrval.polygon_id].id
+            elif shape_type == 'polyline_paths':
+                db_attrval.polyline_id = db_shapes[db_attrval.polyline_id].id
+            elif shape_type == 'box_paths':
+                db_attrval.box_id = db_shapes[db_attrval.box_id].id
+            elif shape_type == 'points_paths':
+                db_attrval.points_id = db_shapes[db_attrval.points_id].id
+
+        bulk_create(self._get_shape_attr_class(shape_type), db_shape_attrvals)
 
     def _get_shape_set(self, shape_type):
         if shape_type == 'polygons':
@@ -1237,7 +1813,7 @@ class _AnnotationForJob(_Annotation):
                     db_shape.xbr = shape.xbr
                     db_shape.ybr = shape.ybr
                 else:
-                    db_shape.points = shape.points
+                    db_shape.points = _pack_points(shape.points)
                 db_shape.frame = shape.frame
                 db_shape.occluded = shape.occluded
                 db_shape.z_order = shape.z_order
@@ -1260,7 +1836,7 @@ class _AnnotationForJob(_Annotation):
                 db_shapes.append(db_shape)
 
             db_shapes = bulk_create(self._get_shape_class(shape_type), db_shapes,
-                {"job_id": self.db_job.id})
+                {"job_id": self.db_job.id}, ['client_id'])
 
             for db_attrval in db_attrvals:
                 if shape_type == 'polygons':
@@ -1274,19 +1850,175 @@ class _AnnotationForJob(_Annotation):
 
             bulk_create(self._get_shape_attr_class(shape_type), db_attrvals)
 
+    # Updated shapes and paths are compared with rows in the database and
+    # only changed rows are written. Rows are matched by client_id, shapes
+    # of a path by frame and attribute values by attribute specification.
+    def _get_geometry_values(self, shape_type, shape):
+        if shape_type in ['boxes', 'box_paths']:
+            return [shape.xtl, shape.ytl, shape.xbr, shape.ybr]
+        else:
+            return [_pack_points(shape.points)]
+
+    @staticmethod
+    def _get_changed_fields(fields, db_values, values):
+        changed = {}
+        for field, db_value, value in zip(fields, db_values, values):
+            if isinstance(db_value, memoryview):
+                db_value = bytes(db_value)
+            if db_value != value:
+                changed[field] = value
+        return changed
+
+    @staticmethod
+    def _update_rows_in_db(db_model, changes):
+        """
+        changes is a list of ids of rows in the database and dictionaries
+        of their changed fields. Rows with the same set of changed fields
+        are updated together by one query for a chunk of rows:
+        UPDATE ... SET field = CASE WHEN id = ... THEN ... END WHERE id IN (...)
+        """
+        rows_by_fields = OrderedDict()
+        for db_id, changed in changes:
+            if changed:
+                rows_by_fields.setdefault(tuple(sorted(changed)), []).append((db_id, changed))
+
+        for fields, rows in rows_by_fields.items():
+            # Each row has its id in WHEN of each field and in IN
+            for chunk in _split_query_params(rows, copies=2 * len(fields) + 1):
+                update = {}
+                for field in fields:
+                    output_field = db_model._meta.get_field(field)
+                    update[field] = Case(*[When(id=db_id, then=Value(changed[field],
+                        output_field=output_field)) for db_id, changed in chunk],
+                        output_field=output_field)
+                db_model.objects.filter(id__in=[db_id for db_id, _ in chunk]) \
+                    .update(**update)
+
+    @staticmethod
+    def _delete_rows_from_db(db_model, ids):
+        for chunk in _split_query_params(ids):
+            db_model.objects.filter(id__in=chunk).delete()
+
+    def _update_attributes_in_db(self, db_model, fk, flt_param, client_id_param,
+        client_ids, attributes):
+        """
+        attributes is a dictionary: an id of the parent row in the database
+        and the list of its new attributes. Stored attribute values of
+        these rows (flt_param and client_ids select them) are updated,
+        created or deleted.
+        """
+        db_attrs = {}
+        deleted = []
+        for chunk in _split_query_params(client_ids, len(flt_param)):
+            for db_id, parent_id, spec_id, value in db_model.objects \
+                .filter(**flt_param, **{client_id_param: chunk}) \
+                .values_list('id', '{}_id'.format(fk), 'spec_id', 'value'):
+                if (parent_id, spec_id) in db_attrs:
+                    deleted.append(db_id)
+                else:
+                    db_attrs[(parent_id, spec_id)] = (db_id, value)
+
+        created = []
+        changes = []
+        for parent_id, parent_attrs in attributes.items():
+            for attr in parent_attrs:
+                db_attr = db_attrs.pop((parent_id, attr.id), None)
+                if db_attr is None:
+                    created.append(db_model(spec_id=attr.id, value=attr.value,
+                        **{'{}_id'.format(fk): parent_id}))
+                elif db_attr[1] != attr.value:
+                    changes.append((db_attr[0], {'value': attr.value}))
+        deleted.extend(db_id for db_id, _ in db_attrs.values())
+
+        self._delete_rows_from_db(db_model, deleted)
+        self._update_rows_in_db(db_model, changes)
+        bulk_create(db_model, created)
+
     def _update_shapes_in_db(self):
-        client_ids_to_delete = {}
         for shape_type in ['polygons', 'polylines', 'points', 'boxes']:
-            client_ids_to_delete[shape_type] = list(shape.client_id for shape in getattr(self, shape_type))
-        self._delete_shapes_from_db(client_ids_to_delete)
-        self._save_shapes_to_db()
+            shapes = {shape.client_id: shape for shape in getattr(self, shape_type)}
+            if not shapes:
+                continue
+
+            shape_class = self._get_shape_class(shape_type)
+            fields = ['label_id', 'group_id', 'frame', 'occluded', 'z_order'] + \
+                self._get_geometry_fields(shape_type)
+            attributes = {}
+            changes = []
+            for client_ids in _split_query_params(shapes, 1):
+                for db_id, client_id, *db_values in self._get_shape_set(shape_type) \
+                    .filter(client_id__in=client_ids).values_list('id', 'client_id', *fields):
+                    shape = shapes[client_id]
+                    changes.append((db_id, self._get_changed_fields(fields, db_values,
+                        [shape.label.id, shape.group_id, shape.frame, shape.occluded,
+                        shape.z_order] + self._get_geometry_values(shape_type, shape))))
+                    attributes[db_id] = shape.attributes
+            self._update_rows_in_db(shape_class, changes)
+
+            fk = self._get_shape_attr_fk(shape_type)
+            self._update_attributes_in_db(self._get_shape_attr_class(shape_type), fk,
+                {'{}__job_id'.format(fk): self.db_job.id}, '{}__client_id__in'.format(fk),
+                list(shapes), attributes)
 
     def _update_paths_in_db(self):
-        client_ids_to_delete = {}
         for shape_type in ['polygon_paths', 'polyline_paths', 'points_paths', 'box_paths']:
-            client_ids_to_delete[shape_type] = list(shape.client_id for shape in getattr(self, shape_type))
-        self._delete_paths_from_db(client_ids_to_delete)
-        self._save_paths_to_db()
+            paths = {path.client_id: path for path in getattr(self, shape_type)}
+            if not paths:
+                continue
+
+            path_fields = ['label_id', 'group_id', 'frame']
+            path_attributes = {}
+            path_shapes = {}
+            path_changes = []
+            for client_ids in _split_query_params(paths, 1):
+                for db_id, client_id, shapes, *db_values in self.db_job.objectpath_set \
+                    .filter(client_id__in=client_ids) \
+                    .values_list('id', 'client_id', 'shapes', *path_fields):
+                    path = paths[client_id]
+                    if shapes != self._get_path_shapes(shape_type):
+                        raise Exception('Type of the path with client id {} cannot be changed'.format(client_id))
+                    path_changes.append((db_id, self._get_changed_fields(path_fields,
+                        db_values, [path.label.id, path.group_id, path.frame])))
+                    path_attributes[db_id] = path.attributes
+                    path_shapes[db_id] = path.boxes if hasattr(path, 'boxes') else path.shapes
+            self._update_rows_in_db(models.ObjectPath, path_changes)
+
+            self._update_attributes_in_db(models.ObjectPathAttributeVal, 'track',
+                {'track__job_id': self.db_job.id}, 'track__client_id__in', list(paths),
+                path_attributes)
+
+            shape_class = self._get_shape_class(shape_type)
+            fields = ['occluded', 'z_order', 'outside'] + self._get_geometry_fields(shape_type)
+            db_shapes = {}
+            for client_ids in _split_query_params(paths, 1):
+                db_shapes.update(((track_id, frame), (db_id, db_values))
+                    for db_id, track_id, frame, *db_values in shape_class.objects \
+                    .filter(track__job_id=self.db_job.id, track__client_id__in=client_ids) \
+                    .values_list('id', 'track_id', 'frame', *fields))
+            created = []
+            attributes = {}
+            changes = []
+            for track_id, shapes in path_shapes.items():
+                for shape in shapes:
+                    db_shape = db_shapes.pop((track_id, shape.frame), None)
+                    if db_shape is None:
+                        created.append((track_id, shape))
+                    else:
+                        db_id, db_values = db_shape
+                        changes.append((db_id, self._get_changed_fields(fields, db_values,
+                            [shape.occluded, shape.z_order, shape.outside] +
+                            self._get_geometry_values(shape_type, shape))))
+                        attributes[db_id] = shape.attributes
+            self._update_rows_in_db(shape_class, changes)
+
+            # Attributes of deleted shapes are deleted by cascade
+            self._delete_rows_from_db(shape_class,
+                [db_id for db_id, _ in db_shapes.values()])
+            fk = self._get_shape_attr_fk(shape_type)
+            self._update_attributes_in_db(self._get_shape_attr_class(shape_type), fk,
+                {'{}__track__job_id'.format(fk): self.db_job.id},
+                '{}__track__client_id__in'.format(fk), list(paths), attributes)
+            self._save_path_shapes_to_db(shape_type, created)
 
     def _delete_shapes_from_db(self, data):
         for shape_type in ['polygons', 'polylines', 'points', 'boxes']:
@@ -1327,93 +2059,183 @@ class _AnnotationForJob(_Annotation):
             self._save_shapes_to_db()
             self._save_paths_to_db()
 
-    def to_client(self):
-        data = {
-            "boxes": [],
-            "box_paths": [],
-            "polygons": [],
-            "polygon_paths": [],
-            "polylines": [],
-            "polyline_paths": [],
-            "points": [],
-            "points_paths": [],
-        }
+    @staticmethod
+    def _attributes_to_client(attributes):
+        return [{'id': attr.id, 'value':attr.value} for attr in attributes]
+
+    def _shape_to_client(self, shape_type, shape):
+        if shape_type == 'boxes':
+            return {
+                "id": shape.client_id,
+                "label_id": shape.label.id,
+                "group_id": shape.group_id,
+                "xtl": shape.xtl,
+                "ytl": shape.ytl,
+                "xbr": shape.xbr,
+                "ybr": shape.ybr,
+                "occluded": shape.occluded,
+                "z_order": shape.z_order,
+                "frame": shape.frame,
+                "attributes": self._attributes_to_client(shape.attributes),
+            }
+        else:
+            return {
+                "id": shape.client_id,
+                "label_id": shape.label.id,
+                "group_id": shape.group_id,
+                "points": _format_points(shape.points),
+                "occluded": shape.occluded,
+                "z_order": shape.z_order,
+                "frame": shape.frame,
+                "attributes": self._attributes_to_client(shape.attributes),
+            }
 
-        for box in self.boxes:
-            data["boxes"].append({
-                "id": box.client_id,
-                "label_id": box.label.id,
-                "group_id": box.group_id,
+    def _path_to_client(self, paths_type, path):
+        if paths_type == 'box_paths':
+            shapes = [{
+                "frame": box.frame,
                 "xtl": box.xtl,
                 "ytl": box.ytl,
                 "xbr": box.xbr,
                 "ybr": box.ybr,
                 "occluded": box.occluded,
                 "z_order": box.z_order,
-                "frame": box.frame,
-                "attributes": [{'id': attr.id, 'value':attr.value} for attr in box.attributes],
-            })
-
-        for poly_type in ['polygons', 'polylines', 'points']:
-            for poly in getattr(self, poly_type):
-                data[poly_type].append({
-                    "id": poly.client_id,
-                    "label_id": poly.label.id,
-                    "group_id": poly.group_id,
-                    "points": poly.points,
-                    "occluded": poly.occluded,
-                    "z_order": poly.z_order,
-                    "frame": poly.frame,
-                    "attributes": [{'id': attr.id, 'value':attr.value} for attr in poly.attributes],
-                })
-
-        for box_path in self.box_paths:
-            data["box_paths"].append({
-                "id": box_path.client_id,
-                "label_id": box_path.label.id,
-                "group_id": box_path.group_id,
-                "frame": box_path.frame,
-                "attributes": [{'id': attr.id, 'value':attr.value} for attr in box_path.attributes],
-                "shapes": [box for box in map(lambda box:
-                    ({
-                        "frame": box.frame,
-                        "xtl": box.xtl,
-                        "ytl": box.ytl,
-                        "xbr": box.xbr,
-                        "ybr": box.ybr,
-                        "occluded": box.occluded,
-                        "z_order": box.z_order,
-                        "outside": box.outside,
-                        "attributes": [{'id': attr.id, 'value':attr.value} for attr in box.attributes],
-                    }), box_path.boxes)
-                ],
-            })
-
-        for poly_path_type in ['polygon_paths', 'polyline_paths', 'points_paths']:
-            for poly_path in getattr(self, poly_path_type):
-                data[poly_path_type].append({
-                    "id": poly_path.client_id,
-                    "label_id": poly_path.label.id,
-                    "group_id": poly_path.group_id,
-                    "frame": poly_path.frame,
-                    "attributes": [{'id': attr.id, 'value':attr.value} for attr in poly_path.attributes],
-                    "shapes": [shape for shape in map(lambda shape:
-                        ({
-                            "frame": shape.frame,
-                            "points": shape.points,
-                            "occluded": shape.occluded,
-                            "z_order": shape.z_order,
-                            "outside": shape.outside,
-                            "attributes": [{'id': attr.id, 'value':attr.value} for attr in shape.attributes],
-                        }), poly_path.shapes)
-                    ],
-                })
+                "outside": box.outside,
+                "attributes": self._attributes_to_client(box.attributes),
+            } for box in path.boxes]
+        else:
+            shapes = [{
+                "frame": shape.frame,
+                "points": _format_points(shape.points),
+                "occluded": shape.occluded,
+                "z_order": shape.z_order,
+                "outside": shape.outside,
+                "attributes": self._attributes_to_client(shape.attributes),
+            } for shape in path.shapes]
+
+        return {
+            "id": path.client_id,
+            "label_id": path.label.id,
+            "group_id": path.group_id,
+            "frame": path.frame,
+            "attributes": self._attributes_to_client(path.attributes),
+            "shapes": shapes,
+        }
+
+    def to_client(self):
+        data = {}
+        for shape_type in self.CLIENT_SHAPE_TYPES:
+            if shape_type.endswith('_paths'):
+                data[shape_type] = [self._path_to_client(shape_type, path)
+                    for path in getattr(self, shape_type)]
+            else:
+                data[shape_type] = [self._shape_to_client(shape_type, shape)
+                    for shape in getattr(self, shape_type)]
 
         return data
 
+    def iter_client_json(self):
+        """
+        Encode annotations from the database into JSON incrementally. The
+        output has the same data as json.dumps(self.to_client()) (the order
+        of keys of objects can differ) but only one shape or track is kept
+        in memory at a time. Yield strings.
+        """
+        labels = self._get_labels()
+        encoder = DjangoJSONEncoder()
+        for idx, shape_type in enumerate(self.CLIENT_SHAPE_TYPES):
+            yield '{}{}: ['.format(', ' if idx else '{', encoder.encode(shape_type))
+            if shape_type.endswith('_paths'):
+                objects = (self._path_to_client(shape_type, path)
+                    for path in self._iter_from_db(shape_type, labels))
+            else:
+                objects = (self._shape_to_client(shape_type, shape)
+                    for shape in self._iter_from_db(shape_type, labels))
+            for obj_idx, obj in enumerate(objects):
+                yield '{}{}'.format(', ' if obj_idx else '', encoder.encode(obj))
+            yield ']'
+        yield '}'
+
+    @staticmethod
+    def _geometry_to_client(shape, name):
+        value = getattr(shape, name)
+        return _format_points(value) if name == 'points' else value
+
+    @staticmethod
+    def _attributes_to_columns(columns, attributes):
+        columns['id'].extend(attr.id for attr in attributes)
+        columns['value'].extend(attr.value for attr in attributes)
+        columns['offsets'].append(len(columns['id']))
+
+    def _shapes_to_columns(self, shape_type, shapes):
+        fields = self._get_geometry_fields(shape_type)
+        columns = {name: [] for name in ['id', 'label_id', 'group_id', 'frame',
+            'occluded', 'z_order'] + fields}
+        attr_columns = {'offsets': [0], 'id': [], 'value': []}
+        for shape in shapes:
+            columns['id'].append(shape.client_id)
+            columns['label_id'].append(shape.label.id)
+            columns['group_id'].append(shape.group_id)
+            columns['frame'].append(shape.frame)
+            columns['occluded'].append(shape.occluded)
+            columns['z_order'].append(shape.z_order)
+            for name in fields:
+                columns[name].append(self._geometry_to_client(shape, name))
+            self._attributes_to_columns(attr_columns, shape.attributes)
+        columns['attributes'] = attr_columns
+
+        return columns
+
+    def _paths_to_columns(self, paths_type, paths):
+        columns = {name: [] for name in ['id', 'label_id', 'group_id', 'frame']}
+        attr_columns = {'offsets': [0], 'id': [], 'value': []}
+        fields = self._get_geometry_fields(paths_type)
+        shape_columns = {name: [] for name in ['frame', 'occluded', 'z_order',
+            'outside'] + fields}
+        shape_columns['offsets'] = [0]
+        shape_attr_columns = {'offsets': [0], 'id': [], 'value': []}
+        for path in paths:
+            columns['id'].append(path.client_id)
+            columns['label_id'].append(path.label.id)
+            columns['group_id'].append(path.group_id)
+            columns['frame'].append(path.frame)
+            self._attributes_to_columns(attr_columns, path.attributes)
+            for shape in (path.boxes if paths_type == 'box_paths' else path.shapes):
+                shape_columns['frame'].append(shape.frame)
+                shape_columns['occluded'].append(shape.occluded)
+                shape_columns['z_order'].append(shape.z_order)
+                shape_columns['outside'].append(shape.outside)
+                for name in fields:
+                    shape_columns[name].append(self._geometry_to_client(shape, name))
+                self._attributes_to_columns(shape_attr_columns, shape.attributes)
+            shape_columns['offsets'].append(len(shape_columns['frame']))
+        columns['attributes'] = attr_columns
+        shape_columns['attributes'] = shape_attr_columns
+        columns['shapes'] = shape_columns
+
+        return columns
+
+    def iter_client_columnar_json(self):
+        """
+        Encode annotations from the database into JSON in the compact
+        columnar format (see columnar.py). Only columns of one shape type
+        are kept in memory at a time. Yield strings.
+        """
+        labels = self._get_labels()
+        encoder = DjangoJSONEncoder(separators=(',', ':'))
+        for idx, shape_type in enumerate(columnar.SHAPE_TYPES):
+            if shape_type.endswith('_paths'):
+                columns = self._paths_to_columns(shape_type,
+                    self._iter_from_db(shape_type, labels))
+            else:
+                columns = self._shapes_to_columns(shape_type,
+                    self._iter_from_db(shape_type, labels))
+            yield '{}{}:{}'.format(',' if idx else '{', encoder.encode(shape_type),
+                encoder.encode(columns))
+        yield '}'
+
     def validate_data_from_client(self, data):
         client_ids = {
-            'saved': self._get_client_ids_from_db(),
             'create': set(),
             'update': set(),
             'delete': set(),
@@ -1437,6 +2259,10 @@ class _AnnotationForJob(_Annotation):
                 for shape in data[action][shape_type]:
                     extract_clinet_id(shape, action)
 
+        # Only ids from the request are interesting for the checks below
+        client_ids['saved'] = self._get_client_ids_from_db(
+            client_ids['create'] | client_ids['update'] | client_ids['delete'])
+
         # In case of delete action potentially it is possible to intersect set of IDs
         # that should delete and set of IDs that should create(i.e. save uploaded anno).
         # There is no need to check that
@@ -1504,34 +2330,210 @@ class _AnnotationForSegment(_Annotation):
         self.points = annotation.points
         self.points_paths = annotation.points_paths
 
+class _SegmentLoader:
+    """
+    Load annotations for segments (see _AnnotationForSegment) by a pool of
+    threads, each with its own database connection. Segments which will be
+    needed soon are requested by prefetch() and are loaded while previous
+    segments are merged, get() waits for a segment. If there are no
+    workers, segments are loaded by get() in the current thread.
+    """
+    def __init__(self, workers, snapshot=None):
+        self._snapshot = snapshot
+        self._futures = {}
+        self._requests = Queue()
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+            for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def prefetch(self, db_segment):
+        if self._threads and db_segment.id not in self._futures:
+            future = Future()
+            self._futures[db_segment.id] = future
+            self._requests.put((future, db_segment))
+
+    def discard(self, db_segment):
+        future = self._futures.pop(db_segment.id, None)
+        if future is not None:
+            future.cancel()
+
+    def get(self, db_segment):
+        if not self._threads:
+            return self._load(db_segment)
+
+        self.prefetch(db_segment)
+        return self._futures.pop(db_segment.id).result()
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        for _ in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    @staticmethod
+    def _load(db_segment):
+        annotation = _AnnotationForSegment(db_segment)
+        annotation.init_from_db()
+        return annotation
+
+    def _run(self):
+        try:
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    break
+                future, db_segment = request
+                if future.set_running_or_notify_cancel():
+                    try:
+                        # Workers see the same data as the thread which has
+                        # created the loader if it is possible
+                        with _import_snapshot(self._snapshot):
+                            annotation = self._load(db_segment)
+                        future.set_result(annotation)
+                    except Exception as ex:
+                        future.set_exception(ex)
+        finally:
+            # Each thread has its own connection to the database
+            connection.close()
+
 @plugin_decorator
 def _dump(tid, data_format, scheme, host, plugin_meta_data):
     # For big tasks dump function may run for a long time and
     # we dont need to acquire lock after _AnnotationForTask instance
-    # has been initialized from DB.
-    # But there is the bug with corrupted dump file in case 2 or more dump request received at the same time.
-    # https://github.com/opencv/cvat/issues/217
+    # has been initialized from DB. Concurrent dumps of the task write
+    # their own files (see _AnnotationForTask.dump).
     with transaction.atomic():
         db_task = models.Task.objects.select_for_update().get(id=tid)
         annotation = _AnnotationForTask(db_task)
+        meta = annotation._get_meta(scheme, host, plugin_meta_data)
+        ticket = annotation._get_dump_ticket(meta)
+        if _read_dump_ticket(db_task.get_dump_path()) == ticket:
+            return
         annotation.init_from_db()
 
-    annotation.dump(data_format, scheme, host, plugin_meta_data)
+    annotation.dump(meta, ticket)
 
-def _calc_box_area(box):
-    return (box.xbr - box.xtl) * (box.ybr - box.ytl)
+@plugin_decorator
+def _get_dump_ticket(tid, data_format, scheme, host, plugin_meta_data):
+    with _read_snapshot():
+        db_task = models.Task.objects.get(id=tid)
+        annotation = _AnnotationForTask(db_task)
+        meta = annotation._get_meta(scheme, host, plugin_meta_data)
+        return annotation._get_dump_ticket(meta)
 
-def _calc_overlap_box_area(box0, box1):
-    dx = min(box0.xbr, box1.xbr) - max(box0.xtl, box1.xtl)
-    dy = min(box0.ybr, box1.ybr) - max(box0.ytl, box1.ytl)
-    if dx > 0 and dy > 0:
-        return dx * dy
-    else:
-        return 0
+@plugin_decorator
+def _stream_dump(tid, data_format, scheme, host, plugin_meta_data):
+    # Plugins are applied before the function is called, thus their meta
+    # data is ready when chunks are requested
+    with _read_snapshot():
+        db_task = models.Task.objects.get(id=tid)
+        annotation = _AnnotationForTask(db_task)
+        meta = annotation._get_meta(scheme, host, plugin_meta_data)
+        yield from annotation._iter_gzip(meta, annotation._iter_fragments())
+
+def _calc_boxes_IoU(boxes0, boxes1):
+    """
+    Calculate IoU (intersection over union) for arrays of (xtl, ytl, xbr,
+    ybr) rows pairwise. It is 0 for boxes which don't overlap.
+    """
+    dx = np.minimum(boxes0[:, 2], boxes1[:, 2]) - np.maximum(boxes0[:, 0], boxes1[:, 0])
+    dy = np.minimum(boxes0[:, 3], boxes1[:, 3]) - np.maximum(boxes0[:, 1], boxes1[:, 1])
+    overlap_area = np.where((dx > 0) & (dy > 0), dx * dy, 0.0)
+    area0 = (boxes0[:, 2] - boxes0[:, 0]) * (boxes0[:, 3] - boxes0[:, 1])
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(overlap_area > 0,
+            overlap_area / (area0 + area1 - overlap_area), 0.0)
+
+def _find_overlapping_boxes(boxes0, boxes1):
+    """
+    Find all pairs of boxes from two arrays of (xtl, ytl, xbr, ybr) rows
+    which overlap. Return indexes of boxes in the pairs for each array.
+    Only pairs which can overlap along x axis are checked: boxes1 are
+    sorted by xtl and each box of boxes0 is compared with a window of them
+    (sort and sweep). Thus crowded frames don't need len(boxes0) x
+    len(boxes1) comparisons. Boxes with infinite or NaN coordinates (e.g.
+    bounds of a path without boxes) don't overlap with anything.
+    """
+    index0 = np.flatnonzero(np.all(np.isfinite(boxes0), axis=1))
+    index1 = np.flatnonzero(np.all(np.isfinite(boxes1), axis=1))
+    if not len(index0) or not len(index1):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    boxes0, boxes1 = boxes0[index0], boxes1[index1]
+
+    order = np.argsort(boxes1[:, 0], kind='mergesort')
+    xtl1 = boxes1[order, 0]
+    # A box of boxes1 can overlap with a box of boxes0 only if it starts
+    # before the end of the box and not too far to the left (the widest
+    # box plus a margin for rounding errors).
+    max_width = np.max(boxes1[:, 2] - boxes1[:, 0]) + 1
+    begins = np.searchsorted(xtl1, boxes0[:, 0] - max_width, side='left')
+    ends = np.maximum(np.searchsorted(xtl1, boxes0[:, 2], side='left'), begins)
+    counts = ends - begins
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = np.repeat(np.arange(len(boxes0)), counts)
+    cols = order[np.repeat(begins, counts) + offsets]
+
+    dx = np.minimum(boxes0[rows, 2], boxes1[cols, 2]) - np.maximum(boxes0[rows, 0], boxes1[cols, 0])
+    dy = np.minimum(boxes0[rows, 3], boxes1[cols, 3]) - np.maximum(boxes0[rows, 1], boxes1[cols, 1])
+    overlap = (dx > 0) & (dy > 0)
+    return index0[rows[overlap]], index1[cols[overlap]]
+
+def _match_objects(shape, rows, cols, costs, min_cost_thresh):
+    """
+    Find correspondence between two sets of objects using Hungarian
+    algorithm. The cost is given for pairs of objects (rows, cols, costs)
+    and it is 1 for all other pairs of the (len(objects0), len(objects1))
+    cost matrix. Return pairs of the solution with the cost not higher than
+    min_cost_thresh.
+
+    If each object has at most one pair with a cost lower than 1, every
+    optimal solution contains all these pairs, thus the matrix isn't built.
+    Otherwise the whole matrix is solved: with equal costs the algorithm
+    can choose another solution for a part of the matrix.
+    """
+    known = costs < 1
+    rows, cols, costs = rows[known], cols[known], costs[known]
+    if not np.any(costs <= min_cost_thresh):
+        return []
 
-def _calc_box_IoU(box0, box1):
-    overlap_area = _calc_overlap_box_area(box0, box1)
-    return overlap_area / (_calc_box_area(box0) + _calc_box_area(box1) - overlap_area)
+    if len(np.unique(rows)) == len(rows) and len(np.unique(cols)) == len(cols):
+        matched = costs <= min_cost_thresh
+        return list(zip(rows[matched].tolist(), cols[matched].tolist()))
+
+    cost_matrix = np.ones(shape=shape, dtype=float)
+    cost_matrix[rows, cols] = costs
+    return [(int(i), int(j)) for i, j in zip(*linear_sum_assignment(cost_matrix))
+        if cost_matrix[i][j] <= min_cost_thresh]
+
+def _get_box_coords(boxes):
+    return np.array([(box.xtl, box.ytl, box.xbr, box.ybr) for box in boxes],
+        dtype=np.float64).reshape(-1, 4)
+
+def _get_path_boxes(paths, start_frame, stop_frame):
+    """
+    Get interpolated boxes of paths on frames from start_frame to
+    stop_frame inclusive as arrays (path, frame): if a path has a box on
+    the frame, outside flags and coordinates.
+    """
+    shape = (len(paths), stop_frame - start_frame + 1)
+    present = np.zeros(shape, dtype=bool)
+    outside = np.zeros(shape, dtype=bool)
+    coords = np.zeros(shape + (4,), dtype=np.float64)
+    for index, path in enumerate(paths):
+        boxes = path.get_interpolated_boxes()
+        begin, end = np.searchsorted(boxes.frames, [start_frame, stop_frame + 1])
+        frames = boxes.frames[begin:end] - start_frame
+        present[index, frames] = True
+        outside[index, frames] = boxes.outside[begin:end]
+        coords[index, frames] = boxes.coords[begin:end]
+
+    return present, outside, coords
 
 class _AnnotationWriter:
     __metaclass__ = ABCMeta
@@ -1605,10 +2607,12 @@ class _AnnotationWriter:
         raise NotImplementedError
 
 class _XmlAnnotationWriter(_AnnotationWriter):
-    def __init__(self, file):
+    def __init__(self, file, level=0):
+        # A writer with a non-zero level writes a fragment of the document
+        # (e.g. images inside the root element)
         super().__init__(file, "1.1")
         self.xmlgen = XMLGenerator(self.file, 'utf-8')
-        self._level = 0
+        self._level = level
 
     def _indent(self, newline = True):
         if newline:
@@ -1730,27 +2734,149 @@ class _XmlAnnotationWriter(_AnnotationWriter):
         self.xmlgen.endDocument()
 
 class _AnnotationForTask(_Annotation):
+    """
+    Annotation for the task which is dumped segment by segment. Objects of
+    a segment are merged with objects of previous segments which overlap
+    them (see _merge_boxes and _merge_paths). After that objects which
+    cannot be changed by next segments are serialized into a fragment of
+    the dump and only the rest is kept (the state). A fragment is cached
+    together with the state, thus a segment is loaded and merged again only
+    if its job or the state left by previous segments has been changed.
+    """
     def __init__(self, db_task):
         super().__init__(0, db_task.size)
         self.db_task = db_task
+        self.fragments = []
+        self.im_meta_data = None
+
+    def reset(self):
+        super().reset()
+        # The first frame which isn't dumped yet (annotation mode)
+        self.next_frame = 0
+        # Positions of box tracks and boxes in the task order and serialized
+        # ones which aren't dumped yet (interpolation mode)
+        self.box_paths_positions = []
+        self.boxes_positions = []
+        self.held_box_paths = []
+        self.held_boxes = []
+        self.next_position = 0
+
+    def _get_state(self):
+        # Interpolated shapes are computed again on demand. They aren't
+        # a part of the state, otherwise the state depends on their usage.
+        for paths_type in ['box_paths', 'polygon_paths', 'polyline_paths', 'points_paths']:
+            for path in getattr(self, paths_type):
+                path._interpolation = None
+
+        return pickle.dumps([getattr(self, name) for name in self._STATE_FIELDS],
+            pickle.HIGHEST_PROTOCOL)
+
+    def _get_state_digest(self):
+        # The pickled state isn't hashed because it depends on the order
+        # of attributes in objects (see _digest)
+        return _digest([getattr(self, name) for name in self._STATE_FIELDS])
+
+    def _set_state(self, state):
+        for name, value in zip(self._STATE_FIELDS, pickle.loads(state)):
+            setattr(self, name, value)
+
+    _STATE_FIELDS = ['boxes', 'box_paths', 'polygons', 'polygon_paths', 'polylines',
+        'polyline_paths', 'points', 'points_paths', 'next_frame',
+        'box_paths_positions', 'boxes_positions', 'held_box_paths', 'held_boxes',
+        'next_position']
+
+    def _get_dump_key(self):
+        # Everything except annotations of jobs which changes the dump
+        db_task = self.db_task
+        db_labels = db_task.label_set.order_by('id').prefetch_related('attributespec_set')
+        return (_DUMP_CACHE_VERSION, db_task.id, db_task.mode, db_task.size,
+            db_task.overlap, db_task.flipped, db_task.z_order,
+            tuple((db_label.id, db_label.name, tuple((db_attr.id, db_attr.text)
+                for db_attr in db_label.attributespec_set.all())) for db_label in db_labels),
+            self.im_meta_data['original_size'][0]['width'],
+            self.im_meta_data['original_size'][0]['height'])
 
     def init_from_db(self):
+        self.fragments = list(self._iter_fragments())
+
+    def _create_loader(self, segments_count):
+        # Only PostgreSQL can share the snapshot of the current transaction
+        # with other connections. Otherwise workers could see other data.
+        workers = min(settings.ANNOTATION_LOAD_WORKERS, segments_count)
+        if workers > 1 and 'postgresql' in settings.DATABASES["default"]["ENGINE"]:
+            snapshot = _export_snapshot()
+            if snapshot is not None:
+                return _SegmentLoader(workers, snapshot)
+
+        return _SegmentLoader(0)
+
+    def _iter_fragments(self):
+        """
+        Load and merge segments in order and produce a fragment of the
+        dump for each of them (see _pop_images and _pop_tracks). Segments
+        which aren't in the cache are loaded in parallel ahead of the merge.
+        """
         self.reset()
-
-        for db_segment in self.db_task.segment_set.all():
-            annotation = _AnnotationForSegment(db_segment)
-            annotation.init_from_db()
-            self._merge_boxes(annotation.boxes, db_segment.start_frame,
-                self.db_task.overlap)
-            self._merge_paths(annotation.box_paths, db_segment.start_frame,
-                self.db_task.overlap)
-            self.polygons.extend(annotation.polygons)
-            self.polylines.extend(annotation.polylines)
-            self.points.extend(annotation.points)
-            self.polygon_paths.extend(annotation.polygon_paths)
-            self.polyline_paths.extend(annotation.polyline_paths)
-            self.points_paths.extend(annotation.points_paths)
-            # FIXME PolyShapes merge???
+        self.im_meta_data = get_image_meta_cache(self.db_task)
+
+        db_segments = list(self.db_task.segment_set.order_by('start_frame'))
+        versions = dict(models.Job.objects.filter(segment__task_id=self.db_task.id) \
+            .values_list('segment_id', 'annotation_version'))
+        loader = self._create_loader(len(db_segments))
+        try:
+            yield from self._merge_segments(db_segments, versions, loader)
+        finally:
+            loader.close()
+
+    def _merge_segments(self, db_segments, versions, loader):
+        dump_key = self._get_dump_key()
+        state = self._get_state()
+        state_digest = self._get_state_digest()
+        # The state is unpickled only if a segment isn't in the cache
+        state_is_loaded = True
+        for index, db_segment in enumerate(db_segments):
+            next_start = db_segments[index + 1].start_frame \
+                if index + 1 < len(db_segments) else None
+            key = _digest((dump_key, db_segment.id, db_segment.start_frame,
+                db_segment.stop_frame, next_start, versions[db_segment.id],
+                state_digest))
+            item = caches['annotation'].get('dump/{}'.format(db_segment.id))
+            if item and item[0] == key:
+                _, fragment, state, state_digest = item
+                state_is_loaded = False
+                loader.discard(db_segment)
+            else:
+                if not state_is_loaded:
+                    self._set_state(state)
+                    state_is_loaded = True
+                # A change of a segment usually changes next segments too
+                lookahead = settings.ANNOTATION_LOAD_WORKERS
+                for db_next_segment in db_segments[index + 1:index + 1 + lookahead]:
+                    loader.prefetch(db_next_segment)
+                annotation = loader.get(db_segment)
+                self._merge_boxes(annotation.boxes, db_segment.start_frame,
+                    self.db_task.overlap)
+                self._merge_paths(annotation.box_paths, db_segment.start_frame,
+                    self.db_task.overlap)
+                self.polygons.extend(annotation.polygons)
+                self.polylines.extend(annotation.polylines)
+                self.points.extend(annotation.points)
+                self.polygon_paths.extend(annotation.polygon_paths)
+                self.polyline_paths.extend(annotation.polyline_paths)
+                self.points_paths.extend(annotation.points_paths)
+                # FIXME PolyShapes merge???
+
+                if self.db_task.mode == "annotation":
+                    fragment = self._pop_images(next_start)
+                else:
+                    fragment = self._pop_tracks(next_start)
+                state = self._get_state()
+                state_digest = self._get_state_digest()
+                if sum(len(block[0]) for _, _, block in fragment) + len(state) <= \
+                    settings.ANNOTATION_CACHE_MAX_ITEM_SIZE:
+                    caches['annotation'].set('dump/{}'.format(db_segment.id),
+                        (key, fragment, state, state_digest))
+            yield fragment
 
     def _merge_paths(self, paths, start_frame, overlap):
         # 1. Split paths on two parts: new and which can be intersected
@@ -1762,10 +2888,10 @@ class _AnnotationForTask(_Annotation):
         assert len(new_paths) + len(int_paths) == len(paths)
 
         # 4. Find old paths which are intersected with int_paths
+        _interpolate_box_paths(self.box_paths)
         old_paths = []
         for path in self.box_paths:
-            box = path.get_interpolated_boxes()[-1]
-            if box.frame >= start_frame:
+            if path.get_interpolated_boxes().frames[-1] >= start_frame:
                 old_paths.append(path)
 
         # 3. Add new paths as is. It should be done only after old_paths
@@ -1777,53 +2903,63 @@ class _AnnotationForTask(_Annotation):
             self.box_paths.extend(int_paths)
             return
 
-        # 4. Build cost matrix for each path and find correspondence using
-        # Hungarian algorithm.
+        # 4. Find correspondence between paths using Hungarian algorithm.
+        # The cost for a pair of paths with the same label is the average
+        # error of their boxes on frames of the overlap. Boxes of paths are
+        # compared as arrays for all pairs of paths at once, and only pairs
+        # with boxes which overlap somewhere can have a cost lower than 1.
         min_cost_thresh = 0.5
-        cost_matrix = np.empty(shape=(len(int_paths), len(old_paths)),
-            dtype=float)
-        for i, int_path in enumerate(int_paths):
-            for j, old_path in enumerate(old_paths):
-                cost_matrix[i][j] = 1
-                if int_path.label.id == old_path.label.id:
-                    # Here start_frame is the start frame of next segment
-                    # and stop_frame is the stop frame of current segment
-                    stop_frame = start_frame + overlap - 1
-                    int_boxes = int_path.get_interpolated_boxes()
-                    old_boxes = old_path.get_interpolated_boxes()
-                    int_boxes = {box.frame:box for box in int_boxes if box.frame <= stop_frame}
-                    old_boxes = {box.frame:box for box in old_boxes if box.frame >= start_frame}
-                    assert int_boxes and old_boxes
-
-                    count, error = 0, 0
-                    for frame in range(start_frame, stop_frame + 1):
-                        box0, box1 = int_boxes.get(frame), old_boxes.get(frame)
-                        if box0 and box1:
-                            if box0.outside != box1.outside:
-                                error += 1
-                            else:
-                                error += 1 - _calc_box_IoU(box0, box1)
-                            count += 1
-                        elif box0 or box1:
-                            error += 1
-                            count += 1
-
-                    cost_matrix[i][j] = error / count
-
-        # 6. Find optimal solution using Hungarian algorithm.
-        row_ind, col_ind = linear_sum_assignment(cost_matrix)
-        int_paths_indexes = list(range(0, len(int_paths)))
-        for i, j in zip(row_ind, col_ind):
-            # Reject the solution if the cost is too high. Remember
-            # inside int_boxes_indexes boxes which were handled.
-            if cost_matrix[i][j] <= min_cost_thresh:
-                old_paths[j].merge(int_paths[i])
-                int_paths_indexes[i] = -1
+        # Here start_frame is the start frame of next segment
+        # and stop_frame is the stop frame of current segment
+        stop_frame = start_frame + overlap - 1
+        _interpolate_box_paths(int_paths)
+        int_present, int_outside, int_coords = _get_path_boxes(int_paths,
+            start_frame, stop_frame)
+        old_present, old_outside, old_coords = _get_path_boxes(old_paths,
+            start_frame, stop_frame)
+
+        def get_bounds(present, coords):
+            # A box which contains all boxes of a path on frames of the overlap.
+            # It is infinite if the path has no boxes there.
+            return np.stack([
+                np.min(np.where(present, coords[:, :, 0], np.inf), axis=1),
+                np.min(np.where(present, coords[:, :, 1], np.inf), axis=1),
+                np.max(np.where(present, coords[:, :, 2], -np.inf), axis=1),
+                np.max(np.where(present, coords[:, :, 3], -np.inf), axis=1)], axis=1)
+
+        rows, cols = _find_overlapping_boxes(get_bounds(int_present, int_coords),
+            get_bounds(old_present, old_coords))
+        int_labels = np.array([path.label.id for path in int_paths], dtype=np.int64)
+        old_labels = np.array([path.label.id for path in old_paths], dtype=np.int64)
+        same_label = int_labels[rows] == old_labels[cols]
+        rows, cols = rows[same_label], cols[same_label]
+
+        # 5. Errors are accumulated frame by frame in the same order as
+        # for a single pair of paths.
+        error = np.zeros(len(rows), dtype=float)
+        count = np.zeros(len(rows), dtype=np.int64)
+        for frame in range(overlap):
+            present0, present1 = int_present[rows, frame], old_present[cols, frame]
+            compared = present0 & present1 & \
+                (int_outside[rows, frame] == old_outside[cols, frame])
+            frame_error = (present0 | present1).astype(float)
+            frame_error[compared] = 1 - _calc_boxes_IoU(
+                int_coords[rows[compared], frame], old_coords[cols[compared], frame])
+            error += frame_error
+            count += present0 | present1
+        costs = error / count
+
+        # 6. Find optimal solution using Hungarian algorithm. Reject
+        # the solution if the cost is too high.
+        merged = set()
+        for i, j in _match_objects((len(int_paths), len(old_paths)), rows, cols,
+            costs, min_cost_thresh):
+            old_paths[j].merge(int_paths[i])
+            merged.add(i)
 
         # 7. Add all paths which were not processed.
-        for i in int_paths_indexes:
-            if i != -1:
-                self.box_paths.append(int_paths[i])
+        self.box_paths.extend(path for i, path in enumerate(int_paths)
+            if i not in merged)
 
     def _merge_boxes(self, boxes, start_frame, overlap):
         # 1. Split boxes on two parts: new and which can be intersected
@@ -1859,66 +2995,384 @@ class _AnnotationForTask(_Annotation):
             self.boxes.extend(int_boxes)
             return
 
-        # 4. Build cost matrix for each frame and find correspondence using
-        # Hungarian algorithm. In this case min_cost_thresh is stronger
-        # because we compare only on one frame.
+        # 4. Find correspondence for each frame using Hungarian algorithm.
+        # In this case min_cost_thresh is stronger because we compare only
+        # on one frame.
         min_cost_thresh = 0.25
         for frame in int_boxes_by_frame:
             if frame in old_boxes_by_frame:
                 int_boxes = int_boxes_by_frame[frame]
                 old_boxes = old_boxes_by_frame[frame]
-                cost_matrix = np.empty(shape=(len(int_boxes), len(old_boxes)),
-                    dtype=float)
-                # 5.1 Construct cost matrix for the frame.
-                for i, box0 in enumerate(int_boxes):
-                    for j, box1 in enumerate(old_boxes):
-                        if box0.label.id == box1.label.id:
-                            cost_matrix[i][j] = 1 - _calc_box_IoU(box0, box1)
-                        else:
-                            cost_matrix[i][j] = 1
-
-                # 6. Find optimal solution using Hungarian algorithm.
-                row_ind, col_ind = linear_sum_assignment(cost_matrix)
-                int_boxes_indexes = list(range(0, len(int_boxes)))
-                for i, j in zip(row_ind, col_ind):
-                    # Reject the solution if the cost is too high. Remember
-                    # inside int_boxes_indexes boxes which were handled.
-                    if cost_matrix[i][j] <= min_cost_thresh:
-                        old_boxes[j].merge(int_boxes[i])
-                        int_boxes_indexes[i] = -1
+                # 5. The cost is 1 - IoU for boxes with the same label which
+                # overlap and 1 for all other pairs.
+                int_coords = _get_box_coords(int_boxes)
+                old_coords = _get_box_coords(old_boxes)
+                rows, cols = _find_overlapping_boxes(int_coords, old_coords)
+                same_label = np.array([int_boxes[i].label.id == old_boxes[j].label.id
+                    for i, j in zip(rows.tolist(), cols.tolist())], dtype=bool)
+                rows, cols = rows[same_label], cols[same_label]
+                costs = 1 - _calc_boxes_IoU(int_coords[rows], old_coords[cols])
+
+                # 6. Find optimal solution using Hungarian algorithm. Reject
+                # the solution if the cost is too high.
+                merged = set()
+                for i, j in _match_objects((len(int_boxes), len(old_boxes)),
+                    rows, cols, costs, min_cost_thresh):
+                    old_boxes[j].merge(int_boxes[i])
+                    merged.add(i)
 
                 # 7. Add all boxes which were not processed.
-                for i in int_boxes_indexes:
-                    if i != -1:
-                        self.boxes.append(int_boxes[i])
+                self.boxes.extend(box for i, box in enumerate(int_boxes)
+                    if i not in merged)
             else:
                 # We don't have old boxes on the frame. Let's add all new ones.
                 self.boxes.extend(int_boxes_by_frame[frame])
 
-    def dump(self, data_format, scheme, host, plugin_meta_data):
-        def _flip_box(box, im_w, im_h):
-            box.xbr, box.xtl = im_w - box.xtl, im_w - box.xbr
-            box.ybr, box.ytl = im_h - box.ytl, im_h - box.ybr
+    def _pop_images(self, next_start):
+        """
+        Serialize images with shapes which cannot be changed by next segments
+        and remove the shapes. Shapes on frames of the next segment can be
+        merged with it. If a track is merged with a track of the next segment,
+        its keyframes are added on frames of the next segment, thus its
+        shapes can be changed only after its last keyframe before the next
+        segment. The result is a fragment with one stream of <image>
+        elements. A stream is a tuple (count of elements, if it has to be
+        numbered, deflate block).
+        """
+        stop_frame = float('inf')
+        if next_start is not None:
+            stop_frame = next_start
+            _interpolate_box_paths(self.box_paths)
+            for path in self.box_paths:
+                if path.get_interpolated_boxes().frames[-1] >= next_start:
+                    last_keyframe = max((box.frame for box in path.boxes
+                        if box.frame < next_start), default=None)
+                    if last_keyframe is not None:
+                        stop_frame = min(stop_frame, last_keyframe + 1)
+
+        shapes = {}
+        for shape_type, shape_list in [('boxes', self.to_boxes()),
+            ('polygons', self.to_polygons()), ('polylines', self.to_polylines()),
+            ('points', self.to_points())]:
+            for shape in shape_list:
+                if self.next_frame <= shape.frame < stop_frame:
+                    shapes.setdefault(shape.frame, {}).setdefault(shape_type, []).append(shape)
+
+        for shape_type in ['boxes', 'polygons', 'polylines', 'points']:
+            setattr(self, shape_type, [shape for shape in getattr(self, shape_type)
+                if shape.frame >= stop_frame])
+        self.box_paths = [path for path in self.box_paths
+            if path.get_interpolated_boxes().frames[-1] >= stop_frame]
+        for paths_type in ['polygon_paths', 'polyline_paths', 'points_paths']:
+            setattr(self, paths_type, [path for path in getattr(self, paths_type)
+                if path.get_interpolated_shapes().frames[-1] >= stop_frame])
+        self.next_frame = stop_frame
+
+        buffer = io.StringIO()
+        dumper = _XmlAnnotationWriter(buffer, level=1)
+        for frame in sorted(shapes):
+            self._dump_image(dumper, frame, shapes[frame])
+
+        return [(len(shapes), False, _deflate(buffer.getvalue()))]
+
+    def _pop_tracks(self, next_start):
+        """
+        Serialize tracks which cannot be changed by next segments and remove
+        them. Tracks are dumped by kinds in the order of the whole task: box
+        tracks, boxes, polygons, polygon tracks and so on. Thus there is
+        a separate stream of <track> elements in the fragment for each of
+        them. Box tracks and boxes are serialized as soon as they are final,
+        but a serialized one is held in the state until all of them before
+        it are final (see _pop_final_boxes). Thus a long track keeps only
+        compressed texts of tracks after it in the state.
+        """
+        def boxes_to_paths(boxes):
+            tracks = _Annotation(0, 0)
+            tracks.boxes = boxes
+            return tracks.to_box_paths()
+
+        _interpolate_box_paths(self.box_paths)
+        fragment = [
+            self._pop_final_boxes('box_paths', next_start,
+                lambda path: path.get_interpolated_boxes().frames[-1] < next_start,
+                lambda paths: paths),
+            self._pop_final_boxes('boxes', next_start,
+                lambda box: box.frame < next_start, boxes_to_paths),
+        ]
+
+        # They are never merged
+        tracks = _Annotation(0, 0)
+        for shape_type in ['polygons', 'polygon_paths', 'polylines',
+            'polyline_paths', 'points', 'points_paths']:
+            setattr(tracks, shape_type, getattr(self, shape_type))
+            setattr(self, shape_type, [])
+
+        for shape_type, paths in [
+            ('polygons', tracks._to_poly_paths('polygons')),
+            ('polygons', tracks.polygon_paths),
+            ('polylines', tracks._to_poly_paths('polylines')),
+            ('polylines', tracks.polyline_paths),
+            ('points', tracks._to_poly_paths('points')),
+            ('points', tracks.points_paths)]:
+            _interpolate_poly_paths(paths)
+            buffer = io.StringIO()
+            dumper = _XmlAnnotationWriter(buffer, level=1)
+            for index, path in enumerate(paths):
+                # Tracks without a client id are numbered by their position
+                # in the whole dump, which is known only in dump()
+                path_id = str(path.client_id) if path.client_id != -1 \
+                    else '\0{}\0'.format(index)
+                self._dump_track(dumper, shape_type, path, path_id)
+            text = buffer.getvalue()
+            fragment.append((len(paths), '\0' in text, _deflate(text)))
+
+        return fragment
+
+    def _pop_final_boxes(self, objects_type, next_start, is_final, to_paths):
+        """
+        Serialize final box tracks or boxes and remove them. Objects which
+        the merge of the segment appended get next positions in the task
+        order. Serialized objects before the first object which isn't final
+        make the stream of the fragment.
+        """
+        objects = getattr(self, objects_type)
+        positions = getattr(self, objects_type + '_positions')
+        held = getattr(self, 'held_' + objects_type)
+        added = len(objects) - len(positions)
+        positions.extend(range(self.next_position, self.next_position + added))
+        self.next_position += added
+
+        final, rest, rest_positions = [], [], []
+        for position, obj in zip(positions, objects):
+            if next_start is None or is_final(obj):
+                final.append((position, obj))
+            else:
+                rest.append(obj)
+                rest_positions.append(position)
+        setattr(self, objects_type, rest)
+        setattr(self, objects_type + '_positions', rest_positions)
+
+        def hold(entries):
+            # Texts are kept compressed by groups, they are decompressed
+            # only when some of them are dumped
+            held.append(([position for position, _ in entries], zlib.compress(
+                pickle.dumps([text for _, text in entries], pickle.HIGHEST_PROTOCOL))))
+
+        paths = to_paths([obj for _, obj in final])
+        _interpolate_box_paths(paths)
+        entries = []
+        for (position, _), path in zip(final, paths):
+            buffer = io.StringIO()
+            dumper = _XmlAnnotationWriter(buffer, level=1)
+            # The number of a track without a client id is its index in the
+            # stream (see _pop_tracks)
+            path_id = str(path.client_id) if path.client_id != -1 else '\0\0'
+            self._dump_track(dumper, 'boxes', path, path_id)
+            entries.append((position, buffer.getvalue()))
+        if entries:
+            hold(entries)
+
+        first_open = rest_positions[0] if rest_positions else float('inf')
+        texts = []
+        if any(positions[0] < first_open for positions, _ in held):
+            entries = sorted((entry for positions, data in held for entry in
+                zip(positions, pickle.loads(zlib.decompress(data)))),
+                key=lambda entry: entry[0])
+            count = sum(1 for position, _ in entries if position < first_open)
+            texts = [text for _, text in entries[:count]]
+            held.clear()
+            if count < len(entries):
+                hold(entries[count:])
+
+        text = ''.join(text.replace('\0\0', '\0{}\0'.format(index))
+            for index, text in enumerate(texts))
+
+        return (len(texts), '\0' in text, _deflate(text))
+
+    @staticmethod
+    def _flip_box(box, im_w, im_h):
+        box.xbr, box.xtl = im_w - box.xtl, im_w - box.xbr
+        box.ybr, box.ytl = im_h - box.ytl, im_h - box.ybr
+
+    @staticmethod
+    def _flip_shape(shape, im_w, im_h):
+        # Interpolated shapes can share the array, thus it isn't
+        # modified inplace
+        shape.points = np.array([im_w - 1, im_h - 1], dtype=np.float32) - shape.points
+
+    @staticmethod
+    def _dump_points(points):
+        return ';'.join(['{:.2f},{:.2f}'.format(x, y) for x, y in points.tolist()])
+
+    def _dump_image(self, dumper, frame, shapes):
+        db_task = self.db_task
+        im_meta_data = self.im_meta_data
+
+        link = get_frame_path(db_task.id, frame)
+        path = os.readlink(link)
+
+        rpath = path.split(os.path.sep)
+        rpath = os.path.sep.join(rpath[rpath.index(".upload")+1:])
+
+        im_w = im_meta_data['original_size'][frame]['width']
+        im_h = im_meta_data['original_size'][frame]['height']
+
+        dumper.open_image(OrderedDict([
+            ("id", str(frame)),
+            ("name", rpath),
+            ("width", str(im_meta_data['original_size'][frame]["width"])),
+            ("height", str(im_meta_data['original_size'][frame]["height"]))
+        ]))
+
+        for shape_type in ["boxes", "polygons", "polylines", "points"]:
+            for shape in shapes.get(shape_type, []):
+                if shape_type == "boxes":
+                    if db_task.flipped:
+                        self._flip_box(shape, im_w, im_h)
+
+                    dump_dict = OrderedDict([
+                        ("label", shape.label.name),
+                        ("xtl", "{:.2f}".format(shape.xtl)),
+                        ("ytl", "{:.2f}".format(shape.ytl)),
+                        ("xbr", "{:.2f}".format(shape.xbr)),
+                        ("ybr", "{:.2f}".format(shape.ybr)),
+                        ("occluded", str(int(shape.occluded))),
+                    ])
+                    if db_task.z_order:
+                        dump_dict['z_order'] = str(shape.z_order)
+                    if shape.group_id:
+                        dump_dict['group_id'] = str(shape.group_id)
+                    dumper.open_box(dump_dict)
+                else:
+                    if db_task.flipped:
+                        self._flip_shape(shape, im_w, im_h)
+
+                    dump_dict = OrderedDict([
+                        ("label", shape.label.name),
+                        ("points", self._dump_points(shape.points)),
+                        ("occluded", str(int(shape.occluded))),
+                    ])
+
+                    if db_task.z_order:
+                        dump_dict['z_order'] = str(shape.z_order)
+                    if shape.group_id:
+                        dump_dict['group_id'] = str(shape.group_id)
+
+                    if shape_type == "polygons":
+                        dumper.open_polygon(dump_dict)
+                    elif shape_type == "polylines":
+                        dumper.open_polyline(dump_dict)
+                    else:
+                        dumper.open_points(dump_dict)
+
+                for attr in shape.attributes:
+                    dumper.add_attribute(OrderedDict([
+                        ("name", attr.name),
+                        ("value", attr.value)
+                    ]))
+
+                if shape_type == "boxes":
+                    dumper.close_box()
+                elif shape_type == "polygons":
+                    dumper.close_polygon()
+                elif shape_type == "polylines":
+                    dumper.close_polyline()
+                else:
+                    dumper.close_points()
 
-        def _flip_shape(shape, im_w, im_h):
-            points = []
-            for p in shape.points.split(' '):
-                p = p.split(',')
-                points.append({
-                    'x': p[0],
-                    'y': p[1]
-                })
+        dumper.close_image()
+
+    def _dump_track(self, dumper, shape_type, path, path_id):
+        db_task = self.db_task
+        im_w = self.im_meta_data['original_size'][0]['width']
+        im_h = self.im_meta_data['original_size'][0]['height']
+
+        dump_dict = OrderedDict([
+            ("id", path_id),
+            ("label", path.label.name),
+        ])
+        if path.group_id:
+            dump_dict['group_id'] = str(path.group_id)
+        dumper.open_track(dump_dict)
+        # Interpolated shapes are dumped from arrays without objects
+        if shape_type == "boxes":
+            interpolation = path.get_interpolated_boxes()
+            coords = interpolation.coords
+            if db_task.flipped:
+                coords = np.stack([im_w - coords[:, 2], im_h - coords[:, 3],
+                    im_w - coords[:, 0], im_h - coords[:, 1]], axis=1)
+            rows = zip(zip(*interpolation.get_columns()), coords.tolist())
+            for (frame, source, outside, occluded, z_order, keyframe), \
+                (xtl, ytl, xbr, ybr) in rows:
+                dump_dict = OrderedDict([
+                    ("frame", str(frame)),
+                    ("xtl", "{:.2f}".format(xtl)),
+                    ("ytl", "{:.2f}".format(ytl)),
+                    ("xbr", "{:.2f}".format(xbr)),
+                    ("ybr", "{:.2f}".format(ybr)),
+                    ("outside", str(int(outside))),
+                    ("occluded", str(int(occluded))),
+                    ("keyframe", str(int(keyframe)))
+                ])
+
+                if db_task.z_order:
+                    dump_dict["z_order"] = str(z_order)
+
+                dumper.open_box(dump_dict)
+                for attr in path.attributes + interpolation.attributes[source]:
+                    dumper.add_attribute(OrderedDict([
+                        ("name", attr.name),
+                        ("value", attr.value)
+                    ]))
+                dumper.close_box()
+        else:
+            interpolation = path.get_interpolated_shapes()
+            # Points of a keyframe are the same on the next frame
+            points = {}
+            for frame, source, outside, occluded, z_order, keyframe in \
+                zip(*interpolation.get_columns()):
+                if source not in points:
+                    shape = interpolation.shapes[source]
+                    if db_task.flipped:
+                        shape = copy.copy(shape)
+                        self._flip_shape(shape, im_w, im_h)
+                    points[source] = self._dump_points(shape.points)
+                dump_dict = OrderedDict([
+                    ("frame", str(frame)),
+                    ("points", points[source]),
+                    ("outside", str(int(outside))),
+                    ("occluded", str(int(occluded))),
+                    ("keyframe", str(int(keyframe)))
+                ])
+
+                if db_task.z_order:
+                    dump_dict["z_order"] = str(z_order)
+
+                if shape_type == "polygons":
+                    dumper.open_polygon(dump_dict)
+                elif shape_type == "polylines":
+                    dumper.open_polyline(dump_dict)
+                else:
+                    dumper.open_points(dump_dict)
 
-            for p in points:
-                p['x'] = im_w - (float(p['x']) + 1)
-                p['y'] = im_h - (float(p['y']) + 1)
+                for attr in path.attributes + interpolation.attributes[source]:
+                    dumper.add_attribute(OrderedDict([
+                        ("name", attr.name),
+                        ("value", attr.value)
+                    ]))
 
-            shape.points = ' '.join(['{},{}'.format(point['x'], point['y']) for point in points])
+                if shape_type == "polygons":
+                    dumper.close_polygon()
+                elif shape_type == "polylines":
+                    dumper.close_polyline()
+                else:
+                    dumper.close_points()
+        dumper.close_track()
 
+    def _get_meta(self, scheme, host, plugin_meta_data):
         db_task = self.db_task
         db_segments = db_task.segment_set.all().prefetch_related('job_set')
         db_labels = db_task.label_set.all().prefetch_related('attributespec_set')
-        im_meta_data = get_image_meta_cache(db_task)
 
         meta = OrderedDict([
             ("task", OrderedDict([
@@ -1962,218 +3416,82 @@ class _AnnotationForTask(_Annotation):
         meta.update(plugin_meta_data)
 
         if db_task.mode == "interpolation":
+            im_meta_data = get_image_meta_cache(db_task)
             meta["task"]["original_size"] = OrderedDict([
                 ("width", str(im_meta_data["original_size"][0]["width"])),
                 ("height", str(im_meta_data["original_size"][0]["height"]))
             ])
 
-        dump_path = db_task.get_dump_path()
-        with open(dump_path, "w") as dump_file:
-            dumper = _XmlAnnotationWriter(dump_file)
+        return meta
+
+    def _iter_gzip(self, meta, fragments, ticket=None):
+        """
+        Encode the dump as chunks of gzip compressed XML. Fragments of
+        segments are concatenated stream by stream without compressing
+        them again. The first stream of a fragment is produced as soon as
+        the fragment is ready, the rest of streams only after all fragments.
+        The ticket is kept in the gzip header (see _read_dump_ticket).
+        """
+        def iter_blocks():
+            buffer = io.StringIO()
+            dumper = _XmlAnnotationWriter(buffer)
             dumper.open_root()
             dumper.add_meta(meta)
-
-            if db_task.mode == "annotation":
-                shapes = {}
-                shapes["boxes"] = {}
-                shapes["polygons"] = {}
-                shapes["polylines"] = {}
-                shapes["points"] = {}
-                boxes = self.to_boxes()
-                for box in boxes:
-                    if box.frame not in shapes["boxes"]:
-                        shapes["boxes"][box.frame] = []
-                    shapes["boxes"][box.frame].append(box)
-
-                polygons = self.to_polygons()
-                for polygon in polygons:
-                    if polygon.frame not in shapes["polygons"]:
-                        shapes["polygons"][polygon.frame] = []
-                    shapes["polygons"][polygon.frame].append(polygon)
-
-                polylines = self.to_polylines()
-                for polyline in polylines:
-                    if polyline.frame not in shapes["polylines"]:
-                        shapes["polylines"][polyline.frame] = []
-                    shapes["polylines"][polyline.frame].append(polyline)
-
-                points = self.to_points()
-                for points in points:
-                    if points.frame not in shapes["points"]:
-                        shapes["points"][points.frame] = []
-                    shapes["points"][points.frame].append(points)
-
-                for frame in sorted(set(list(shapes["boxes"].keys()) +
-                    list(shapes["polygons"].keys()) +
-                    list(shapes["polylines"].keys()) +
-                    list(shapes["points"].keys()))):
-
-                    link = get_frame_path(db_task.id, frame)
-                    path = os.readlink(link)
-
-                    rpath = path.split(os.path.sep)
-                    rpath = os.path.sep.join(rpath[rpath.index(".upload")+1:])
-
-                    im_w = im_meta_data['original_size'][frame]['width']
-                    im_h = im_meta_data['original_size'][frame]['height']
-
-                    dumper.open_image(OrderedDict([
-                        ("id", str(frame)),
-                        ("name", rpath),
-                        ("width", str(im_meta_data['original_size'][frame]["width"])),
-                        ("height", str(im_meta_data['original_size'][frame]["height"]))
-                    ]))
-
-                    for shape_type in ["boxes", "polygons", "polylines", "points"]:
-                        shape_dict = shapes[shape_type]
-                        if frame in shape_dict:
-                            for shape in shape_dict[frame]:
-                                if shape_type == "boxes":
-                                    if db_task.flipped:
-                                        _flip_box(shape, im_w, im_h)
-
-                                    dump_dict = OrderedDict([
-                                        ("label", shape.label.name),
-                                        ("xtl", "{:.2f}".format(shape.xtl)),
-                                        ("ytl", "{:.2f}".format(shape.ytl)),
-                                        ("xbr", "{:.2f}".format(shape.xbr)),
-                                        ("ybr", "{:.2f}".format(shape.ybr)),
-                                        ("occluded", str(int(shape.occluded))),
-                                    ])
-                                    if db_task.z_order:
-                                        dump_dict['z_order'] = str(shape.z_order)
-                                    if shape.group_id:
-                                        dump_dict['group_id'] = str(shape.group_id)
-                                    dumper.open_box(dump_dict)
-                                else:
-                                    if db_task.flipped:
-                                        _flip_shape(shape, im_w, im_h)
-
-                                    dump_dict = OrderedDict([
-                                        ("label", shape.label.name),
-                                        ("points", ';'.join((
-                                            ','.join((
-                                                "{:.2f}".format(float(p.split(',')[0])),
-                                                "{:.2f}".format(float(p.split(',')[1]))
-                                            )) for p in shape.points.split(' '))
-                                        )),
-                                        ("occluded", str(int(shape.occluded))),
-                                    ])
-
-                                    if db_task.z_order:
-                                        dump_dict['z_order'] = str(shape.z_order)
-                                    if shape.group_id:
-                                        dump_dict['group_id'] = str(shape.group_id)
-
-                                    if shape_type == "polygons":
-                                        dumper.open_polygon(dump_dict)
-                                    elif shape_type == "polylines":
-                                        dumper.open_polyline(dump_dict)
-                                    else:
-                                        dumper.open_points(dump_dict)
-
-                                for attr in shape.attributes:
-                                    dumper.add_attribute(OrderedDict([
-                                        ("name", attr.name),
-                                        ("value", attr.value)
-                                    ]))
-
-                                if shape_type == "boxes":
-                                    dumper.close_box()
-                                elif shape_type == "polygons":
-                                    dumper.close_polygon()
-                                elif shape_type == "polylines":
-                                    dumper.close_polyline()
-                                else:
-                                    dumper.close_points()
-
-                    dumper.close_image()
-            else:
-                paths = {}
-                paths["boxes"] = self.to_box_paths()
-                paths["polygons"] = self.to_polygon_paths()
-                paths["polylines"] = self.to_polyline_paths()
-                paths["points"] = self.to_points_paths()
-
-                im_w = im_meta_data['original_size'][0]['width']
-                im_h = im_meta_data['original_size'][0]['height']
-
-                counter = 0
-                for shape_type in ["boxes", "polygons", "polylines", "points"]:
-                    path_list = paths[shape_type]
-                    for path in path_list:
-                        path_id = path.client_id if path.client_id != -1 else counter
-                        counter += 1
-                        dump_dict = OrderedDict([
-                            ("id", str(path_id)),
-                            ("label", path.label.name),
-                        ])
-                        if path.group_id:
-                            dump_dict['group_id'] = str(path.group_id)
-                        dumper.open_track(dump_dict)
-                        if shape_type == "boxes":
-                            for box in path.get_interpolated_boxes():
-                                if db_task.flipped:
-                                    _flip_box(box, im_w, im_h)
-                                dump_dict = OrderedDict([
-                                    ("frame", str(box.frame)),
-                                    ("xtl", "{:.2f}".format(box.xtl)),
-                                    ("ytl", "{:.2f}".format(box.ytl)),
-                                    ("xbr", "{:.2f}".format(box.xbr)),
-                                    ("ybr", "{:.2f}".format(box.ybr)),
-                                    ("outside", str(int(box.outside))),
-                                    ("occluded", str(int(box.occluded))),
-                                    ("keyframe", str(int(box.keyframe)))
-                                ])
-
-                                if db_task.z_order:
-                                    dump_dict["z_order"] = str(box.z_order)
-
-                                dumper.open_box(dump_dict)
-                                for attr in path.attributes + box.attributes:
-                                    dumper.add_attribute(OrderedDict([
-                                        ("name", attr.name),
-                                        ("value", attr.value)
-                                    ]))
-                                dumper.close_box()
-                        else:
-                            for shape in path.get_interpolated_shapes():
-                                if db_task.flipped:
-                                    _flip_shape(shape, im_w, im_h)
-                                dump_dict = OrderedDict([
-                                    ("frame", str(shape.frame)),
-                                    ("points", ';'.join((
-                                        ','.join((
-                                            "{:.2f}".format(float(p.split(',')[0])),
-                                            "{:.2f}".format(float(p.split(',')[1]))
-                                        )) for p in shape.points.split(' '))
-                                    )),
-                                    ("outside", str(int(shape.outside))),
-                                    ("occluded", str(int(shape.occluded))),
-                                    ("keyframe", str(int(shape.keyframe)))
-                                ])
-
-                                if db_task.z_order:
-                                    dump_dict["z_order"] = str(shape.z_order)
-
-                                if shape_type == "polygons":
-                                    dumper.open_polygon(dump_dict)
-                                elif shape_type == "polylines":
-                                    dumper.open_polyline(dump_dict)
-                                else:
-                                    dumper.open_points(dump_dict)
-
-                                for attr in path.attributes + shape.attributes:
-                                    dumper.add_attribute(OrderedDict([
-                                        ("name", attr.name),
-                                        ("value", attr.value)
-                                    ]))
-
-                                if shape_type == "polygons":
-                                    dumper.close_polygon()
-                                elif shape_type == "polylines":
-                                    dumper.close_polyline()
-                                else:
-                                    dumper.close_points()
-                        dumper.close_track()
+            yield _deflate(buffer.getvalue())
+
+            # Tracks without a client id get their number here (see _pop_tracks)
+            counter = 0
+            def get_block(count, numbered, block):
+                if numbered:
+                    block = _deflate(re.sub('\0([0-9]+)\0',
+                        lambda match: str(counter + int(match.group(1))), _inflate(block)))
+                return block
+
+            fragments_tail = []
+            for fragment in fragments:
+                for count, numbered, block in fragment[:1]:
+                    yield get_block(count, numbered, block)
+                    counter += count
+                fragments_tail.append(fragment[1:])
+
+            streams_count = len(fragments_tail[0]) if fragments_tail else 0
+            for stream in range(streams_count):
+                for fragment in fragments_tail:
+                    count, numbered, block = fragment[stream]
+                    yield get_block(count, numbered, block)
+                    counter += count
+
+            buffer = io.StringIO()
+            dumper = _XmlAnnotationWriter(buffer, level=1)
             dumper.close_root()
+            yield _deflate(buffer.getvalue())
+
+        return _gzip_blocks(iter_blocks(), ticket)
+
+    def _get_dump_ticket(self, meta):
+        """
+        Identify the dump by everything which it is made of except the time
+        of the dump: the meta data (the task, labels, segments and data of
+        plugins) and versions of annotations of all jobs.
+        """
+        meta = OrderedDict((key, value) for key, value in meta.items()
+            if key != 'dumped')
+        versions = list(models.Job.objects.filter(segment__task_id=self.db_task.id) \
+            .order_by('id').values_list('id', 'annotation_version'))
+        return _digest((_DUMP_CACHE_VERSION, self.db_task.z_order, meta, versions))
+
+    def dump(self, meta, ticket):
+        # The dump is written into a new file which replaces the previous
+        # dump only when it is complete. Thus concurrent dumps of the task
+        # cannot corrupt it and a dump is never read half-written (#217).
+        dump_path = self.db_task.get_dump_path()
+        tmp_path = "{}.{}.tmp".format(dump_path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, "xb") as dump_file:
+                for chunk in self._iter_gzip(meta, self.fragments, ticket):
+                    dump_file.write(chunk)
+            os.replace(tmp_path, dump_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
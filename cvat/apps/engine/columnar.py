@@ -0,0 +1,100 @@
+# Copyright (C) 2018 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Compact columnar format of annotations for a job. Instead of a list of
+objects each shape type is represented by a table: a dictionary of columns
+(lists) of the same length. For example:
+
+{
+    "boxes": {
+        "id": [1, 2], "label_id": [3, 3], "group_id": [0, 0],
+        "frame": [0, 5], "xtl": [...], "ytl": [...], "xbr": [...], "ybr": [...],
+        "occluded": [false, true], "z_order": [0, 1],
+        "attributes": {"offsets": [0, 1, 1], "id": [7], "value": ["red"]}
+    },
+    "box_paths": {
+        "id": [...], "label_id": [...], "group_id": [...], "frame": [...],
+        "attributes": {"offsets": [...], "id": [...], "value": [...]},
+        "shapes": {
+            "offsets": [...], "frame": [...], "xtl": [...], ...,
+            "outside": [...],
+            "attributes": {"offsets": [...], "id": [...], "value": [...]}
+        }
+    },
+    ...
+}
+
+Polygons, polylines, points and their paths have the "points" column
+instead of "xtl", "ytl", "xbr", "ybr". A nested table (attributes, shapes
+of a path) has the "offsets" column: rows of the nested table which belong
+to the i-th row of the parent table are in [offsets[i], offsets[i+1]).
+"""
+
+CONTENT_TYPE = 'application/vnd.cvat.columnar+json'
+
+SHAPE_TYPES = ['boxes', 'box_paths', 'polygons', 'polygon_paths',
+    'polylines', 'polyline_paths', 'points', 'points_paths']
+
+class Table:
+    """
+    A sequence of rows of a columnar table. Rows are lightweight views
+    which behave like dictionaries, thus code which works with lists of
+    shapes from the client can work with tables without any changes.
+    """
+    def __init__(self, columns, start=None, stop=None):
+        self.columns = columns
+        self.start = 0 if start is None else start
+        self.stop = len(columns['frame']) if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('row index out of range')
+
+        return Row(self.columns, self.start + index)
+
+    def __iter__(self):
+        for index in range(self.start, self.stop):
+            yield Row(self.columns, index)
+
+class Row:
+    __slots__ = ['columns', 'index']
+
+    def __init__(self, columns, index):
+        self.columns = columns
+        self.index = index
+
+    def __getitem__(self, key):
+        column = self.columns[key]
+        if isinstance(column, dict):
+            offsets = column['offsets']
+            return Table(column, offsets[self.index], offsets[self.index + 1])
+
+        return column[self.index]
+
+    def __setitem__(self, key, value):
+        self.columns[key][self.index] = value
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def get(self, key, default=None):
+        return self[key] if key in self.columns else default
+
+def load(data):
+    """
+    Convert data for save_job in the columnar format into tables. Each
+    action contains a table for every shape type, except the 'delete'
+    action which contains lists of client ids as usual.
+    """
+    for action in ['create', 'update']:
+        data[action] = {shape_type: Table(data[action][shape_type])
+            for shape_type in SHAPE_TYPES}
+
+    return data
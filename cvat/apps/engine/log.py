@@ -3,7 +3,14 @@
 # SPDX-License-Identifier: MIT
 
 import os
+import gzip
+import json
+import atexit
 import logging
+import threading
+from collections import OrderedDict
+from queue import Queue, Empty, Full
+from django.conf import settings
 from cvat.settings.base import LOGGING
 from .models import Job, Task
 
@@ -52,6 +59,102 @@ class JobLoggerStorage:
         job = _get_job(jid)
         return slogger.task[job.segment.task.id]
 
+class ClientLogWriter:
+    """
+    Write events from clients to client logs of tasks in a background
+    thread. Events are taken from the queue in batches and each batch of a
+    task is appended to its log as one gzip member of NDJSON (one event per
+    line), thus the log can be read by zcat. Events are also passed to
+    handlers of the 'cvat.client' logger (e.g. logstash) by the thread.
+    The queue is limited by CLIENT_LOG_QUEUE_SIZE events. If it is full, a
+    request waits for CLIENT_LOG_PUT_TIMEOUT seconds and after that events
+    are dropped.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._dropped = 0
+
+    def _get_queue(self):
+        # The thread doesn't survive a fork, so the writer is started again
+        # in a child process (e.g. by mod_wsgi or rq).
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = Queue(settings.CLIENT_LOG_QUEUE_SIZE)
+                threading.Thread(target=self._run, args=(self._queue,),
+                    name='client-log-writer', daemon=True).start()
+
+            return self._queue
+
+    def put(self, tid, path, level, events):
+        queue = self._get_queue()
+        for index, event in enumerate(events):
+            try:
+                queue.put((tid, path, level, event), timeout=settings.CLIENT_LOG_PUT_TIMEOUT)
+            except Full:
+                self._dropped += len(events) - index
+                slogger.glob.warning("client log queue is full: {} events have been dropped".format(
+                    self._dropped))
+                break
+
+    def flush(self):
+        """Wait until all queued events are written"""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def _run(self, queue):
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < settings.CLIENT_LOG_BATCH_SIZE:
+                    batch.append(queue.get_nowait())
+            except Empty:
+                pass
+
+            try:
+                self._write(batch)
+            except Exception:
+                slogger.glob.error("cannot write {} client events".format(len(batch)),
+                    exc_info=True)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    @staticmethod
+    def _write(batch):
+        tasks = OrderedDict()
+        for tid, path, level, event in batch:
+            tasks.setdefault((tid, path), []).append((level, json.dumps(event)))
+
+        ship = logging.getLogger('cvat.client').hasHandlers()
+        for (tid, path), events in tasks.items():
+            data = gzip.compress(''.join(line + '\n' for _, line in events).encode())
+            # The member is written by one call to the end of the file, thus
+            # batches from different processes aren't mixed.
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+            if ship:
+                logger = logging.getLogger('cvat.client.task_{}'.format(tid))
+                for level, line in events:
+                    logger.log(level, line)
+
+class TaskClientLogger:
+    def __init__(self, tid, path):
+        self.tid = tid
+        self.path = path
+
+    def info(self, events):
+        _client_log_writer.put(self.tid, self.path, logging.INFO, events)
+
+    def error(self, events):
+        _client_log_writer.put(self.tid, self.path, logging.ERROR, events)
+
 class TaskClientLoggerStorage:
     def __init__(self):
         self._storage = dict()
@@ -63,11 +166,7 @@ class TaskClientLoggerStorage:
 
     def _create_client_logger(self, tid):
         task = _get_task(tid)
-        logger = logging.getLogger('cvat.client.task_{}'.format(tid))
-        client_file = logging.FileHandler(filename=task.get_client_log_path())
-        logger.addHandler(client_file)
-
-        return logger
+        return TaskClientLogger(tid, task.get_client_log_path())
 
 class JobClientLoggerStorage:
     def __init__(self):
@@ -88,9 +187,13 @@ class dotdict(dict):
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+_client_log_writer = ClientLogWriter()
+atexit.register(_client_log_writer.flush)
+
 clogger = dotdict({
     'task': TaskClientLoggerStorage(),
-    'job': JobClientLoggerStorage()
+    'job': JobClientLoggerStorage(),
+    'flush': _client_log_writer.flush,
 })
 
 slogger = dotdict({
@@ -0,0 +1,235 @@
+# Copyright (C) 2018 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+import copy
+import os
+import random
+import shutil
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+
+from cvat.apps.engine import annotation, columnar, models
+
+class Command(BaseCommand):
+    help = ('Create a synthetic task with a lot of annotations, show query '
+        'plans of hot annotation queries and measure get, save_job and dump. '
+        'Run it before and after a migration to compare indexes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=10000)
+        parser.add_argument('--segment-size', type=int, default=1000)
+        parser.add_argument('--overlap', type=int, default=0)
+        parser.add_argument('--shapes', type=int, default=100000,
+            help='number of boxes and polygons in the task')
+        parser.add_argument('--tracks', type=int, default=5000,
+            help='number of box tracks in the task')
+        parser.add_argument('--keep', action='store_true',
+            help="don't delete the task at the end")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        db_task = self._create_task(options['frames'], options['segment_size'],
+            options['overlap'])
+        try:
+            self.stdout.write('Task #{}: seeding annotations...'.format(db_task.id))
+            db_jobs = list(models.Job.objects.filter(segment__task=db_task)
+                .select_related('segment').order_by('id'))
+            for db_job in db_jobs:
+                annotation.save_job(db_job.id, {
+                    'create': self._generate(db_task, db_job.segment, rng,
+                        options['shapes'] // len(db_jobs),
+                        options['tracks'] // len(db_jobs)),
+                    'update': self._empty(),
+                    'delete': self._empty(),
+                })
+
+            db_job = db_jobs[len(db_jobs) // 2]
+            self._explain(db_job)
+            self._measure(db_task, db_jobs, db_job, rng)
+            self._measure_split(db_task, rng, options['shapes'], options['tracks'])
+        finally:
+            if not options['keep']:
+                shutil.rmtree(db_task.get_task_dirname(), ignore_errors=True)
+                db_task.delete()
+
+    @staticmethod
+    def _empty():
+        return {shape_type: [] for shape_type in columnar.SHAPE_TYPES}
+
+    def _create_task(self, size, segment_size, overlap):
+        db_task = models.Task.objects.create(name='benchmark', size=size,
+            path='', mode='interpolation', z_order=True, overlap=overlap)
+        db_task.set_task_dirname(os.path.join(settings.DATA_ROOT, str(db_task.id)))
+        os.makedirs(db_task.get_data_dirname(), exist_ok=True)
+        with open(db_task.get_image_meta_cache_path(), 'w') as meta_file:
+            meta_file.write(str({'original_size': [{'width': 1920, 'height': 1080}]}))
+
+        for start_frame in range(0, size, segment_size - overlap):
+            db_segment = models.Segment.objects.create(task=db_task,
+                start_frame=start_frame,
+                stop_frame=min(start_frame + segment_size, size) - 1)
+            models.Job.objects.create(segment=db_segment)
+
+        for name in ['car', 'person']:
+            db_label = models.Label.objects.create(task=db_task, name=name)
+            models.AttributeSpec.objects.create(label=db_label,
+                text='~radio=color:red,green,blue')
+            models.AttributeSpec.objects.create(label=db_label,
+                text='@checkbox=parked:false')
+
+        return db_task
+
+    def _generate(self, db_task, db_segment, rng, shapes_count, tracks_count):
+        db_labels = list(db_task.label_set.prefetch_related('attributespec_set'))
+        start, stop = db_segment.start_frame, db_segment.stop_frame
+
+        def attributes(db_label, mutable):
+            return [{'id': db_spec.id, 'value': rng.choice(db_spec.get_values())}
+                for db_spec in db_label.attributespec_set.all()
+                if db_spec.is_mutable() == mutable]
+
+        data = self._empty()
+        for _ in range(shapes_count):
+            db_label = rng.choice(db_labels)
+            x, y = rng.uniform(0, 1800), rng.uniform(0, 1000)
+            shape = {'label_id': db_label.id, 'group_id': 0, 'z_order': 0,
+                'frame': rng.randint(start, stop), 'occluded': False,
+                'attributes': attributes(db_label, False) + attributes(db_label, True)}
+            if rng.random() < 0.5:
+                data['boxes'].append(dict(shape, xtl=x, ytl=y, xbr=x + 100, ybr=y + 50))
+            else:
+                data['polygons'].append(dict(shape, points=' '.join(
+                    '{:.2f},{:.2f}'.format(x + rng.uniform(0, 100), y + rng.uniform(0, 100))
+                    for _ in range(8))))
+
+        for _ in range(tracks_count):
+            db_label = rng.choice(db_labels)
+            frame = rng.randint(start, stop)
+            keyframes = sorted(set(rng.randint(frame, stop) for _ in range(10)) | {frame})
+            x, y = rng.uniform(0, 1800), rng.uniform(0, 1000)
+            data['box_paths'].append({'label_id': db_label.id, 'group_id': 0,
+                'frame': frame, 'attributes': attributes(db_label, False),
+                'shapes': [{'frame': keyframe, 'occluded': False, 'z_order': 0,
+                    'outside': keyframe == keyframes[-1] and keyframe != stop,
+                    'xtl': x + idx, 'ytl': y, 'xbr': x + idx + 100, 'ybr': y + 50,
+                    'attributes': attributes(db_label, True)}
+                    for idx, keyframe in enumerate(keyframes)]})
+
+        return data
+
+    def _explain(self, db_job):
+        db_path = db_job.objectpath_set.order_by('id').first()
+        queries = [
+            ('shapes of a job by frame', models.LabeledBox.objects \
+                .filter(job_id=db_job.id).order_by('frame', 'id')),
+            ('shapes of a job by client id', models.LabeledBox.objects \
+                .filter(job_id=db_job.id, client_id__in=[1, 2, 3])),
+            ('client ids of a job', models.ObjectPath.objects \
+                .filter(job_id=db_job.id).values_list('client_id', flat=True)),
+            ('attributes of shapes of a job', models.LabeledBoxAttributeVal.objects \
+                .filter(box__job_id=db_job.id).order_by('box__frame', 'box__id', 'id')),
+            ('shapes of a track by frame', models.TrackedBox.objects \
+                .filter(track_id=db_path.id if db_path else 0).order_by('frame')),
+        ]
+        for title, queryset in queries:
+            self.stdout.write('\n{}:\n{}'.format(title, queryset.explain()))
+
+    def _measure(self, db_task, db_jobs, db_job, rng):
+        self.stdout.write('')
+        started = time.perf_counter()
+        for job in db_jobs:
+            annotation.get(job.id)
+        self._report('get (all jobs)', started)
+
+        data = annotation.get(db_job.id)
+        update, delete = self._empty(), self._empty()
+        for shape_type, objects in data.items():
+            for obj in rng.sample(objects, len(objects) // 10):
+                if rng.random() < 0.5:
+                    delete[shape_type].append(obj['id'])
+                else:
+                    if 'xtl' in obj:
+                        obj['xtl'] += 1
+                    update[shape_type].append(obj)
+        started = time.perf_counter()
+        with self._count_writes() as writes:
+            annotation.save_job(db_job.id, {'create': self._empty(),
+                'update': copy.deepcopy(update), 'delete': delete})
+        self._report('save_job (10% of a job)', started)
+        self._report_writes('updated in place', writes)
+
+        # Write amplification if the same objects are deleted and created again
+        # (with new client ids, which are assigned for id -1)
+        delete = {shape_type: [obj['id'] for obj in objects]
+            for shape_type, objects in update.items()}
+        for objects in update.values():
+            for obj in objects:
+                obj['id'] = -1
+        with self._count_writes() as writes:
+            annotation.save_job(db_job.id, {'create': update, 'update': self._empty(),
+                'delete': delete})
+        self._report_writes('deleted and created', writes)
+
+        started = time.perf_counter()
+        annotation._dump(db_task.id, annotation.FORMAT_XML, 'http', 'localhost', {})
+        self._report('dump', started)
+
+        # The dump is up to date, thus it isn't made again
+        started = time.perf_counter()
+        annotation._dump(db_task.id, annotation.FORMAT_XML, 'http', 'localhost', {})
+        self._report('dump (unchanged task)', started)
+
+        # Fragments of unchanged segments are taken from the cache
+        os.remove(db_task.get_dump_path())
+        started = time.perf_counter()
+        annotation._dump(db_task.id, annotation.FORMAT_XML, 'http', 'localhost', {})
+        self._report('dump (unchanged segments)', started)
+
+        # All segments are loaded again one by one and by the pool of threads
+        for workers in sorted({1, settings.ANNOTATION_LOAD_WORKERS}):
+            os.remove(db_task.get_dump_path())
+            caches['annotation'].delete_many(['dump/{}'.format(db_job.segment_id)
+                for db_job in db_jobs])
+            with override_settings(ANNOTATION_LOAD_WORKERS=workers):
+                started = time.perf_counter()
+                annotation._dump(db_task.id, annotation.FORMAT_XML, 'http', 'localhost', {})
+                self._report('dump ({} load workers)'.format(workers), started)
+
+    def _measure_split(self, db_task, rng, shapes_count, tracks_count):
+        # Annotations for the whole task (e.g. from auto annotation) are
+        # split by segments in save_task before they are saved by jobs
+        data = self._generate(db_task, models.Segment(start_frame=0,
+            stop_frame=db_task.size - 1), rng, shapes_count, tracks_count)
+        db_segments = list(db_task.segment_set.all())
+        started = time.perf_counter()
+        annotation._split_task_data(db_segments, {'create': data,
+            'update': self._empty(), 'delete': self._empty()})
+        self._report('split for save_task', started)
+
+    @staticmethod
+    @contextmanager
+    def _count_writes():
+        writes = {'statements': 0, 'rows': 0}
+        def count(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            if sql.lstrip().split(None, 1)[0].upper() in ['INSERT', 'UPDATE', 'DELETE']:
+                writes['statements'] += 1
+                writes['rows'] += max(context['cursor'].rowcount, 0)
+            return result
+
+        with connection.execute_wrapper(count):
+            yield writes
+
+    def _report_writes(self, title, writes):
+        self.stdout.write('  {:<22} {:8} statements {:8} rows'.format(title,
+            writes['statements'], writes['rows']))
+
+    def _report(self, title, started):
+        self.stdout.write('{:<24} {:8.3f}s'.format(title, time.perf_counter() - started))
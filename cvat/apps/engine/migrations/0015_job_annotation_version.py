@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2019-01-24 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0014_job_max_shape_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='annotation_version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
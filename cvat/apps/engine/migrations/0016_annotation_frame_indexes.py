@@ -0,0 +1,49 @@
+# Generated by Django 2.1.5 on 2019-01-28 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0015_job_annotation_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='labeledbox',
+            index=models.Index(fields=['job', 'frame'], name='engine_labe_job_id_6e7cd6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='labeledpoints',
+            index=models.Index(fields=['job', 'frame'], name='engine_labe_job_id_9ce28b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='labeledpolygon',
+            index=models.Index(fields=['job', 'frame'], name='engine_labe_job_id_2fd205_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='labeledpolyline',
+            index=models.Index(fields=['job', 'frame'], name='engine_labe_job_id_979b82_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='objectpath',
+            index=models.Index(fields=['job', 'frame'], name='engine_obje_job_id_69f512_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trackedbox',
+            index=models.Index(fields=['track', 'frame'], name='engine_trac_track_i_ea6eb1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trackedpoints',
+            index=models.Index(fields=['track', 'frame'], name='engine_trac_track_i_3d6a43_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trackedpolygon',
+            index=models.Index(fields=['track', 'frame'], name='engine_trac_track_i_d86ac5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trackedpolyline',
+            index=models.Index(fields=['track', 'frame'], name='engine_trac_track_i_a8ef1d_idx'),
+        ),
+    ]
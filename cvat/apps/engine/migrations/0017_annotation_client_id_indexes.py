@@ -0,0 +1,33 @@
+# Generated by Django 2.1.5 on 2019-01-29 14:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0016_annotation_frame_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='labeledbox',
+            index=models.Index(fields=['job', 'client_id'], name='engine_labe_job_id_d0fe4a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='labeledpoints',
+            index=models.Index(fields=['job', 'client_id'], name='engine_labe_job_id_00d9f0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='labeledpolygon',
+            index=models.Index(fields=['job', 'client_id'], name='engine_labe_job_id_42233c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='labeledpolyline',
+            index=models.Index(fields=['job', 'client_id'], name='engine_labe_job_id_f23e39_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='objectpath',
+            index=models.Index(fields=['job', 'client_id'], name='engine_obje_job_id_e82750_idx'),
+        ),
+    ]
@@ -0,0 +1,103 @@
+# Generated by Django 2.1.5 on 2019-01-31 10:18
+
+import logging
+from django.db import migrations, models
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+POLY_SHAPE_MODELS = ['labeledpolygon', 'labeledpolyline', 'labeledpoints',
+    'trackedpolygon', 'trackedpolyline', 'trackedpoints']
+
+# Number of rows which are read and updated by one query
+BATCH_SIZE = 1000
+
+def _convert_points(apps, schema_editor, model_name, src_field, dst_field, convert):
+    db_model = apps.get_model('engine', model_name)
+    query = 'UPDATE {} SET {} = %s WHERE id = %s'.format(
+        schema_editor.quote_name(db_model._meta.db_table),
+        schema_editor.quote_name(db_model._meta.get_field(dst_field).column))
+    rows = db_model.objects.values_list('id', src_field).order_by('id') \
+        .iterator(chunk_size=BATCH_SIZE)
+    with schema_editor.connection.cursor() as cursor:
+        params = []
+        for row_id, points in rows:
+            try:
+                value = convert(points)
+            except (ValueError, IndexError):
+                # The row keeps the default value of the field (no points)
+                logger.warning("points of %s #%d cannot be converted: %r",
+                    model_name, row_id, points)
+                continue
+            params.append((value, row_id))
+            if len(params) == BATCH_SIZE:
+                cursor.executemany(query, params)
+                params = []
+        if params:
+            cursor.executemany(query, params)
+
+def pack_points(apps, schema_editor):
+    def convert(points):
+        if not points.strip():
+            return b''
+        # Text which isn't a list of pairs "x,y" is read point by point as
+        # the engine reads points from clients: extra values of a point are
+        # ignored and a point with a single value is invalid.
+        values = points.replace(' ', ',').split(',')
+        if len(values) != 2 * (points.count(' ') + 1):
+            values = []
+            for point in points.split(' '):
+                point = point.split(',')
+                values.extend([point[0], point[1]])
+        return np.array(values, dtype='<f4').tobytes()
+
+    for model_name in POLY_SHAPE_MODELS:
+        _convert_points(apps, schema_editor, model_name, 'points', 'packed_points', convert)
+
+def unpack_points(apps, schema_editor):
+    def convert(data):
+        points = np.frombuffer(data, dtype='<f4').reshape(-1, 2)
+        return ' '.join(map(','.join, points.astype(str)))
+
+    for model_name in POLY_SHAPE_MODELS:
+        _convert_points(apps, schema_editor, model_name, 'packed_points', 'points', convert)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0017_annotation_client_id_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name=model_name,
+            name='packed_points',
+            field=models.BinaryField(default=b''),
+        ) for model_name in POLY_SHAPE_MODELS
+    ] + [
+        migrations.RunPython(pack_points, unpack_points),
+    ] + [
+        # The default is needed to restore the field on a backward migration
+        migrations.AlterField(
+            model_name=model_name,
+            name='points',
+            field=models.TextField(default=''),
+        ) for model_name in POLY_SHAPE_MODELS
+    ] + [
+        migrations.RemoveField(
+            model_name=model_name,
+            name='points',
+        ) for model_name in POLY_SHAPE_MODELS
+    ] + [
+        migrations.RenameField(
+            model_name=model_name,
+            old_name='packed_points',
+            new_name='points',
+        ) for model_name in POLY_SHAPE_MODELS
+    ] + [
+        migrations.AlterField(
+            model_name=model_name,
+            name='points',
+            field=models.BinaryField(),
+        ) for model_name in POLY_SHAPE_MODELS
+    ]
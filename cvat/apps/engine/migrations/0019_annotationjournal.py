@@ -0,0 +1,25 @@
+# Generated by Django 2.1.5 on 2019-02-04 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0018_polyshape_packed_points'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationJournal',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('data', models.TextField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='engine.Job')),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2019-02-11 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('engine', '0019_annotationjournal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotationjournal',
+            name='rejected',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -64,13 +64,13 @@ class Task(models.Model):
 
     def get_dump_path(self):
         name = re.sub(r'[\\/*?:"<>|]', '_', self.name)
-        return os.path.join(self.path, "{}.xml".format(name))
+        return os.path.join(self.path, "{}.xml.gz".format(name))
 
     def get_log_path(self):
         return os.path.join(self.path, "task.log")
 
     def get_client_log_path(self):
-        return os.path.join(self.path, "client.log")
+        return os.path.join(self.path, "client.log.gz")
 
     def get_image_meta_cache_path(self):
         return os.path.join(self.path, "image_meta.cache")
@@ -98,6 +98,20 @@ class Job(models.Model):
     assignee = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
     status = models.CharField(max_length=32, default=StatusChoice.ANNOTATION)
     max_shape_id = models.BigIntegerField(default=-1)
+    annotation_version = models.BigIntegerField(default=0)
+
+    class Meta:
+        default_permissions = ()
+
+class AnnotationJournal(models.Model):
+    # Saves of annotations for the job (the validated data for save_job in
+    # JSON) which haven't been compacted into the annotation tables yet
+    id = models.BigAutoField(primary_key=True)
+    job = models.ForeignKey(Job, on_delete=models.CASCADE)
+    data = models.TextField()
+    # The save cannot be applied (see compact_journal). It is kept for
+    # the administrator but it isn't applied anymore.
+    rejected = models.BooleanField(default=False)
 
     class Meta:
         default_permissions = ()
@@ -133,7 +147,15 @@ class AttributeSpec(models.Model):
         default_permissions = ()
 
     def get_attribute(self):
-        return parse_attribute(self.text)
+        # Methods below are called for every attribute value of every shape
+        # when annotations are loaded, saved or dumped. Thus the text is
+        # parsed only once and again only if it has been changed.
+        cached = self.__dict__.get('_parsed_attribute')
+        if cached is None or cached[0] != self.text:
+            cached = (self.text, parse_attribute(self.text))
+            self._parsed_attribute = cached
+
+        return cached[1]
 
     def is_mutable(self):
         attr = self.get_attribute()
@@ -179,6 +201,10 @@ class Annotation(models.Model):
 
     class Meta:
         abstract = True
+        indexes = [
+            models.Index(fields=['job', 'frame']),
+            models.Index(fields=['job', 'client_id']),
+        ]
 
 class Shape(models.Model):
     occluded = models.BooleanField(default=False)
@@ -201,7 +227,8 @@ class BoundingBox(Shape):
 
 class PolyShape(Shape):
     id = models.BigAutoField(primary_key=True)
-    points = models.TextField()
+    # Packed little-endian float32 pairs (x, y)
+    points = models.BinaryField()
 
     class Meta:
         abstract = True
@@ -245,6 +272,7 @@ class TrackedObject(models.Model):
     class Meta:
         abstract = True
         default_permissions = ()
+        indexes = [models.Index(fields=['track', 'frame'])]
 
 class TrackedBox(TrackedObject, BoundingBox):
     pass
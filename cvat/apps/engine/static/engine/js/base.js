@@ -112,7 +112,12 @@ function dumpAnnotationRequest(dumpButton, taskID) {
         error: onDumpRequestError,
     });
 
-    function onDumpRequestSuccess() {
+    function onDumpRequestSuccess(data) {
+        if (data.state === 'created') {
+            getDumpedFile();
+            return;
+        }
+
         let requestInterval = 3000;
         let requestSended = false;
 
@@ -120,7 +125,7 @@ function dumpAnnotationRequest(dumpButton, taskID) {
             if (requestSended) return;
             requestSended = true;
             $.ajax({
-                url: '/check/annotation/task/' + taskID,
+                url: '/check/annotation/task/' + taskID + '/' + data.ticket,
                 success: onDumpCheckSuccess,
                 error: onDumpCheckError,
                 complete: () => requestSended = false,
@@ -139,21 +144,6 @@ function dumpAnnotationRequest(dumpButton, taskID) {
                 showMessage(message);
                 throw Error(message);
             }
-
-            function getDumpedFile() {
-                $.ajax({
-                    url: '/download/annotation/task/' + taskID,
-                    error: onGetDumpError,
-                    success: () => window.location = '/download/annotation/task/' + taskID,
-                    complete: () => dumpButton.attr('disabled', false)
-                });
-
-                function onGetDumpError(response) {
-                    let message = 'Get the dump request error: ' + response.responseText;
-                    showMessage(message);
-                    throw Error(message);
-                }
-            }
         }
 
         function onDumpCheckError(response) {
@@ -165,6 +155,21 @@ function dumpAnnotationRequest(dumpButton, taskID) {
         }
     }
 
+    function getDumpedFile() {
+        $.ajax({
+            url: '/download/annotation/task/' + taskID,
+            error: onGetDumpError,
+            success: () => window.location = '/download/annotation/task/' + taskID,
+            complete: () => dumpButton.attr('disabled', false)
+        });
+
+        function onGetDumpError(response) {
+            let message = 'Get the dump request error: ' + response.responseText;
+            showMessage(message);
+            throw Error(message);
+        }
+    }
+
     function onDumpRequestError(response) {
         let message = "Dump request error: " + response.responseText;
         dumpButton.attr('disabled', false);
@@ -1,9 +1,470 @@
-
 # Copyright (C) 2018 Intel Corporation
 #
 # SPDX-License-Identifier: MIT
 
-from django.test import TestCase
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+
+from cvat.apps.engine import annotation, models
+
+def create_task(size, segment_size, overlap=0, flipped=False):
+    # Ids of rows are reused after rollbacks of tests, thus cached
+    # annotations for them are removed
+    caches['annotation'].clear()
+    db_task = models.Task.objects.create(name='test', size=size, path='',
+        mode='interpolation', overlap=overlap, flipped=flipped)
+    db_task.set_task_dirname(tempfile.mkdtemp())
+    db_task.save()
+    with open(db_task.get_image_meta_cache_path(), 'w') as meta_file:
+        meta_file.write(str({'original_size': [{'width': 1920, 'height': 1080}]}))
+    for start_frame in range(0, size, segment_size - overlap):
+        db_segment = models.Segment.objects.create(task=db_task,
+            start_frame=start_frame,
+            stop_frame=min(start_frame + segment_size, size) - 1)
+        models.Job.objects.create(segment=db_segment)
+    db_label = models.Label.objects.create(task=db_task, name='car')
+    models.AttributeSpec.objects.create(label=db_label, text='~number=speed:0,10000,1')
+
+    return db_task
+
+def empty_data():
+    return {shape_type: [] for shape_type in ['boxes', 'box_paths', 'polygons',
+        'polygon_paths', 'polylines', 'polyline_paths', 'points', 'points_paths']}
+
+class BulkCreateTest(TestCase):
+    """
+    Ids of rows created by one query are selected back by their keys on
+    databases other than PostgreSQL. Batches are larger than 999 rows,
+    the limit of parameters of a query on SQLite.
+    """
+    def setUp(self):
+        self.db_task = create_task(size=2000, segment_size=2000)
+        self.db_job = models.Job.objects.get(segment__task=self.db_task)
+        self.db_label = self.db_task.label_set.get()
+        self.db_spec = self.db_label.attributespec_set.get()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_task.get_task_dirname(), ignore_errors=True)
+
+    def assertIdsOfRows(self, db_model, objects, key_fields):
+        rows = dict(((db_id, tuple(key)) for db_id, *key in
+            db_model.objects.values_list('id', *key_fields)))
+        self.assertEqual([rows[obj.id] for obj in objects],
+            [tuple(getattr(obj, field) for field in key_fields) for obj in objects])
+
+    def test_shapes(self):
+        # Rows of another job with the same client ids are ignored
+        db_other_job = models.Job.objects.create(segment=self.db_job.segment)
+        for db_job in [db_other_job, self.db_job]:
+            db_shapes = [models.LabeledBox(job=db_job, label=self.db_label,
+                client_id=client_id, frame=client_id, group_id=0, occluded=False,
+                z_order=0, xtl=0, ytl=0, xbr=1, ybr=1) for client_id in range(1500, 0, -1)]
+            db_shapes = annotation.bulk_create(models.LabeledBox, db_shapes,
+                {'job_id': db_job.id}, ['client_id'])
+        self.assertEqual(len(set(db_shape.id for db_shape in db_shapes)), 1500)
+        self.assertIdsOfRows(models.LabeledBox, db_shapes, ['job_id', 'client_id'])
+
+    def test_paths(self):
+        db_paths = [models.ObjectPath(job=self.db_job, label=self.db_label,
+            client_id=client_id, frame=0, group_id=0, shapes='boxes')
+            for client_id in range(1200, 0, -1)]
+        db_paths = annotation.bulk_create(models.ObjectPath, db_paths,
+            {'job_id': self.db_job.id}, ['client_id'])
+        self.assertIdsOfRows(models.ObjectPath, db_paths, ['client_id'])
+
+    def test_path_shapes(self):
+        db_paths = annotation.bulk_create(models.ObjectPath,
+            [models.ObjectPath(job=self.db_job, label=self.db_label, client_id=client_id,
+            frame=0, group_id=0, shapes='boxes') for client_id in range(3)],
+            {'job_id': self.db_job.id}, ['client_id'])
+        db_shapes = [models.TrackedBox(track=db_path, frame=frame, occluded=False,
+            z_order=0, outside=False, xtl=0, ytl=0, xbr=1, ybr=1)
+            for frame in range(500, 0, -1) for db_path in db_paths]
+        db_shapes = annotation.bulk_create(models.TrackedBox, db_shapes,
+            {}, ['track_id', 'frame'])
+        self.assertIdsOfRows(models.TrackedBox, db_shapes, ['track_id', 'frame'])
+
+    def test_attributes(self):
+        # Attributes are created by ids of their shapes, paths and path shapes
+        data = empty_data()
+        for client_id in range(1100):
+            data['boxes'].append({'id': client_id, 'label_id': self.db_label.id,
+                'group_id': 0, 'frame': client_id, 'occluded': False, 'z_order': 0,
+                'xtl': 0, 'ytl': 0, 'xbr': 1, 'ybr': 1,
+                'attributes': [{'id': self.db_spec.id, 'value': client_id}]})
+            data['box_paths'].append({'id': 1100 + client_id, 'label_id': self.db_label.id,
+                'group_id': 0, 'frame': client_id, 'attributes': [],
+                'shapes': [{'frame': client_id + frame, 'occluded': False, 'z_order': 0,
+                    'outside': frame == 1, 'xtl': 0, 'ytl': 0, 'xbr': 1, 'ybr': 1,
+                    'attributes': [{'id': self.db_spec.id, 'value': client_id + frame}]}
+                    for frame in range(2)]})
+        annotation.save_job(self.db_job.id, {'create': data,
+            'update': empty_data(), 'delete': empty_data()})
+
+        data = annotation.get(self.db_job.id)
+        self.assertEqual(len(data['boxes']), 1100)
+        for box in data['boxes']:
+            self.assertEqual([attr['value'] for attr in box['attributes']],
+                [str(box['id'])])
+        self.assertEqual(len(data['box_paths']), 1100)
+        for path in data['box_paths']:
+            for shape in path['shapes']:
+                self.assertEqual([attr['value'] for attr in shape['attributes']],
+                    [str(shape['frame'])])
+
+class InitFromClientTest(TestCase):
+    """
+    Shapes from the client are converted as columns, but invalid values
+    raise the same errors as the conversion of shapes one by one did.
+    """
+    def setUp(self):
+        self.db_task = create_task(size=10, segment_size=10)
+        self.db_job = models.Job.objects.get(segment__task=self.db_task)
+        self.db_label = self.db_task.label_set.get()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_task.get_task_dirname(), ignore_errors=True)
+
+    def _init_from_client(self, shape_type, **fields):
+        shape = {'id': 0, 'label_id': self.db_label.id, 'group_id': 0,
+            'frame': 0, 'occluded': False, 'z_order': 0, 'attributes': []}
+        shape.update(fields)
+        data = empty_data()
+        data[shape_type].append(shape)
+        job_annotation = annotation._AnnotationForJob(self.db_job)
+        job_annotation.init_from_client(data)
+        return getattr(job_annotation, shape_type)[0]
+
+    def assertError(self, exc_type, message, shape_type, **fields):
+        with self.assertRaises(exc_type) as context:
+            self._init_from_client(shape_type, **fields)
+        self.assertEqual(str(context.exception), message)
+
+    def test_points(self):
+        self.assertError(IndexError, 'list index out of range', 'polygons',
+            points='1,2 3')
+        self.assertError(IndexError, 'list index out of range', 'polylines',
+            points='1,2 3,4 5')
+        self.assertError(ValueError, "could not convert string to float: 'a'",
+            'points', points='1,a 3')
+        self.assertError(ValueError, "could not convert string to float: ''",
+            'polygons', points='1, 3,4')
+        # Extra values of a point are ignored
+        shape = self._init_from_client('polygons', points='1,2,3 4,5')
+        self.assertEqual(shape.points.tolist(), [[1, 2], [4, 5]])
+        shape = self._init_from_client('polygons', points='1,2,,3')
+        self.assertEqual(shape.points.tolist(), [[1, 2]])
+
+    def test_bools(self):
+        self.assertError(ValueError, "invalid truth value 'maybe'", 'boxes',
+            occluded='maybe', xtl=0, ytl=0, xbr=1, ybr=1)
+        # The occluded property of poly shapes is converted only by the model
+        shape = self._init_from_client('polygons', points='1,2 3,4', occluded='maybe')
+        self.assertEqual(shape.occluded, 'maybe')
+
+    def test_frames(self):
+        self.assertError(ValueError, "invalid literal for int() with base 10: 'x'",
+            'boxes', frame='x', xtl=0, ytl=0, xbr=1, ybr=1)
+        self.assertError(ValueError, "could not convert string to float: 'x'",
+            'boxes', xtl='x', ytl=0, xbr=1, ybr=1)
+
+class SerializedCacheTest(TestCase):
+    def setUp(self):
+        self.db_task = create_task(size=10, segment_size=10)
+        self.db_job = models.Job.objects.get(segment__task=self.db_task)
+        self.db_label = self.db_task.label_set.get()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_task.get_task_dirname(), ignore_errors=True)
+
+    def _get_serialized(self):
+        return json.loads(gzip.decompress(b''.join(
+            annotation.get_serialized(self.db_job.id))).decode('utf-8'))
+
+    def test_deleted_labels(self):
+        # Annotations are deleted by the cascade, the version isn't changed
+        db_spec = self.db_label.attributespec_set.get()
+        data = empty_data()
+        data['boxes'].append({'id': 0, 'label_id': self.db_label.id,
+            'group_id': 0, 'frame': 0, 'occluded': False, 'z_order': 0,
+            'xtl': 0, 'ytl': 0, 'xbr': 1, 'ybr': 1,
+            'attributes': [{'id': db_spec.id, 'value': 5}]})
+        annotation.save_job(self.db_job.id, {'create': data,
+            'update': empty_data(), 'delete': empty_data()})
+        self.assertEqual(len(self._get_serialized()['boxes'][0]['attributes']), 1)
+
+        db_spec.delete()
+        self.assertEqual(self._get_serialized()['boxes'][0]['attributes'], [])
+        self.db_label.delete()
+        self.assertEqual(self._get_serialized()['boxes'], [])
+
+class DumpInterpolationTest(TestCase):
+    """
+    Dumps of tracks are compared with dumps made by the implementation
+    which interpolated tracks shape by shape (test_data/*.xml).
+    """
+    def _create_task(self, flipped):
+        db_task = create_task(size=40, segment_size=20, overlap=5, flipped=flipped)
+        self.addCleanup(shutil.rmtree, db_task.get_task_dirname(), ignore_errors=True)
+        db_label = db_task.label_set.get()
+        db_speed = db_label.attributespec_set.get()
+        db_type = models.AttributeSpec.objects.create(label=db_label,
+            text="@select=type:car,'truck','bus'")
+
+        def box(frame, xtl, ytl, xbr, ybr, outside=False, occluded=False, speed=None):
+            return {'frame': frame, 'xtl': xtl, 'ytl': ytl, 'xbr': xbr, 'ybr': ybr,
+                'outside': outside, 'occluded': occluded, 'z_order': 0,
+                'attributes': [] if speed is None else [{'id': db_speed.id, 'value': speed}]}
+
+        def poly(frame, points, outside=False, occluded=False, speed=None):
+            return {'frame': frame, 'points': points, 'outside': outside,
+                'occluded': occluded, 'z_order': 0,
+                'attributes': [] if speed is None else [{'id': db_speed.id, 'value': speed}]}
+
+        def track(client_id, shapes, group_id=0, kind='truck'):
+            return {'id': client_id, 'label_id': db_label.id, 'group_id': group_id,
+                'frame': shapes[0]['frame'], 'shapes': shapes,
+                'attributes': [{'id': db_type.id, 'value': kind}]}
+
+        data = empty_data()
+        data['box_paths'] = [
+            # Through all segments: outside in the middle, attribute changes,
+            # adjacent keyframes and a keyframe on the last frame
+            track(0, [box(0, 10, 20, 110, 220, speed=5), box(7, 30.5, 20, 140, 260),
+                box(8, 31, 21, 141, 261, occluded=True, speed=7),
+                box(16, 60, 60, 160, 160, outside=True), box(19, 70, 70, 170, 170),
+                box(33, 1900, 1000, 2000, 1100, speed=9), box(39, 0, 0, 1919, 1079)]),
+            # Inside of the overlap of the first and the second segments
+            track(1, [box(15, 100, 100, 200, 200, speed=1), box(17, 110, 100, 210, 200),
+                box(19, 110, 100, 210, 200, outside=True)], group_id=1),
+            # Starts with an outside keyframe
+            track(2, [box(3, 5, 5, 15, 15, outside=True), box(5, 5, 5, 15, 15),
+                box(12, 25, 5, 35, 15, outside=True)], kind='car'),
+            # A single keyframe on the first and on the last frame
+            track(3, [box(0, 1, 2, 3, 4)]),
+            track(4, [box(39, 1, 2, 3, 4, speed=3)], kind='bus'),
+        ]
+        data['polygon_paths'] = [
+            track(5, [poly(0, '10,10 20,10 20,20', speed=2),
+                poly(4, '14,10 24,10 24,20.5', occluded=True),
+                poly(9, '30,30 40,30 40,40', outside=True),
+                poly(18, '1,1 2,2 3,1', speed=4), poly(36, '5,5 6,6 7,5')]),
+        ]
+        data['polyline_paths'] = [
+            track(6, [poly(2, '0,0 100,100'), poly(3, '0,0 100,110', speed=1),
+                poly(20, '50,50 60,60', outside=True)], group_id=1),
+        ]
+        data['points_paths'] = [
+            track(7, [poly(16, '1,1', speed=0), poly(17, '2,2'), poly(39, '3,3', speed=8)]),
+        ]
+        # Shapes are dumped as tracks of two frames
+        client_id = 10
+        for shape_type, points in [('boxes', None), ('polygons', '1,2 3,4 5,1'),
+            ('polylines', '7,8 9,10'), ('points', '11,12')]:
+            for frame in [0, 16, 33, 39]:
+                shape = box(frame, 1, 2, 30, 40) if points is None else poly(frame, points)
+                del shape['outside']
+                shape.update({'id': client_id, 'label_id': db_label.id, 'group_id': 0})
+                data[shape_type].append(shape)
+                client_id += 1
+        annotation.save_task(db_task.id, {'create': data,
+            'update': empty_data(), 'delete': empty_data()})
+
+        return db_task
+
+    def _get_tracks(self, db_task):
+        dump = gzip.decompress(b''.join(annotation.get_dump(db_task.id,
+            'http', 'localhost'))).decode('utf-8')
+        return dump[dump.index('</meta>') + len('</meta>'):]
+
+    def _get_expected(self, name):
+        path = os.path.join(os.path.dirname(__file__), 'test_data', name)
+        with open(path, encoding='utf-8') as dump_file:
+            return dump_file.read()
+
+    def test_dump(self):
+        self.assertEqual(self._get_tracks(self._create_task(flipped=False)),
+            self._get_expected('dump_interpolation.xml'))
+
+    def test_dump_flipped(self):
+        self.assertEqual(self._get_tracks(self._create_task(flipped=True)),
+            self._get_expected('dump_interpolation_flipped.xml'))
+
+class DumpMergeTest(TestCase):
+    """
+    Boxes and tracks of overlapping segments are merged as before: dumps
+    are compared with dumps made by the implementation which built the
+    whole cost matrix for each frame and for tracks (test_data/*.xml).
+    """
+    def setUp(self):
+        self.db_task = create_task(size=30, segment_size=20, overlap=10)
+        self.db_label = self.db_task.label_set.get()
+        self.db_other_label = models.Label.objects.create(task=self.db_task, name='person')
+        self.db_jobs = list(models.Job.objects.filter(segment__task=self.db_task) \
+            .order_by('segment__start_frame'))
+
+    def tearDown(self):
+        shutil.rmtree(self.db_task.get_task_dirname(), ignore_errors=True)
+
+    def _save(self, db_job, data):
+        client_id = 0
+        for objects in data.values():
+            for obj in objects:
+                obj['id'] = client_id
+                client_id += 1
+        annotation.save_job(db_job.id, {'create': data,
+            'update': empty_data(), 'delete': empty_data()})
+
+    def _box(self, frame, xtl, ytl, xbr, ybr, db_label=None):
+        return {'label_id': (db_label or self.db_label).id, 'group_id': 0,
+            'frame': frame, 'occluded': False, 'z_order': 0, 'attributes': [],
+            'xtl': xtl, 'ytl': ytl, 'xbr': xbr, 'ybr': ybr}
+
+    def _track(self, boxes):
+        shapes = [dict(self._box(frame, *coords), outside=outside)
+            for frame, coords, outside in boxes]
+        return {'label_id': self.db_label.id, 'group_id': 0,
+            'frame': shapes[0]['frame'], 'attributes': [], 'shapes': shapes}
+
+    def _get_tracks(self):
+        dump = gzip.decompress(b''.join(annotation.get_dump(self.db_task.id,
+            'http', 'localhost'))).decode('utf-8')
+        return dump[dump.index('</meta>') + len('</meta>'):]
+
+    def _get_expected(self, name):
+        path = os.path.join(os.path.dirname(__file__), 'test_data', name)
+        with open(path, encoding='utf-8') as dump_file:
+            return dump_file.read()
+
+    def test_boxes(self):
+        data0, data1 = empty_data(), empty_data()
+        # A crowded frame: each box overlaps with its neighbours
+        for i in range(8):
+            for j in range(8):
+                data0['boxes'].append(self._box(15, 20 * i, 20 * j, 20 * i + 30, 20 * j + 30))
+                if (8 * i + j) % 7:
+                    shift = (i + j) % 3
+                    data1['boxes'].append(self._box(15, 20 * i + shift, 20 * j,
+                        20 * i + shift + 30, 20 * j + 30))
+                if (8 * i + j) % 9 == 0:
+                    data1['boxes'].append(self._box(15, 20 * i, 20 * j, 20 * i + 30, 20 * j + 30))
+        # Equal costs: the same boxes twice and a box between two boxes
+        for data in [data0, data1]:
+            data['boxes'].extend(self._box(12, 100, 100, 200, 200) for _ in range(2))
+        data0['boxes'].extend([self._box(12, 300, 100, 400, 200),
+            self._box(12, 310, 100, 410, 200)])
+        data1['boxes'].append(self._box(12, 305, 100, 405, 200))
+        # Equal costs of two boxes for one box which has other candidates
+        data0['boxes'].extend([self._box(13, 20, 10, 40, 30), self._box(13, 0, 0, 20, 20)])
+        data1['boxes'].extend(self._box(13, 0, 0, 20, 20) for _ in range(2))
+        data1['boxes'].append(self._box(13, 0, 10, 20, 30))
+        # Zero area boxes
+        data0['boxes'].extend([self._box(14, 50, 50, 50, 80),
+            self._box(14, 40, 40, 90, 90)])
+        data1['boxes'].extend([self._box(14, 41, 40, 91, 90),
+            self._box(14, 50, 50, 50, 80, self.db_other_label)])
+        self._save(self.db_jobs[0], data0)
+        self._save(self.db_jobs[1], data1)
+
+        self.assertEqual(self._get_tracks(), self._get_expected('dump_merged_boxes.xml'))
+
+    def test_tracks(self):
+        data0, data1 = empty_data(), empty_data()
+        # Each track overlaps with its neighbours in the overlap
+        for k in range(10):
+            data0['box_paths'].append(self._track([(0, (20 * k, 0, 20 * k + 30, 30), False),
+                (19, (20 * k + 5, 0, 20 * k + 35, 30), False)]))
+            if k % 4:
+                data1['box_paths'].append(self._track([(10, (20 * k + 3, 0, 20 * k + 33, 30), False),
+                    (29, (20 * k, 5, 20 * k + 30, 35), False)]))
+        # Equal costs: the same tracks twice
+        for data in [data0, data1]:
+            data['box_paths'].extend(self._track([(10, (500, 500, 600, 600), False),
+                (19, (510, 500, 610, 600), False)]) for _ in range(2))
+        # Tracks which are outside in the overlap, end before it or start
+        # after it
+        data0['box_paths'].extend([
+            self._track([(0, (300, 300, 400, 400), False), (10, (300, 300, 400, 400), True)]),
+            self._track([(0, (300, 300, 400, 400), False), (5, (300, 300, 400, 400), True)])])
+        data1['box_paths'].extend([
+            self._track([(10, (300, 300, 400, 400), True), (12, (302, 300, 402, 400), False)]),
+            self._track([(25, (300, 300, 400, 400), False)])])
+        self._save(self.db_jobs[0], data0)
+        self._save(self.db_jobs[1], data1)
+
+        self.assertEqual(self._get_tracks(), self._get_expected('dump_merged_tracks.xml'))
+
+    def test_zero_area_boxes(self):
+        # Such boxes of the same label cannot be merged (the implementation
+        # before raised ZeroDivisionError)
+        data = empty_data()
+        data['boxes'].append(self._box(12, 50, 50, 50, 80))
+        self._save(self.db_jobs[0], data)
+        self._save(self.db_jobs[1], data)
+        self.assertEqual(self._get_tracks().count('<track '), 2)
+
+class ConcurrentGetTest(TransactionTestCase):
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('in-memory SQLite locks tables for readers of other connections')
+        self.db_task = create_task(size=100, segment_size=100)
+        self.db_job = models.Job.objects.get(segment__task=self.db_task)
+        self.db_label = self.db_task.label_set.get()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_task.get_task_dirname(), ignore_errors=True)
+
+    def _save_boxes(self, client_ids):
+        data = empty_data()
+        data['boxes'] = [{'id': client_id, 'label_id': self.db_label.id,
+            'group_id': 0, 'frame': 0, 'occluded': False, 'z_order': 0,
+            'xtl': 0, 'ytl': 0, 'xbr': 1, 'ybr': 1, 'attributes': []}
+            for client_id in client_ids]
+        annotation.save_job(self.db_job.id, {'create': data,
+            'update': empty_data(), 'delete': empty_data()})
+
+    def test_get_during_save(self):
+        self._save_boxes([0])
+        saved = threading.Event()
+        finish = threading.Event()
+        errors = []
+
+        def save():
+            try:
+                # The transaction of save_job (and the lock of the job) is
+                # held until the reader is done
+                with transaction.atomic():
+                    self._save_boxes([1])
+                    saved.set()
+                    finish.wait(30)
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                saved.set()
+                connection.close()
 
-# Create your tests here.
+        writer = threading.Thread(target=save)
+        writer.start()
+        try:
+            self.assertTrue(saved.wait(30))
+            started = time.perf_counter()
+            data = annotation.get(self.db_job.id)
+            self.assertLess(time.perf_counter() - started, 5)
+            # The reader isn't blocked and doesn't see the uncommitted save
+            self.assertEqual([box['id'] for box in data['boxes']], [0])
+        finally:
+            finish.set()
+            writer.join()
+        self.assertEqual(errors, [])
 
+        data = annotation.get(self.db_job.id)
+        self.assertEqual(sorted(box['id'] for box in data['boxes']), [0, 1])
@@ -17,8 +17,11 @@ urlpatterns = [
     path('get/task/<int:tid>', views.get_task),
     path('dump/annotation/task/<int:tid>', views.dump_annotation),
     path('check/annotation/task/<int:tid>', views.check_annotation),
+    path('check/annotation/task/<int:tid>/<str:ticket>', views.check_annotation),
     path('download/annotation/task/<int:tid>', views.download_annotation),
+    path('stream/annotation/task/<int:tid>', views.stream_annotation),
     path('save/annotation/job/<int:jid>', views.save_annotation_for_job),
+    path('check/annotation/job/<int:jid>/<str:key>', views.check_annotation_for_job),
     path('save/annotation/task/<int:tid>', views.save_annotation_for_task),
     path('delete/annotation/task/<int:tid>', views.delete_annotation_for_task),
     path('get/annotation/job/<int:jid>', views.get_annotation),
@@ -4,17 +4,25 @@
 # SPDX-License-Identifier: MIT
 
 import os
+import re
+import time
+import uuid
+import zlib
 import json
 import traceback
 
-from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.conf import settings
 from rules.contrib.views import permission_required, objectgetter
 from django.views.decorators.gzip import gzip_page
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
 from sendfile import sendfile
+import django_rq
+from rq.registry import StartedJobRegistry
 
-from . import annotation, task, models
+from . import annotation, task, models, columnar
 from cvat.settings.base import JS_3RDPARTY, CSS_3RDPARTY
 from cvat.apps.authentication.decorators import login_required
 from requests.exceptions import RequestException
@@ -28,8 +36,7 @@ from cvat.apps.engine.models import StatusChoice
     fn=objectgetter(models.Job, 'jid'), raise_exception=True)
 def catch_client_exception(request, jid):
     data = json.loads(request.body.decode('utf-8'))
-    for event in data['exceptions']:
-        clogger.job[jid].error(json.dumps(event))
+    clogger.job[jid].error(data['exceptions'])
 
     return HttpResponse()
 
@@ -196,21 +203,31 @@ def get_job(request, jid):
 def dump_annotation(request, tid):
     try:
         slogger.task[tid].info("dump annotation request")
-        annotation.dump(tid, annotation.FORMAT_XML, request.scheme, request.get_host())
+        ticket = annotation.dump(tid, annotation.FORMAT_XML, request.scheme, request.get_host())
+        # The dump can be ready already if the task hasn't been changed
+        response = annotation.check(tid, ticket)
     except Exception as e:
         slogger.task[tid].error("cannot dump annotation", exc_info=True)
         return HttpResponseBadRequest(str(e))
 
-    return HttpResponse()
+    return JsonResponse(response)
 
 @login_required
 @gzip_page
 @permission_required(perm=['engine.task.access'],
     fn=objectgetter(models.Task, 'tid'), raise_exception=True)
-def check_annotation(request, tid):
+def check_annotation(request, tid, ticket=None):
     try:
         slogger.task[tid].info("check annotation")
-        response = annotation.check(tid)
+        # The ticket is computed once by the dump request, thus a check
+        # doesn't read the task or run plugins
+        if ticket is None:
+            # Clients without the ticket check the last dump request
+            ticket = annotation.get_last_dump_ticket(tid, annotation.FORMAT_XML,
+                request.scheme, request.get_host())
+        elif not re.match(r'^[0-9a-f]{40}$', ticket):
+            raise Exception('Invalid ticket: {}'.format(ticket))
+        response = annotation.check(tid, ticket)
     except Exception as e:
         slogger.task[tid].error("cannot check annotation", exc_info=True)
         return HttpResponseBadRequest(str(e))
@@ -218,36 +235,212 @@ def check_annotation(request, tid):
     return JsonResponse(response)
 
 
+def _get_dump_filename(db_task):
+    return '{}_{}.xml'.format(db_task.id, db_task.name)
+
+def _read_chunks(file, chunk_size=256 * 1024):
+    with file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            yield chunk
+
 @login_required
-@gzip_page
 @permission_required(perm=['engine.task.access'],
     fn=objectgetter(models.Task, 'tid'), raise_exception=True)
 def download_annotation(request, tid):
     try:
         slogger.task[tid].info("get dumped annotation")
         db_task = models.Task.objects.get(pk=tid)
-        response = sendfile(request, db_task.get_dump_path(), attachment=True,
-            attachment_filename='{}_{}.xml'.format(db_task.id, db_task.name))
+        dump_path = db_task.get_dump_path()
+        if re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            # The dump is stored compressed and is sent as is
+            response = sendfile(request, dump_path, attachment=True,
+                attachment_filename=_get_dump_filename(db_task),
+                mimetype='application/xml', encoding='gzip')
+            patch_vary_headers(response, ('Accept-Encoding',))
+        else:
+            response = _gzipped_response(request,
+                _read_chunks(open(dump_path, 'rb')), 'application/xml')
+            response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+                _get_dump_filename(db_task).replace('"', '_'))
     except Exception as e:
         slogger.task[tid].error("cannot get dumped annotation", exc_info=True)
         return HttpResponseBadRequest(str(e))
 
     return response
 
+@login_required
+@permission_required(perm=['engine.task.access'],
+    fn=objectgetter(models.Task, 'tid'), raise_exception=True)
+def stream_annotation(request, tid):
+    """Dump annotation for the task directly into the response"""
+    try:
+        slogger.task[tid].info("stream annotation request")
+        db_task = models.Task.objects.get(pk=tid)
+        chunks = annotation.get_dump(tid, request.scheme, request.get_host())
+        # Errors which happen before the first chunk are reported as usual
+        first_chunk = next(chunks)
+    except Exception as e:
+        slogger.task[tid].error("cannot stream annotation", exc_info=True)
+        return HttpResponseBadRequest(str(e))
+
+    def iter_chunks():
+        # The response closes the generator (and the dump) if the client
+        # goes away
+        yield first_chunk
+        yield from chunks
+
+    response = _gzipped_response(request, iter_chunks(), 'application/xml')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        _get_dump_filename(db_task).replace('"', '_'))
+
+    return response
+
+
+def _get_request_body(request):
+    """Get the body of the request and decompress it if it is gzipped"""
+    if request.META.get('HTTP_CONTENT_ENCODING', '') == 'gzip':
+        # Limit the size of decompressed data to protect the server
+        # against "zip bombs"
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = decompressor.decompress(request.body,
+            settings.DATA_UPLOAD_MAX_DECOMPRESSED_SIZE)
+        if decompressor.unconsumed_tail:
+            raise Exception('Too big request body after decompression')
+        return body
+
+    return request.body
+
+def _gunzip_chunks(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+def _gzipped_response(request, chunks, content_type):
+    """Stream already compressed data or decompress it for old clients"""
+    if re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = StreamingHttpResponse(_gunzip_chunks(chunks), content_type=content_type)
+    patch_vary_headers(response, ('Accept-Encoding',))
+
+    return response
 
 @login_required
-@gzip_page
 @permission_required(perm=['engine.job.access'],
     fn=objectgetter(models.Job, 'jid'), raise_exception=True)
 def get_annotation(request, jid):
     try:
         slogger.job[jid].info("get annotation for {} job".format(jid))
-        response = annotation.get(jid)
+        # Optional range of frames: ?start=<first frame>&stop=<last frame>
+        frames = None
+        if 'start' in request.GET or 'stop' in request.GET:
+            frames = (int(request.GET.get('start', 0)),
+                int(request.GET.get('stop', 2 ** 31 - 1)))
+            if frames[0] > frames[1]:
+                raise Exception('Invalid range of frames: {}-{}'.format(*frames))
+        if columnar.CONTENT_TYPE in request.META.get('HTTP_ACCEPT', ''):
+            content_type = columnar.CONTENT_TYPE
+            chunks = annotation.get_serialized(jid, annotation.FORMAT_COLUMNAR_JSON, frames)
+        else:
+            content_type = 'application/json'
+            chunks = annotation.get_serialized(jid, frames=frames)
+        # The annotation is read from the database before the first chunk,
+        # thus its errors are reported as usual
+        first_chunk = next(chunks)
     except Exception as e:
         slogger.job[jid].error("cannot get annotation for job {}".format(jid), exc_info=True)
         return HttpResponseBadRequest(str(e))
 
-    return JsonResponse(response, safe=False)
+    def iter_chunks():
+        yield first_chunk
+        yield from chunks
+
+    return _gzipped_response(request, iter_chunks(), content_type)
+
+def _save_annotation_for_job(jid, body, content_type):
+    """Save annotation and logs from the body of a save request"""
+    data = json.loads(body.decode('utf-8'))
+    if content_type == columnar.CONTENT_TYPE:
+        # Annotation and logs are nested objects here, not JSON strings
+        logs = data.get('logs', [])
+        if 'annotation' in data:
+            annotation.save_job(jid, columnar.load(data['annotation']))
+    else:
+        logs = json.loads(data['logs']) if 'logs' in data else []
+        if 'annotation' in data:
+            annotation.save_job(jid, json.loads(data['annotation']))
+    # Logs are written by a background thread after the save
+    clogger.job[jid].info(logs)
+
+def _get_save_rq_id(jid, key):
+    return 'annotation.save_job/{}/{}'.format(jid, key)
+
+def _get_save_path(jid, key):
+    db_task = models.Job.objects.select_related('segment__task').get(id=jid).segment.task
+    return os.path.join(db_task.get_task_dirname(), '.saves', '{}_{}'.format(jid, key))
+
+def _has_pending_saves(jid):
+    queue = django_rq.get_queue('annotation')
+    rq_ids = queue.get_job_ids() + StartedJobRegistry(queue=queue).get_job_ids()
+    return any(rq_id.startswith(_get_save_rq_id(jid, '')) for rq_id in rq_ids)
+
+def _save_annotation_for_job_async(jid, key, body, content_type):
+    """
+    Persist the body of a save request and schedule saving. Requests with
+    the same idempotency key are scheduled only once (e.g. retries of the
+    client after a timeout of a proxy).
+    """
+    queue = django_rq.get_queue('annotation')
+    rq_id = _get_save_rq_id(jid, key)
+    # The key is claimed atomically, thus concurrent retries don't schedule
+    # the save twice
+    if queue.connection.set('cvat:' + rq_id, 1, nx=True,
+        ex=settings.ANNOTATION_SAVE_TICKET_TTL):
+        path = _get_save_path(jid, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as body_file:
+                body_file.write(body)
+            # The queue has only one worker, thus saves for a job are applied
+            # in the order of requests
+            queue.enqueue_call(func=_apply_annotation_for_job,
+                args=(jid, key, content_type), job_id=rq_id,
+                result_ttl=settings.ANNOTATION_SAVE_TICKET_TTL)
+        except Exception:
+            # The save isn't scheduled, thus a retry with the key can do it
+            queue.connection.delete('cvat:' + rq_id)
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+    return _check_annotation_for_job(jid, key)
+
+def _apply_annotation_for_job(jid, key, content_type):
+    path = _get_save_path(jid, key)
+    try:
+        with open(path, 'rb') as body_file:
+            _save_annotation_for_job(jid, body_file.read(), content_type)
+        slogger.job[jid].info("annotation have been saved for the {} job".format(jid))
+        # The rq work horse exits right after the job without atexit handlers
+        clogger.flush()
+    finally:
+        os.remove(path)
+
+def _check_annotation_for_job(jid, key):
+    job = django_rq.get_queue('annotation').fetch_job(_get_save_rq_id(jid, key))
+    if job is None:
+        response = {"state": "unknown"}
+    elif job.is_failed:
+        response = {"state": "error", "stderr": job.exc_info}
+    elif job.is_finished:
+        response = {"state": "saved"}
+    else:
+        response = {"state": "started" if job.is_started else "queued"}
+    response['ticket'] = key
+
+    return response
 
 @login_required
 @permission_required(perm=['engine.job.change'],
@@ -255,12 +448,19 @@ def get_annotation(request, jid):
 def save_annotation_for_job(request, jid):
     try:
         slogger.job[jid].info("save annotation for {} job".format(jid))
-        data = json.loads(request.body.decode('utf-8'))
-        if 'annotation' in data:
-            annotation.save_job(jid, json.loads(data['annotation']))
-        if 'logs' in data:
-            for event in json.loads(data['logs']):
-                clogger.job[jid].info(json.dumps(event))
+        body = _get_request_body(request)
+        # Clients which can poll a ticket ask for an asynchronous save. Small
+        # saves are still synchronous if there are no earlier pending saves.
+        if 'respond-async' in request.META.get('HTTP_PREFER', '') and \
+            (len(body) >= settings.ANNOTATION_ASYNC_SAVE_MIN_SIZE or _has_pending_saves(jid)):
+            key = request.META.get('HTTP_IDEMPOTENCY_KEY') or uuid.uuid4().hex
+            if not re.match(r'^[\w-]{1,64}$', key):
+                raise Exception('Invalid idempotency key: {}'.format(key))
+            response = _save_annotation_for_job_async(jid, key, body, request.content_type)
+            slogger.job[jid].info("annotation saving for the {} job is scheduled: {}".format(jid, key))
+            return JsonResponse(response, status=202)
+
+        _save_annotation_for_job(jid, body, request.content_type)
         slogger.job[jid].info("annotation have been saved for the {} job".format(jid))
     except RequestException as e:
         slogger.job[jid].error("cannot send annotation logs for job {}".format(jid), exc_info=True)
@@ -271,13 +471,34 @@ def save_annotation_for_job(request, jid):
 
     return HttpResponse()
 
+@login_required
+@permission_required(perm=['engine.job.access'],
+    fn=objectgetter(models.Job, 'jid'), raise_exception=True)
+def check_annotation_for_job(request, jid, key):
+    """
+    Get the state of a scheduled save. If the timeout (in seconds) is
+    specified, wait until the save is completed but no more than the time.
+    """
+    try:
+        timeout = min(float(request.GET.get('timeout', 0)), settings.ANNOTATION_SAVE_POLL_TIMEOUT)
+        deadline = time.monotonic() + timeout
+        response = _check_annotation_for_job(jid, key)
+        while response['state'] in ['queued', 'started'] and time.monotonic() < deadline:
+            time.sleep(0.5)
+            response = _check_annotation_for_job(jid, key)
+    except Exception as e:
+        slogger.job[jid].error("cannot check annotation for job {}".format(jid), exc_info=True)
+        return HttpResponseBadRequest(str(e))
+
+    return JsonResponse(response)
+
 @login_required
 @permission_required(perm=['engine.task.change'],
     fn=objectgetter(models.Task, 'tid'), raise_exception=True)
 def save_annotation_for_task(request, tid):
     try:
         slogger.task[tid].info("save annotation request")
-        data = json.loads(request.body.decode('utf-8'))
+        data = json.loads(_get_request_body(request).decode('utf-8'))
         annotation.save_task(tid, data)
     except Exception as e:
         slogger.task[tid].error("cannot save annotation", exc_info=True)
@@ -18,6 +18,7 @@ from collections import OrderedDict
 import subprocess
 import django_rq
 import shutil
+import gzip
 import json
 import git
 import os
@@ -286,9 +287,16 @@ class Git:
 
         ext = os.path.splitext(self.__path)[1]
         if ext == '.zip':
-            subprocess.call('zip -j -r "{}" "{}"'.format(self.__annotation_file, dump_name), shell=True)
+            # The dump is stored compressed, but the archive has to contain XML
+            xml_name = os.path.join(os.path.dirname(dump_name),
+                os.path.splitext(os.path.basename(dump_name))[0])
+            with gzip.open(dump_name, 'rb') as src, open(xml_name, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            subprocess.call('zip -j -r "{}" "{}"'.format(self.__annotation_file, xml_name), shell=True)
+            os.remove(xml_name)
         elif ext == '.xml':
-            shutil.copyfile(dump_name, self.__annotation_file)
+            with gzip.open(dump_name, 'rb') as src, open(self.__annotation_file, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
         else:
             raise Exception("Got unknown annotation file type")
 
@@ -489,3 +497,5 @@ def _ondump(tid, data_format, scheme, host, plugin_meta_data):
 add_plugin("save_job", _onsave, "after", exc_ok = False)
 add_plugin("_create_thread", _initial_create, "before", exc_ok = False)
 add_plugin("_dump", _ondump, "before", exc_ok = False)
+add_plugin("_stream_dump", _ondump, "before", exc_ok = False)
+add_plugin("_get_dump_ticket", _ondump, "before", exc_ok = False)
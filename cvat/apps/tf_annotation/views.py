@@ -251,7 +251,11 @@ def create_thread(tid, labels_mapping):
         # Modify data format and save
         result = convert_to_cvat_format(result)
         annotation.clear_task(tid)
-        annotation.save_task(tid, result)
+        # Jobs are saved in parallel, each in its own transaction
+        errors = annotation.save_task(tid, result, atomic=False)
+        failed_jobs = [jid for jid, error in errors.items() if error]
+        if failed_jobs:
+            raise Exception("Cannot save annotations for jobs {}".format(failed_jobs))
         slogger.glob.info('tf annotation for task {} done'.format(tid))
     except:
         try:
@@ -177,6 +177,12 @@ RQ_QUEUES = {
         'PORT': 6379,
         'DB': 0,
         'DEFAULT_TIMEOUT': '24h'
+    },
+    'annotation': {
+        'HOST': 'localhost',
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': '4h'
     }
 }
 
@@ -310,12 +316,65 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 os.makedirs(STATIC_ROOT, exist_ok=True)
 DATA_ROOT = os.path.join(BASE_DIR, 'data')
 os.makedirs(DATA_ROOT, exist_ok=True)
+CACHE_ROOT = os.path.join(DATA_ROOT, 'cache')
+os.makedirs(CACHE_ROOT, exist_ok=True)
 SHARE_ROOT = os.path.join(BASE_DIR, 'share')
 os.makedirs(SHARE_ROOT, exist_ok=True)
 MODELS_ROOT=os.path.join(BASE_DIR, 'models')
 os.makedirs(MODELS_ROOT, exist_ok=True)
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024  # 100 MB
+DATA_UPLOAD_MAX_DECOMPRESSED_SIZE = 1024 * 1024 * 1024  # 1 GB (gzipped annotation)
 DATA_UPLOAD_MAX_NUMBER_FIELDS = None   # this django check disabled
 LOCAL_LOAD_MAX_FILES_COUNT = 500
 LOCAL_LOAD_MAX_FILES_SIZE = 512 * 1024 * 1024  # 512 MB
+
+# Cache of serialized annotations for jobs (see engine.annotation.get_serialized)
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'annotation': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_ROOT, 'annotation'),
+        'TIMEOUT': 7 * 24 * 60 * 60, # 1 week
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+        },
+    },
+}
+# Bigger annotations are not cached. Together with MAX_ENTRIES it limits
+# disk space used by the annotation cache.
+ANNOTATION_CACHE_MAX_ITEM_SIZE = 16 * 1024 * 1024  # 16 MB
+
+# Number of threads (each with its own database connection) which save
+# annotations for jobs of a task in parallel (e.g. after auto annotation)
+ANNOTATION_SAVE_WORKERS = int(os.getenv('CVAT_ANNOTATION_SAVE_WORKERS', 4))
+
+# Number of threads (each with its own database connection) which load
+# segments of a task in parallel for a dump. Loaded segments are merged
+# one by one in order anyway, thus the dump doesn't depend on the number.
+ANNOTATION_LOAD_WORKERS = int(os.getenv('CVAT_ANNOTATION_LOAD_WORKERS', 4))
+
+# Saves of annotations for a job which are bigger are applied asynchronously
+# by the 'annotation' queue if the client asks for it (Prefer: respond-async).
+# Tickets of such saves are kept for ANNOTATION_SAVE_TICKET_TTL seconds and a
+# client can wait for a ticket no more than ANNOTATION_SAVE_POLL_TIMEOUT seconds.
+# A waiting request occupies a web server worker, thus the wait is short.
+ANNOTATION_ASYNC_SAVE_MIN_SIZE = 10 * 1024 * 1024  # 10 MB
+ANNOTATION_SAVE_TICKET_TTL = 24 * 60 * 60
+ANNOTATION_SAVE_POLL_TIMEOUT = 5
+
+# Saves of annotations for a job are appended to a journal and applied to the
+# annotation tables later by the 'annotation' queue. It makes saves of big
+# annotations fast but reads of a job have to replay its journal meanwhile.
+ANNOTATION_JOURNAL = os.getenv('CVAT_ANNOTATION_JOURNAL', 'no').lower() in ('1', 'yes', 'true')
+
+# Events from clients are written to client logs of tasks in batches (no more
+# than CLIENT_LOG_BATCH_SIZE events) by a background thread. No more than
+# CLIENT_LOG_QUEUE_SIZE events wait for it. If the queue is full, a request
+# waits for CLIENT_LOG_PUT_TIMEOUT seconds before its events are dropped.
+CLIENT_LOG_BATCH_SIZE = 10000
+CLIENT_LOG_QUEUE_SIZE = 100000
+CLIENT_LOG_PUT_TIMEOUT = 1